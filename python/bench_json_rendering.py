@@ -0,0 +1,64 @@
+##
+## Benchmark of db_json_rendering
+##
+## Calls the list endpoints in process (Flask test client, no HTTP server) with
+## the JSON built in Python from tuples and with the JSON built by Postgres, and
+## prints the API process CPU time and the wall time per request of each.
+## Postgres time is part of the wall time only, so the CPU column is what the
+## option saves on the API side.
+##
+## Run it from the repository root against a database with data, e.g.:
+##
+##   python python/bench_json_rendering.py --assistant <email> <password> --patient <cc>
+##
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import care_sync
+
+
+def measure(client, path, token, repeat):
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    for _ in range(repeat):
+        response = client.get(path, headers={'Authorization': token})
+        if response.status_code != 200:
+            raise SystemExit(f'{path}: {response.status_code} {response.get_data(as_text=True)}')
+        response.get_data()
+    return (time.process_time() - cpu) / repeat, (time.perf_counter() - wall) / repeat, len(response.get_data())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU per request with and without db_json_rendering')
+    parser.add_argument('--assistant', nargs=2, required=True, metavar=('EMAIL', 'PASSWORD'))
+    parser.add_argument('--patient', required=True, help='cc of a patient with appointments and prescriptions')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    care_sync.logger = logging.getLogger('logger')
+    client = care_sync.app.test_client()
+    response = client.put('/dbproj/user', json={'username': args.assistant[0], 'password': args.assistant[1]})
+    if response.status_code != 200:
+        raise SystemExit(f'login failed: {response.get_json()}')
+    token = response.get_json()['results']
+
+    paths = [f'/dbproj/appointments/{args.patient}', f'/dbproj/prescriptions/{args.patient}', '/dbproj/top3', '/dbproj/report']
+    print(f'mean of {args.repeat} requests       {"tuples":>22} {"db_json_rendering":>22}')
+    print(f'{"endpoint":<32} {"cpu ms":>10} {"wall ms":>10} {"cpu ms":>10} {"wall ms":>10} {"bytes":>8}')
+    for path in paths:
+        results = []
+        for mode in (False, True):
+            care_sync.db_json_rendering = mode
+            measure(client, path, token, 1)
+            results.append(measure(client, path, token, args.repeat))
+        (cpu, wall, _), (db_cpu, db_wall, size) = results
+        print(f'{path:<32} {cpu * 1000:10.2f} {wall * 1000:10.2f} {db_cpu * 1000:10.2f} {db_wall * 1000:10.2f} {size:8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+##
+## Benchmark of the patient dashboard
+##
+## Opens the patient app --repeat times in process (Flask test client, no HTTP
+## server), first the way it does without the dashboard, GET /dbproj/appointments
+## and GET /dbproj/prescriptions one after the other (the bill balances have no list
+## endpoint, so the app without the dashboard does even more), and then with a
+## single GET /dbproj/dashboard, and prints the latency percentiles of an app open
+## and the API process CPU time of each.
+##
+## Run it from the repository root against a database with data, e.g.:
+##
+##   python python/bench_patient_dashboard.py --patient <cc> <password>
+##
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import care_sync
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(client, paths, token, repeat):
+    latencies = []
+    cpu = time.process_time()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            response = client.get(path, headers={'Authorization': token})
+            if response.status_code != 200:
+                raise SystemExit(f'{path}: {response.status_code} {response.get_data(as_text=True)}')
+            response.get_data()
+        latencies.append(time.perf_counter() - start)
+    return latencies, (time.process_time() - cpu) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Patient app open with and without the dashboard')
+    parser.add_argument('--patient', nargs=2, required=True, metavar=('CC', 'PASSWORD'))
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    care_sync.logger = logging.getLogger('logger')
+    client = care_sync.app.test_client()
+    response = client.put('/dbproj/user', json={'username': int(args.patient[0]), 'password': args.patient[1]})
+    if response.status_code != 200:
+        raise SystemExit(f'login failed: {response.get_json()}')
+    token = response.get_json()['results']
+
+    opens = {
+        'separate calls': [f'/dbproj/appointments/{args.patient[0]}', f'/dbproj/prescriptions/{args.patient[0]}'],
+        'dashboard': [f'/dbproj/dashboard/{args.patient[0]}']
+    }
+    print(f'app open, {args.repeat} times')
+    print(f'{"":<16} {"requests":>8} {"p50 ms":>10} {"p99 ms":>10} {"cpu ms":>10}')
+    for name, paths in opens.items():
+        measure(client, paths, token, 1)
+        latencies, cpu = measure(client, paths, token, args.repeat)
+        print(f'{name:<16} {len(paths):>8} {percentile(latencies, 50) * 1000:10.2f} {percentile(latencies, 99) * 1000:10.2f} {cpu * 1000:10.2f}')
+
+
+if __name__ == '__main__':
+    main()
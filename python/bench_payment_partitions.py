@@ -0,0 +1,121 @@
+##
+## Benchmark of the monthly partitioning of payment
+##
+## Builds two copies of a payment history in a scratch schema, one plain table
+## (as before migration 002) and one partitioned by month (as now), both with
+## the bill_id index, and times the payment queries of the endpoints on each:
+##
+##   top-N month   the payments of one month grouped by bill (/dbproj/top)
+##   daily         the payments of one day (/dbproj/daily)
+##   bill lookup   the payments of one bill (payment_sum, /dbproj/bills)
+##
+## The first two only read the partition of their month; the bill lookup has no
+## date, so on the partitioned table it probes the bill_id index of every
+## partition, the price paid for the other two.
+##
+## Run it from the repository root (it uses the API configuration):
+##
+##   python python/bench_payment_partitions.py --payments 2000000 --months 24
+##
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from care_sync import db_connection
+
+
+QUERIES = {
+    'top-N month': '''
+        SELECT bill_id, SUM(amount) FROM {table}
+        WHERE date_time >= %(month)s::date AND date_time < %(month)s::date + INTERVAL '1 month'
+        GROUP BY bill_id ORDER BY 2 DESC LIMIT 3
+    ''',
+    'daily': '''
+        SELECT SUM(amount) FROM {table}
+        WHERE date_time >= %(day)s::date AND date_time < %(day)s::date + 1
+    ''',
+    'bill lookup': '''
+        SELECT SUM(amount) FROM {table} WHERE bill_id = %(bill)s
+    '''
+}
+
+
+def setup(cur, payments, months):
+    cur.execute('DROP SCHEMA IF EXISTS bench_payment CASCADE')
+    cur.execute('CREATE SCHEMA bench_payment')
+    cur.execute('''
+        CREATE TABLE bench_payment.flat (
+            id BIGINT, amount INTEGER, method VARCHAR(128), date_time TIMESTAMP, bill_id BIGINT,
+            PRIMARY KEY(id, bill_id, date_time)
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE bench_payment.part (LIKE bench_payment.flat INCLUDING ALL)
+        PARTITION BY RANGE (date_time)
+    ''')
+    cur.execute('''
+        SELECT format('CREATE TABLE bench_payment.part_%%s PARTITION OF bench_payment.part FOR VALUES FROM (%%L) TO (%%L)',
+                      to_char(m, 'YYYY_MM'), m, m + INTERVAL '1 month')
+        FROM generate_series(date_trunc('month', now()) - %s * INTERVAL '1 month', date_trunc('month', now()), INTERVAL '1 month') AS m
+    ''', (months - 1,))
+    for (statement,) in cur.fetchall():
+        cur.execute(statement)
+
+    # about two payments per bill, spread over the months
+    cur.execute('''
+        INSERT INTO bench_payment.flat
+        SELECT g, 1 + g %% 100, 'card', date_trunc('month', now()) - %s * INTERVAL '1 month' + random() * (now() - (date_trunc('month', now()) - %s * INTERVAL '1 month')), g / 2
+        FROM generate_series(1, %s) AS g
+    ''', (months - 1, months - 1, payments))
+    cur.execute('INSERT INTO bench_payment.part SELECT * FROM bench_payment.flat')
+    cur.execute('CREATE INDEX ON bench_payment.flat (bill_id)')
+    cur.execute('CREATE INDEX ON bench_payment.part (bill_id)')
+    cur.execute('ANALYZE bench_payment.flat')
+    cur.execute('ANALYZE bench_payment.part')
+
+
+def run(cur, table, query, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(QUERIES[query].format(table=table), params)
+        cur.fetchall()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plain vs monthly partitioned payment table')
+    parser.add_argument('--payments', type=int, default=2000000)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--keep', action='store_true', help='keep the bench_payment schema')
+    args = parser.parse_args()
+
+    conn = db_connection()
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        setup(cur, args.payments, args.months)
+        cur.execute("SELECT to_char(date_trunc('month', now()) - INTERVAL '1 month', 'YYYY-MM-DD'), (CURRENT_DATE - 40)::text")
+        month, day = cur.fetchone()
+        params = {'month': month, 'day': day, 'bill': args.payments // 4}
+
+        print(f'{args.payments} payments over {args.months} months, median of {args.repeat} runs')
+        print(f'{"query":<12} {"plain":>10} {"partitioned":>12}')
+        for query in QUERIES:
+            flat = run(cur, 'bench_payment.flat', query, params, args.repeat)
+            part = run(cur, 'bench_payment.part', query, params, args.repeat)
+            print(f'{query:<12} {flat * 1000:8.2f}ms {part * 1000:10.2f}ms')
+    finally:
+        if not args.keep:
+            cur.execute('DROP SCHEMA IF EXISTS bench_payment CASCADE')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+##
+## Benchmark of the bulk prescription endpoint
+##
+## Writes a ward round of --prescriptions prescriptions (two medicines each) for
+## the given hospitalizations, first one POST /dbproj/prescription per
+## prescription and then a single POST /dbproj/prescriptions, in process (Flask
+## test client, no HTTP server), and prints the wall time of each and the API
+## process CPU time. Both rounds are committed, so run it against a scratch
+## database: every run adds 2 * --prescriptions prescriptions.
+##
+## Run it from the repository root, e.g.:
+##
+##   python python/bench_ward_round.py --doctor <email> <password> --hospitalizations 1 2 3
+##
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import care_sync
+
+
+def ward_round(hospitalizations, prescriptions):
+    return [{
+        'type': 'hospitalization',
+        'event_id': hospitalizations[i % len(hospitalizations)],
+        'validity': '2030-01-01',
+        'medicines': [
+            {'name': 'paracetamol', 'posology_dose': '1 g', 'posology_frequency': 'every 8 hours'},
+            {'name': 'enoxaparin', 'posology_dose': '40 mg', 'posology_frequency': 'daily'}
+        ]
+    } for i in range(prescriptions)]
+
+
+def measure(run):
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    run()
+    return time.process_time() - cpu, time.perf_counter() - wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description='One request per prescription vs one bulk request')
+    parser.add_argument('--doctor', nargs=2, required=True, metavar=('EMAIL', 'PASSWORD'))
+    parser.add_argument('--hospitalizations', nargs='+', type=int, required=True)
+    parser.add_argument('--prescriptions', type=int, default=500)
+    args = parser.parse_args()
+
+    care_sync.logger = logging.getLogger('logger')
+    client = care_sync.app.test_client()
+    response = client.put('/dbproj/user', json={'username': args.doctor[0], 'password': args.doctor[1]})
+    if response.status_code != 200:
+        raise SystemExit(f'login failed: {response.get_json()}')
+    headers = {'Authorization': response.get_json()['results']}
+
+    prescriptions = ward_round(args.hospitalizations, args.prescriptions)
+
+    def one_by_one():
+        for prescription in prescriptions:
+            response = client.post('/dbproj/prescription', headers=headers, json=prescription)
+            if response.status_code != 200:
+                raise SystemExit(f'/dbproj/prescription: {response.get_json()}')
+
+    def bulk():
+        response = client.post('/dbproj/prescriptions', headers=headers, json={'prescriptions': prescriptions})
+        if response.status_code != 200:
+            raise SystemExit(f'/dbproj/prescriptions: {response.get_json()}')
+
+    print(f'ward round of {args.prescriptions} prescriptions')
+    print(f'{"":<14} {"wall ms":>10} {"cpu ms":>10}')
+    for name, run in (('one by one', one_by_one), ('bulk', bulk)):
+        cpu, wall = measure(run)
+        print(f'{name:<14} {wall * 1000:10.1f} {cpu * 1000:10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -16,11 +16,27 @@
 ##   University of Coimbra
 
 
+import concurrent.futures
+import cProfile
+import csv
+import datetime
 import flask
+import io
+import itertools
 import jwt
 import logging
+import math
+import os
 import psycopg2
+import pstats
+import queue
+import random
+import re
+import select
+import tempfile
+import threading
 import time
+import zlib
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
 from cryptography.fernet import Fernet
@@ -30,8 +46,12 @@ app = flask.Flask(__name__)
 
 StatusCodes = {
     'success': 200,
+    'accepted': 202,
+    'not_modified': 304,
     'api_error': 400,
-    'internal_error': 500
+    'internal_error': 500,
+    'unavailable': 503,
+    'timeout': 504
 }
 
 def load_config(file_path="secret.key"):
@@ -56,22 +76,657 @@ app.config['SECRET_KEY'] = credentials['SECRET_KEY']
 ## DATABASE ACCESS
 ##########################################################
 
-def db_connection():
+# patient-centric rows (patients, appointments, hospitalizations, surgeries, bills,
+# payments and prescriptions) can be spread over several databases, e.g.
+# "shards": [{"database": "prjdb_0"}, {"database": "prjdb_1", "host": "10.0.0.2"}]
+# (missing fields are taken from the primary, see setup_shards.py); a patient lives on
+# shard_for(cc) and the ids created on a shard tell it (configure_shard in
+# object_definition.sql), so single-patient endpoints use one shard and cross-patient
+# reports gather the results of every shard. Reference data (employees, specialties,
+# nurse hierarchy) is written to every shard, shard 0 also holds the report jobs.
+# Without "shards" the primary is the only shard
+# (a shard only has the replicas it lists)
+if ('shards' in credentials):
+    shards = [dict(credentials, **{'replicas': [], **shard}) for shard in credentials['shards']]
+else:
+    shards = [dict(credentials)]
+
+def shard_for(patient_cc):
+    # a stable hash, the same in every process and run
+    return zlib.crc32(str(int(patient_cc)).encode()) % len(shards)
+
+def shard_of(record_id):
+    return (int(record_id) - 1) % len(shards)
+
+def db_connection(shard=0):
     db = psycopg2.connect(
-        user = credentials['user'],
-        password = credentials['password'],
-        host = credentials['host'],
-        port = credentials['port'],
-        database = credentials['database']
+        user = shards[shard]['user'],
+        password = shards[shard]['password'],
+        host = shards[shard]['host'],
+        port = shards[shard]['port'],
+        database = shards[shard]['database'],
+        connection_factory = DeadlineConnection
     )
+    db.deadline = request_deadline()
 
     return db
 
 
+class ShardedCursor:
+    def __init__(self, cursors):
+        self.cursors = cursors
+
+    def execute(self, statement, values=None):
+        # run on every shard even after a failure, so the serials of the reference
+        # tables (emp_num) advance the same way everywhere
+        failure = None
+        for cur in self.cursors:
+            try:
+                cur.execute(statement, values)
+            except psycopg2.Error as error:
+                failure = failure or error
+        if failure is not None:
+            raise failure
+
+    def fetchone(self):
+        return self.cursors[0].fetchone()
+
+    def fetchall(self):
+        return self.cursors[0].fetchall()
+
+    @property
+    def rowcount(self):
+        return self.cursors[0].rowcount
+
+
+class ShardedConnection:
+    # writes of reference data: the same statements on every shard, committed together
+    # (one shard after the other, a failure between two commits needs a manual fix)
+    def __init__(self):
+        self.connections = []
+        for shard in range(len(shards)):
+            self.connections.append(db_connection(shard))
+
+    @property
+    def autocommit(self):
+        return self.connections[0].autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        for conn in self.connections:
+            conn.autocommit = value
+
+    def cursor(self):
+        return ShardedCursor([conn.cursor() for conn in self.connections])
+
+    def commit(self):
+        for conn in self.connections:
+            conn.commit()
+
+    def rollback(self):
+        for conn in self.connections:
+            conn.rollback()
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+
+def reference_connection():
+    if (len(shards) == 1):
+        return db_connection()
+    return ShardedConnection()
+
+
+def scatter(statement, values=None, read=True):
+    # runs statement on every shard (one thread each) and returns the rows of each shard
+    deadline = request_deadline()
+
+    def run(shard):
+        conn = replica_connection(shard) if read else db_connection(shard)
+        # the threads do not see the request, they get its deadline from here
+        conn.deadline = deadline
+        try:
+            cur = conn.cursor()
+            cur.execute(statement, values)
+            rows = cur.fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    if (len(shards) == 1):
+        return [run(0)]
+    with concurrent.futures.ThreadPoolExecutor(len(shards)) as executor:
+        return list(executor.map(run, range(len(shards))))
+
+
+# batches over several shards (payment imports, ward rounds) run a transaction per shard
+# and commit them one after the other: there is no two-phase commit, Postgres refuses to
+# PREPARE a transaction that used temporary tables (the batches stage their rows in
+# them). When the first commit fails nothing was applied and the error is raised; a
+# failure after that cannot be undone, the other shards are still committed and the
+# caller reports which shards were (committed, {shard: error})
+def commit_shards(connections):
+    committed = []
+    failed = {}
+    for shard, conn in connections.items():
+        try:
+            conn.commit()
+            committed.append(shard)
+        except psycopg2.Error as error:
+            if (not committed):
+                raise
+            failed[shard] = str(error).strip()
+    return committed, failed
+
+
+# a booking on one shard cannot see the appointments and surgeries the same doctors and
+# nurses have on the others: with several shards the API locks the staff on shard 0
+# (transaction advisory locks, in a fixed order) and asks the other shards with
+# staff_busy before booking, holding the locks until the booking is committed
+def lock_staff(doctor_ids, nurse_ids, busy_start, busy_end, patient_shard):
+    if (len(shards) == 1):
+        return None
+
+    coordinator = db_connection(0)
+    try:
+        cur = coordinator.cursor()
+        for staff in sorted(set(doctor_ids) | set(nurse_ids)):
+            cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (staff,))
+        for shard in range(len(shards)):
+            if (shard == patient_shard):
+                continue
+            conn = db_connection(shard)
+            try:
+                cur = conn.cursor()
+                cur.execute('SELECT staff_busy(%s, %s, %s, %s)', (list(doctor_ids), list(nurse_ids), busy_start, busy_end))
+                busy = cur.fetchone()[0]
+                conn.commit()
+            finally:
+                conn.close()
+            if (busy):
+                raise psycopg2.DataError('Doctor, nurse or patient unavailable at this time')
+    except Exception:
+        coordinator.close()
+        raise
+    return coordinator
+
+def unlock_staff(coordinator):
+    if (coordinator is not None):
+        coordinator.rollback()
+        coordinator.close()
+
+
+# read-only endpoints are served by streaming replicas when configured, e.g.
+# "replicas": [{"host": "127.0.0.1", "port": "5433"}] (missing fields are taken from the primary),
+# with shards each shard lists its own replicas
+# a replica lagging more than replica_max_lag seconds, or down, is skipped for REPLICA_CHECK_INTERVAL seconds
+REPLICA_CHECK_INTERVAL = 5
+replica_max_lag = credentials.get('replica_max_lag', 5)
+replicas = [[dict(shard, **replica) for replica in shard.get('replicas', [])] for shard in shards]
+replica_status = [[(0, True)] * len(shard_replicas) for shard_replicas in replicas] # (checked_at, healthy)
+replica_counter = itertools.count()
+
+def replica_connection(shard=0):
+    shard_replicas = replicas[shard]
+    shard_status = replica_status[shard]
+    for _ in range(len(shard_replicas)):
+        idx = next(replica_counter) % len(shard_replicas)
+        checked_at, healthy = shard_status[idx]
+        now = time.monotonic()
+        if (not healthy and now - checked_at < REPLICA_CHECK_INTERVAL):
+            continue
+
+        try:
+            db = psycopg2.connect(
+                user = shard_replicas[idx]['user'],
+                password = shard_replicas[idx]['password'],
+                host = shard_replicas[idx]['host'],
+                port = shard_replicas[idx]['port'],
+                database = shard_replicas[idx]['database'],
+                connection_factory = DeadlineConnection
+            )
+            db.deadline = request_deadline()
+        except psycopg2.OperationalError as error:
+            logger.warning(f'replica {shard_replicas[idx]["host"]}:{shard_replicas[idx]["port"]} unavailable: {error}')
+            shard_status[idx] = (now, False)
+            continue
+
+        if (now - checked_at >= REPLICA_CHECK_INTERVAL):
+            # a streaming replica that replayed everything it received is up to date, even if the
+            # primary is idle; one whose WAL receiver is not streaming has nothing left to replay
+            # either but may be hours behind, so it counts as lagging
+            # (the status needs pg_read_all_stats, see database_setup.sql)
+            try:
+                cur = db.cursor()
+                cur.execute('''
+                    SELECT
+                        COALESCE((SELECT status = 'streaming' FROM pg_stat_wal_receiver), FALSE),
+                        CASE
+                            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                        END
+                ''')
+                streaming, lag = cur.fetchone()
+                db.rollback()
+            except psycopg2.Error as error:
+                logger.warning(f'replica {shard_replicas[idx]["host"]}:{shard_replicas[idx]["port"]} lag check failed: {error}')
+                shard_status[idx] = (now, False)
+                db.close()
+                continue
+
+            healthy = streaming and lag <= replica_max_lag
+            shard_status[idx] = (now, healthy)
+            if (not healthy):
+                logger.warning(f'replica {shard_replicas[idx]["host"]}:{shard_replicas[idx]["port"]} lagging {lag}s (streaming: {streaming})')
+                db.close()
+                continue
+
+        return db
+
+    # no replica configured or none usable, read from the primary
+    return db_connection(shard)
+
+
+# payments are partitioned by month, make sure the partitions ahead exist
+# (checked once per month by each process, the function is idempotent and serialised
+# in the database); a failure is not fatal, payments land in payment_default meanwhile
+PAYMENT_PARTITION_MONTHS = 3
+payment_partitions_month = None
+payment_partitions_lock = threading.Lock()
+
+def ensure_payment_partitions():
+    global payment_partitions_month
+
+    month = time.strftime('%Y-%m')
+    if (payment_partitions_month == month):
+        return
+
+    with payment_partitions_lock:
+        if (payment_partitions_month == month):
+            return
+
+        try:
+            scatter("SELECT create_payment_partitions(CURRENT_DATE, (CURRENT_DATE + %s * INTERVAL '1 month')::date)", (PAYMENT_PARTITION_MONTHS,), read=False)
+            payment_partitions_month = month
+        except psycopg2.Error as error:
+            logger.warning(f'could not create the payment partitions: {error}')
+
+
+# list endpoints can let Postgres build the JSON (json_agg) and send it as is,
+# instead of fetching tuples, building dicts and serialising them again
+db_json_rendering = credentials.get('db_json_rendering', False)
+
+# how Flask writes dates and datetimes (http_date), so both renderings return the same values
+HTTP_DATE_FORMAT = 'Dy, DD Mon YYYY HH24:MI:SS "GMT"'
+
+def json_response(results):
+    # results is a JSON document rendered by Postgres, it is never parsed here
+    body = '{"status": %d, "results": %s}' % (StatusCodes['success'], results)
+    return flask.Response(body, status=StatusCodes['success'], mimetype='application/json')
+
+
+# conditional GET of the patient lists: patient_version (bumped by triggers whenever the
+# appointments, prescriptions or bills of a patient change) is read before the list, in
+# the same transaction, so an unchanged list costs a primary key lookup and a 304;
+# reading the version first means the list sent can only be newer than its ETag, which
+# at worst makes the next poll fetch it again
+def patient_etag(cur, patient_cc, resource, daily=False):
+    cur.execute('SELECT COALESCE((SELECT version FROM patient_version WHERE patient_cc = %s), 0), CURRENT_DATE', (patient_cc,))
+    version, today = cur.fetchone()
+    # lists filtered on the current date change at midnight without any write
+    if (daily):
+        return f'{resource}-{patient_cc}-{version}-{today:%Y%m%d}'
+    return f'{resource}-{patient_cc}-{version}'
+
+def not_modified(etag):
+    return flask.request.if_none_match.contains_weak(etag)
+
+def etag_response(response, etag):
+    # response is a dict to jsonify or a flask.Response (JSON rendered by Postgres, 304)
+    if (not isinstance(response, flask.Response)):
+        response = flask.make_response(flask.jsonify(response), response['status'])
+    if (etag is not None and response.status_code in (StatusCodes['success'], StatusCodes['not_modified'])):
+        # weak: both renderings (db_json_rendering) carry the same data, not the same bytes
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# admission control: all endpoints share ADMISSION_SLOTS slots (each one holds a
+# Postgres connection, keep it below max_connections), every class of endpoints can
+# use at most its share of them and waits in a short queue for a free one; a free
+# slot always goes to the waiting class with the highest priority, and what does not
+# fit in the queue (or waits too long) is shed with a 503, so a burst of reports
+# cannot take the connections bookings and payments need
+ADMISSION_SLOTS = 30
+ADMISSION_LIMITS = {
+    # class (by priority): (max slots, queue, max wait in seconds)
+    'write': (30, 60, 2),       # registrations, bookings, prescriptions and payments
+    'read': (20, 20, 1),        # lists and login
+    'analytics': (2, 4, 0.5)    # reports and maintenance (size it to the database cores)
+}
+ADMISSION_RETRY_AFTER = 1
+
+class AdmissionControl:
+    def __init__(self, slots, limits):
+        self.slots = slots
+        self.limits = limits
+        self.priority = list(limits)
+        self.running = {route_class: 0 for route_class in limits}
+        self.waiting = {route_class: 0 for route_class in limits}
+        self.condition = threading.Condition()
+
+    def can_run(self, route_class):
+        if (sum(self.running.values()) >= self.slots or self.running[route_class] >= self.limits[route_class][0]):
+            return False
+        # a higher priority class that is waiting gets the slot first
+        for other in self.priority[:self.priority.index(route_class)]:
+            if (self.waiting[other] > 0):
+                return False
+        return True
+
+    def acquire(self, route_class):
+        _, queue, wait = self.limits[route_class]
+        deadline = time.monotonic() + wait
+        with self.condition:
+            if (self.waiting[route_class] == 0 and self.can_run(route_class)):
+                self.running[route_class] += 1
+                return True
+            if (self.waiting[route_class] >= queue):
+                return False
+
+            self.waiting[route_class] += 1
+            try:
+                while (not self.can_run(route_class)):
+                    remaining = deadline - time.monotonic()
+                    if (remaining <= 0):
+                        return False
+                    self.condition.wait(remaining)
+                self.running[route_class] += 1
+                return True
+            finally:
+                self.waiting[route_class] -= 1
+                # lower priority classes may be able to run now
+                self.condition.notify_all()
+
+    def release(self, route_class):
+        with self.condition:
+            self.running[route_class] -= 1
+            self.condition.notify_all()
+
+admission = AdmissionControl(
+    credentials.get('admission_slots', ADMISSION_SLOTS),
+    {route_class: tuple(credentials.get('admission_limits', {}).get(route_class, limits)) for route_class, limits in ADMISSION_LIMITS.items()}
+)
+
+# deadlines: every endpoint under admission control has a budget of seconds, counted
+# from its admission request (the wait for a slot included), set by its class or by
+# ROUTE_DEADLINES for the endpoints that do more. Each statement the endpoint sends runs
+# with statement_timeout and lock_timeout set to what is left of the budget (SET LOCAL,
+# in the same round trip), so Postgres cancels it, and the transaction gives its locks
+# back, instead of working for a client that gave up; the answer is then a 504.
+# Timeouts are counted per endpoint (GET /dbproj/metrics), per worker process
+DEADLINES = {
+    'write': 5,
+    'read': 5,
+    'analytics': 30
+}
+ROUTE_DEADLINES = {
+    'add_prescriptions': 30,    # a whole ward round
+    'import_payments': 300,     # a settlement file
+    'archive_history': 600
+}
+
+# a statement cancelled for the deadline of its request; a psycopg2 error like the
+# cancellation itself, so every handler and helper that copes with a failed statement
+# copes with it too
+class RequestTimeout(psycopg2.extensions.QueryCanceledError):
+    pass
+
+class Deadline:
+    def __init__(self, budget):
+        self.at = time.monotonic() + budget
+        # set when a statement ran out of it (in any thread)
+        self.expired = False
+
+def request_deadline():
+    if (not flask.has_request_context()):
+        return None
+    return flask.g.get('deadline')
+
+class DeadlineCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        deadline = self.connection.deadline
+        if (deadline is None or self.connection.autocommit):
+            return super().execute(query, vars)
+
+        # rounded up, Postgres gives up at the deadline and not before
+        remaining = math.ceil((deadline.at - time.monotonic()) * 1000)
+        try:
+            if (remaining <= 0):
+                raise RequestTimeout('Request deadline exceeded')
+            try:
+                return super().execute(f'SET LOCAL statement_timeout = {remaining}; SET LOCAL lock_timeout = {remaining}; '.encode() + self.mogrify(query, vars))
+            except (psycopg2.errors.QueryCanceled, psycopg2.errors.LockNotAvailable) as error:
+                raise RequestTimeout(f'Request deadline exceeded: {error}'.strip()) from error
+        except RequestTimeout:
+            deadline.expired = True
+            raise
+
+class DeadlineConnection(psycopg2.extensions.connection):
+    # the deadline of the request that opened it, None outside requests (jobs, listeners)
+    deadline = None
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', DeadlineCursor)
+        return super().cursor(*args, **kwargs)
+
+class RouteMetrics:
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def count(self, route, counter):
+        with self.lock:
+            counters = self.counters.setdefault(route, {'requests': 0, 'shed': 0, 'timeouts': 0})
+            counters[counter] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {route: dict(counters) for route, counters in self.counters.items()}
+
+route_metrics = RouteMetrics()
+route_budgets = {}
+
+def timed_out(response, deadline):
+    # the handlers answer a failed statement with a 500, a RequestTimeout among them
+    # (also when it came from a thread of scatter); what failed otherwise, or after
+    # the commit, keeps its answer
+    status = flask.make_response(response).status_code
+    return status == StatusCodes['internal_error'] and deadline.expired
+
+def admission_control(route_class):
+    def decorator(f):
+        budget = credentials.get('route_deadlines', {}).get(f.__name__, ROUTE_DEADLINES.get(f.__name__, DEADLINES[route_class]))
+        route_budgets[f.__name__] = (route_class, budget)
+
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            deadline = Deadline(budget)
+            flask.g.deadline = deadline
+            route_metrics.count(f.__name__, 'requests')
+            if (not admission.acquire(route_class)):
+                logger.warning(f'{flask.request.method} {flask.request.path} - shed ({route_class} queue full)')
+                route_metrics.count(f.__name__, 'shed')
+                response = {'status': StatusCodes['unavailable'], 'errors': 'Server busy, try again later'}
+                return flask.jsonify(response), response['status'], {'Retry-After': str(ADMISSION_RETRY_AFTER)}
+
+            try:
+                result = f(*args, **kwargs)
+            finally:
+                admission.release(route_class)
+
+            if (timed_out(result, deadline)):
+                logger.warning(f'{flask.request.method} {flask.request.path} - timeout ({budget}s)')
+                route_metrics.count(f.__name__, 'timeouts')
+                response = {'status': StatusCodes['timeout'], 'errors': f'Request deadline exceeded ({budget}s), try again later'}
+                return flask.jsonify(response), response['status']
+            return result
+        return decorated
+    return decorator
+
+
+# change feed: the write functions NOTIFY on CHANGE_FEED_CHANNEL when they commit
+# (notify_change in object_definition.sql) and each worker process keeps a single
+# LISTEN connection per shard, started with the first subscriber, that fans the events out to
+# the queues of its /dbproj/events streams; a subscriber that does not keep up is
+# dropped (its client reconnects) instead of holding the others back
+CHANGE_FEED_CHANNEL = 'care_sync'
+CHANGE_FEED_QUEUE = 100             # events buffered per subscriber
+CHANGE_FEED_MAX_SUBSCRIBERS = 200   # streams per worker (each one holds a thread)
+CHANGE_FEED_HEARTBEAT = 15          # seconds between keep-alive comments
+CHANGE_FEED_MAX_AGE = 900           # a stream ends with its token, clients reconnect with a new one
+CHANGE_FEED_RECONNECT = 3           # seconds before listening again after losing the connection
+
+class ChangeFeed:
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.threads = None
+
+    def subscribe(self, accepts):
+        # accepts(event) says whether the subscriber is allowed to see an event;
+        # one more slot than the buffer for the end of stream marker
+        subscriber = queue.Queue(CHANGE_FEED_QUEUE + 1)
+        with self.lock:
+            if (len(self.subscribers) >= CHANGE_FEED_MAX_SUBSCRIBERS):
+                return None
+            self.subscribers[subscriber] = accepts
+            if (self.threads is None):
+                self.threads = [threading.Thread(target=self.listen, args=(shard,), name=f'change-feed-{shard}', daemon=True) for shard in range(len(shards))]
+                for thread in self.threads:
+                    thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.pop(subscriber, None)
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for subscriber, accepts in subscribers:
+            if (event['event'] != 'reset' and not accepts(event)):
+                continue
+            # only this thread puts, so the size checked is never exceeded
+            if (subscriber.qsize() >= CHANGE_FEED_QUEUE):
+                logger.warning('change feed subscriber too slow, dropped')
+                self.unsubscribe(subscriber)
+                subscriber.put_nowait(None)
+            else:
+                subscriber.put_nowait(event)
+
+    def listen(self, shard=0):
+        while True:
+            conn = None
+            try:
+                conn = db_connection(shard)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f'LISTEN {CHANGE_FEED_CHANNEL}')
+                logger.info(f'change feed listening on {CHANGE_FEED_CHANNEL} of shard {shard}')
+                while True:
+                    if (select.select([conn], [], [], CHANGE_FEED_HEARTBEAT) == ([], [], [])):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.publish(json.loads(notify.payload))
+                        except ValueError:
+                            logger.warning(f'change feed - invalid payload: {notify.payload}')
+            except psycopg2.Error as error:
+                logger.error(f'change feed - error: {error}')
+            finally:
+                if conn is not None:
+                    conn.close()
+
+            # events sent while not listening are lost, subscribers must fetch the lists again
+            self.publish({'event': 'reset'})
+            time.sleep(CHANGE_FEED_RECONNECT)
+
+change_feed = ChangeFeed()
+
+def change_feed_filter(user_id, user_type):
+    if (user_type == 'assistant'):
+        return lambda event: True
+    if (user_type == 'patient'):
+        return lambda event: event.get('patient_cc') == user_id
+    # doctors and nurses see the events they take part in
+    key = 'doctors' if user_type == 'doctor' else 'nurses'
+    return lambda event: user_id in event.get(key, [])
+
+
 ##########################################################
 ## LOGGING
 ##########################################################
 
+# profiling: a request of a PROFILE_ROLES token with the X-Profile header runs its
+# handler under cProfile, for profile_sample_rate of such requests (lower it when a
+# client sends the header every time), and the stats are saved in profile_dir, named
+# <time>-<process>-<route>-<duration>ms.prof, keeping the last PROFILE_RING files
+# (see GET /dbproj/profiles). The answer tells the file in X-Profile-Id. Other
+# requests only pay for the header lookup. Threads the handler starts (scatter,
+# report jobs) are not profiled
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ROLES = ['assistant']
+PROFILE_RING = 50
+PROFILE_TEXT_LINES = 60         # functions in the ?format=text view
+PROFILE_NAME = re.compile(r'(\d+)-(\d+)-(\w+)-(\d+)ms\.prof')
+profile_sample_rate = credentials.get('profile_sample_rate', 1.0)
+profile_dir = credentials.get('profile_dir', 'profiles')
+
+def profiled(user_type):
+    return PROFILE_HEADER in flask.request.headers and user_type in PROFILE_ROLES and random.random() < profile_sample_rate
+
+def profile_call(f, *args, **kwargs):
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        result = f(*args, **kwargs)
+    finally:
+        profiler.disable()
+    duration = int((time.perf_counter() - start) * 1000)
+
+    name = f'{int(time.time() * 1000)}-{os.getpid()}-{f.__name__}-{duration}ms.prof'
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, name + '.tmp'))
+        os.replace(os.path.join(profile_dir, name + '.tmp'), os.path.join(profile_dir, name))
+        # the oldest go, whichever process wrote them
+        for old in sorted(profile_names())[:-PROFILE_RING]:
+            try:
+                os.remove(os.path.join(profile_dir, old))
+            except FileNotFoundError:
+                pass
+    except OSError as error:
+        logger.warning(f'{flask.request.method} {flask.request.path} - profile not saved: {error}')
+        return result
+
+    response = flask.make_response(result)
+    response.headers['X-Profile-Id'] = name
+    return response
+
+def profile_names():
+    # only the files named like profile_call names them: anything else in profile_dir
+    # is neither listed, served nor dropped from the ring
+    try:
+        return [name for name in os.listdir(profile_dir) if PROFILE_NAME.fullmatch(name)]
+    except FileNotFoundError:
+        return []
+
 def token_required(allowed_roles):
     def decorator(f):
         @wraps(f)
@@ -96,6 +751,8 @@ def token_required(allowed_roles):
             except Exception as e:
                 return flask.jsonify({'status': StatusCodes['api_error'], 'errors': str(e)}), StatusCodes['api_error']
 
+            if (profiled(kwargs['user_type'])):
+                return profile_call(f, *args, **kwargs)
             return f(*args, **kwargs)
         return decorated
     return decorator
@@ -117,6 +774,7 @@ def token_required(allowed_roles):
 ## http://localhost:8080/dbproj/register/patient
 ##
 @app.route('/dbproj/register/patient', methods=['POST'])
+@admission_control('write')
 def add_patient():
     logger.info('POST /dbproj/register/patient')
     payload = flask.request.get_json()
@@ -143,7 +801,7 @@ def add_patient():
     values = (payload['cc'], payload['name'], hashed_password, payload['health_number'], payload['emergency_contact'], payload['birthday'], payload['email'],)
 
     try:
-        conn = db_connection()
+        conn = db_connection(shard_for(payload['cc']))
         conn.autocommit = False
         cur = conn.cursor()
 
@@ -175,6 +833,7 @@ def add_patient():
 ## http://localhost:8080/dbproj/register/assistant
 ##
 @app.route('/dbproj/register/assistant', methods=['POST'])
+@admission_control('write')
 def add_assistant():
     logger.info('POST /dbproj/register/assistant')
     payload = flask.request.get_json()
@@ -203,7 +862,8 @@ def add_assistant():
     values = (payload['cc'], payload['name'], hashed_password, payload['contract_id'], payload['salary'], payload['contract_issue_date'], payload['contract_due_date'], payload['birthday'], payload['email'],)
 
     try:
-        conn = db_connection()
+        # reference data, on every shard
+        conn = reference_connection()
         conn.autocommit = False
         cur = conn.cursor()
 
@@ -237,6 +897,7 @@ def add_assistant():
 ## http://localhost:8080/dbproj/register/nurse
 ##
 @app.route('/dbproj/register/nurse', methods=['POST'])
+@admission_control('write')
 def add_nurse():
     logger.info('POST /dbproj/register/nurse')
     payload = flask.request.get_json()
@@ -268,7 +929,8 @@ def add_nurse():
     values = (payload['cc'], payload['name'], hashed_password, payload['contract_id'], payload['salary'], payload['contract_issue_date'], payload['contract_due_date'], payload['birthday'], payload['email'], payload['superior_email'],)
 
     try:
-        conn = db_connection()
+        # reference data, on every shard
+        conn = reference_connection()
         conn.autocommit = False
         cur = conn.cursor()
 
@@ -302,6 +964,7 @@ def add_nurse():
 ## http://localhost:8080/dbproj/register/doctor
 ##
 @app.route('/dbproj/register/doctor', methods=['POST'])
+@admission_control('write')
 def add_doctor():
     logger.info('POST /dbproj/register/doctor')
     payload = flask.request.get_json()
@@ -355,7 +1018,8 @@ def add_doctor():
         parent_specialties,)
 
     try:
-        conn = db_connection()
+        # reference data, on every shard
+        conn = reference_connection()
         conn.autocommit = False
         cur = conn.cursor()
 
@@ -392,6 +1056,7 @@ def add_doctor():
 ## http://localhost:8080/dbproj/user
 ##
 @app.route('/dbproj/user', methods=['PUT'])
+@admission_control('read')
 def login():
     logger.info('PUT /dbproj/user')
     payload = flask.request.get_json()
@@ -421,7 +1086,8 @@ def login():
     value = (payload['username'],)
 
     try:
-        conn = db_connection()
+        # patients are found on their shard, employees on any (shard 0)
+        conn = db_connection(shard_for(payload['username']) if is_patient else 0)
         conn.autocommit = False
         cur = conn.cursor()
 
@@ -479,6 +1145,7 @@ def login():
 ##
 @app.route('/dbproj/appointment', methods=['POST'])
 @token_required(['patient'])
+@admission_control('write')
 def schedule_appointment(user_id, user_type):
     logger.info('POST /dbproj/appointment')
     payload = flask.request.get_json()
@@ -499,11 +1166,14 @@ def schedule_appointment(user_id, user_type):
     '''
     values = (payload['appointment_time'], payload['doctor_id'], user_id,)
 
+    coordinator = None
     try:
-        conn = db_connection()
+        conn = db_connection(shard_for(user_id))
         conn.autocommit = False
         cur = conn.cursor()
 
+        # the doctor's bookings on the other shards
+        coordinator = lock_staff([payload['doctor_id']], [], payload['appointment_time'], None, shard_for(user_id))
         cur.execute(statement, values)
         appointment_id = cur.fetchone()[0]
 
@@ -519,6 +1189,7 @@ def schedule_appointment(user_id, user_type):
         conn.rollback()
 
     finally:
+        unlock_staff(coordinator)
         if conn is not None:
             conn.close()
 
@@ -532,12 +1203,15 @@ def schedule_appointment(user_id, user_type):
 ## 
 ## Only assistants and the target patient can use this endpoint
 ##
+## Sends an ETag, a request with If-None-Match and the same ETag gets a 304
+##
 ## To use it, access:
 ## 
 ## http://localhost:8080/dbproj/appointments/<patient_user_id>
 ##
 @app.route('/dbproj/appointments/<patient_user_id>', methods=['GET'])
 @token_required(['assistant', 'patient'])
+@admission_control('read')
 def get_appointments(patient_user_id, user_id, user_type):
     logger.info('GET /dbproj/appointments/<patient_user_id>')
 
@@ -558,19 +1232,44 @@ def get_appointments(patient_user_id, user_id, user_type):
                 WHERE a.patient_cc = %s AND a.doctor_email = e.email'
     value = (patient_user_id,)
 
+    # archived appointments are only read on request (?archived=true)
+    if (flask.request.args.get('archived', 'false').lower() == 'true'):
+        statement += ' UNION ALL \
+                SELECT a.id, e.emp_num, a.start_time \
+                FROM archive.appointment AS a, employee AS e \
+                WHERE a.patient_cc = %s AND a.doctor_email = e.email'
+        value = (patient_user_id, patient_user_id,)
+        resource = 'appointments-archived'
+    else:
+        resource = 'appointments'
+
+    if (db_json_rendering):
+        statement = f'''
+            SELECT COALESCE(json_agg(json_build_object('id', a.id, 'doctor_id', a.emp_num, 'start_time', to_char(a.start_time, '{HTTP_DATE_FORMAT}'))), '[]')::text
+            FROM ({statement}) AS a
+        '''
+
+    etag = None
     try:
-        conn = db_connection()
+        conn = replica_connection(shard_for(patient_user_id))
         conn.autocommit = False
         cur = conn.cursor()
 
-        cur.execute(statement, value)
-        rows = cur.fetchall()
+        etag = patient_etag(cur, patient_user_id, resource)
+        if (not_modified(etag)):
+            response = flask.Response(status=StatusCodes['not_modified'])
+        elif (db_json_rendering):
+            cur.execute(statement, value)
+            response = json_response(cur.fetchone()[0])
+        else:
+            cur.execute(statement, value)
+            rows = cur.fetchall()
 
-        appointments = []
-        for row in rows:
-            appointments.append({'id': int(row[0]), 'doctor_id': int(row[1]), 'start_time': row[2]})
+            appointments = []
+            for row in rows:
+                appointments.append({'id': int(row[0]), 'doctor_id': int(row[1]), 'start_time': row[2]})
 
-        response = {'status': StatusCodes['success'], 'results': appointments}
+            response = {'status': StatusCodes['success'], 'results': appointments}
 
         # commit the transaction
         conn.commit()
@@ -586,7 +1285,7 @@ def get_appointments(patient_user_id, user_id, user_type):
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return etag_response(response, etag)
 
 
 ##
@@ -603,10 +1302,13 @@ def get_appointments(patient_user_id, user_id, user_type):
 ## http://localhost:8080/dbproj/surgery/<int:hospitalization_id>
 ##
 ## If the hospitalization_id is provided, the surgery will be associated to that hospitalization
+## Otherwise an optional hospitalization_team (nurse email) requires the responsable nurse of the
+## new hospitalization to be that nurse or under them (rejected with an existing hospitalization)
 ##
 @app.route('/dbproj/surgery', methods=['POST'], defaults={'hospitalization_id': None})
 @app.route('/dbproj/surgery/<int:hospitalization_id>', methods=['POST'])
 @token_required(['assistant'])
+@admission_control('write')
 def schedule_surgery(hospitalization_id, user_id, user_type):
     if (hospitalization_id):
         logger.info(f'POST /dbproj/surgery/{hospitalization_id}')
@@ -625,7 +1327,12 @@ def schedule_surgery(hospitalization_id, user_id, user_type):
         if arg not in payload:
             response = {'status': StatusCodes['api_error'], 'errors': f'{arg} value not in payload'}
             return flask.jsonify(response), response['status']
-    
+
+    # the team is only checked when a new hospitalization is created
+    if (hospitalization_id and 'hospitalization_team' in payload):
+        response = {'status': StatusCodes['api_error'], 'errors': 'hospitalization_team only applies to a new hospitalization'}
+        return flask.jsonify(response), response['status']
+
     try:
         payload['patient_id'] = int(payload['patient_id'])
     except ValueError:
@@ -653,19 +1360,26 @@ def schedule_surgery(hospitalization_id, user_id, user_type):
         statement += 'SELECT * FROM schedule_surgery(%s, %s, %s, %s, %s, %s, %s)'
         values = (payload['patient_id'], payload['doctor'], nurse_ids, nurse_roles, payload['surgery_start'], payload['surgery_end'], hospitalization_id,)
     else:
-        statement += 'SELECT * FROM schedule_surgery(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'
-        values = (payload['patient_id'], payload['doctor'], nurse_ids, nurse_roles, payload['surgery_start'], payload['surgery_end'], None, payload['hospitalization_entry_time'], payload['hospitalization_exit_time'], payload['hospitalization_responsable_nurse'],)
+        # optionally restrict the responsable nurse to the team under this head nurse
+        if ('hospitalization_team' not in payload):
+            payload['hospitalization_team'] = None
+        statement += 'SELECT * FROM schedule_surgery(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'
+        values = (payload['patient_id'], payload['doctor'], nurse_ids, nurse_roles, payload['surgery_start'], payload['surgery_end'], None, payload['hospitalization_entry_time'], payload['hospitalization_exit_time'], payload['hospitalization_responsable_nurse'], payload['hospitalization_team'],)
 
+    coordinator = None
     try:
-        conn = db_connection()
+        conn = db_connection(shard_for(payload['patient_id']))
         conn.autocommit = False
         cur = conn.cursor()
 
+        # the bookings of the doctor and the nurses on the other shards
+        coordinator = lock_staff([payload['doctor']], nurse_ids, payload['surgery_start'], payload['surgery_end'], shard_for(payload['patient_id']))
         cur.execute(statement, values)
         surgery_id, hospitalization_id, bill_id = cur.fetchone()
 
         # commit the transaction
         conn.commit()
+        stale_report_jobs(surgeries=True)
         response = {'status': StatusCodes['success'], 'results': {
             'surgery_id': surgery_id, 
             'hospitalization_id': hospitalization_id, 
@@ -683,6 +1397,7 @@ def schedule_surgery(hospitalization_id, user_id, user_type):
         conn.rollback()
 
     finally:
+        unlock_staff(coordinator)
         if conn is not None:
             conn.close()
 
@@ -696,12 +1411,16 @@ def schedule_surgery(hospitalization_id, user_id, user_type):
 ##
 ## Only employees and the target patient can use this endpoint
 ##
+## Sends an ETag, a request with If-None-Match and the same ETag gets a 304
+## With ?include=side_effects each medicine comes with its known side effects
+##
 ## To use it, access:
 ##
 ## http://localhost:8080/dbproj/prescriptions/<person_id>
 ##
 @app.route('/dbproj/prescriptions/<person_id>', methods=['GET'])
 @token_required(['assistant', 'nurse', 'doctor', 'patient'])
+@admission_control('read')
 def get_prescriptions(person_id, user_id, user_type):
     logger.info('GET /dbproj/prescriptions/<person_id>')
 
@@ -717,31 +1436,66 @@ def get_prescriptions(person_id, user_id, user_type):
         response = {'status': StatusCodes['api_error'], 'errors': 'Unauthorized'}
         return flask.jsonify(response), response['status']
 
+    try:
+        side_effects = include_side_effects()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'errors': str(error)}
+        return flask.jsonify(response), response['status']
+
     statement = '''
         SELECT p.id, p.validity, md.quantity, md.frequency, md.medicine_name
         FROM prescription AS p
         JOIN medicine_dosage AS md ON md.prescription_id = p.id
-        LEFT JOIN appt_prescriptions AS ap ON ap.id = p.id
-        LEFT JOIN hosp_prescriptions AS hp ON hp.id = p.id
-        WHERE (ap.patient_cc = %s OR hp.patient_cc = %s)
+        WHERE p.id IN (
+            SELECT ap.id FROM appt_prescriptions AS ap WHERE ap.patient_cc = %s
+            UNION ALL
+            SELECT hp.id FROM hosp_prescriptions AS hp WHERE hp.patient_cc = %s
+        )
         AND p.validity >= CURRENT_DATE
-        ORDER BY p.id;
+        ORDER BY p.id
     '''
     value = (person_id, person_id,)
 
+    # the annotated list is built here
+    if (db_json_rendering and not side_effects):
+        statement = f'''
+            SELECT COALESCE(json_agg(json_build_object(
+                'id', p.id,
+                'validity', to_char(p.validity, '{HTTP_DATE_FORMAT}'),
+                'posology', json_build_array(json_build_object('dose', p.quantity, 'frequency', p.frequency, 'medicine', p.medicine_name))
+            ) ORDER BY p.id), '[]')::text
+            FROM ({statement}) AS p
+        '''
+
+    etag = None
     try:
-        conn = db_connection()
+        conn = replica_connection(shard_for(person_id))
         conn.autocommit = False
         cur = conn.cursor()
 
-        cur.execute(statement, value)
-        rows = cur.fetchall()
+        # only prescriptions still valid are listed
+        etag = patient_etag(cur, person_id, 'prescriptions', daily=True)
+        if (side_effects):
+            # the side effects can change without the patient's prescriptions changing
+            effects, version = medicine_index.get()
+            etag += f'-{version}'
+        if (not_modified(etag)):
+            response = flask.Response(status=StatusCodes['not_modified'])
+        elif (db_json_rendering and not side_effects):
+            cur.execute(statement, value)
+            response = json_response(cur.fetchone()[0])
+        else:
+            cur.execute(statement, value)
+            rows = cur.fetchall()
 
-        prescriptions = []
-        for row in rows:
-            prescriptions.append({'id': int(row[0]), 'validity': row[1], 'posology': [{'dose': row[2], 'frequency': row[3], 'medicine': row[4]}]})
+            prescriptions = []
+            for row in rows:
+                posology = {'dose': row[2], 'frequency': row[3], 'medicine': row[4]}
+                if (side_effects):
+                    posology['side_effects'] = effects.get(row[4], [])
+                prescriptions.append({'id': int(row[0]), 'validity': row[1], 'posology': [posology]})
 
-        response = {'status': StatusCodes['success'], 'results': prescriptions}
+            response = {'status': StatusCodes['success'], 'results': prescriptions}
 
         # commit the transaction
         conn.commit()
@@ -757,6 +1511,126 @@ def get_prescriptions(person_id, user_id, user_type):
         if conn is not None:
             conn.close()
 
+    return etag_response(response, etag)
+
+
+##
+## GET
+##
+## Patient dashboard
+##
+## What the patient app shows when it opens, in one request:
+## {"appointments": [...], "prescriptions": [...], "bills": [...]}
+## the upcoming appointments, the prescriptions still valid with their posology and
+## the bills not paid yet with what is left to pay:
+## {"id": ..., "type": "appointment" | "hospitalization", "event_id": ..., "amount": ..., "paid": ..., "remaining": ...}
+## Built by Postgres in one statement, so it costs one connection and one round trip
+##
+## Only assistants and the target patient can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/dashboard/<patient_user_id>
+##
+PATIENT_DASHBOARD_STATEMENT = f'''
+    SELECT json_build_object(
+        'appointments', COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', a.id,
+                'doctor_id', e.emp_num,
+                'doctor_name', e.name,
+                'start_time', to_char(a.start_time, '{HTTP_DATE_FORMAT}')
+            ) ORDER BY a.start_time)
+            FROM appointment AS a
+            JOIN employee AS e ON e.email = a.doctor_email
+            WHERE a.patient_cc = %(patient)s AND a.start_time >= LOCALTIMESTAMP
+        ), '[]'),
+        'prescriptions', COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', p.id,
+                'validity', to_char(p.validity, '{HTTP_DATE_FORMAT}'),
+                'posology', (
+                    SELECT json_agg(json_build_object('dose', md.quantity, 'frequency', md.frequency, 'medicine', md.medicine_name) ORDER BY md.medicine_name)
+                    FROM medicine_dosage AS md
+                    WHERE md.prescription_id = p.id
+                )
+            ) ORDER BY p.id)
+            FROM prescription AS p
+            WHERE p.id IN (
+                SELECT ap.id FROM appt_prescriptions AS ap WHERE ap.patient_cc = %(patient)s
+                UNION ALL
+                SELECT hp.id FROM hosp_prescriptions AS hp WHERE hp.patient_cc = %(patient)s
+            )
+            AND p.validity >= CURRENT_DATE
+        ), '[]'),
+        'bills', COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', b.id,
+                'type', b.type,
+                'event_id', b.event_id,
+                'amount', b.amount,
+                'paid', b.paid,
+                'remaining', b.amount - b.paid
+            ) ORDER BY b.id)
+            FROM (
+                SELECT bill.id, 'appointment' AS type, a.id AS event_id, bill.amount,
+                    (SELECT COALESCE(SUM(p.amount), 0) FROM payment AS p WHERE p.bill_id = bill.id) AS paid
+                FROM appointment AS a
+                JOIN bill ON bill.id = a.bill_id
+                WHERE a.patient_cc = %(patient)s AND NOT bill.paid
+                UNION ALL
+                SELECT bill.id, 'hospitalization', h.id, bill.amount,
+                    (SELECT COALESCE(SUM(p.amount), 0) FROM payment AS p WHERE p.bill_id = bill.id)
+                FROM hospitalization AS h
+                JOIN bill ON bill.id = h.bill_id
+                WHERE h.patient_cc = %(patient)s AND NOT bill.paid
+            ) AS b
+        ), '[]')
+    )::text;
+'''
+
+@app.route('/dbproj/dashboard/<patient_user_id>', methods=['GET'])
+@token_required(['assistant', 'patient'])
+@admission_control('read')
+def get_patient_dashboard(patient_user_id, user_id, user_type):
+    logger.info('GET /dbproj/dashboard/<patient_user_id>')
+
+    logger.debug(f'patient_user_id: {patient_user_id}, token_id: {user_id}, token_type: {user_type}')
+
+    try:
+        patient_user_id = int(patient_user_id)
+    except ValueError:
+        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid patient_user_id'}
+        return flask.jsonify(response), response['status']
+
+    if (user_type == 'patient' and user_id != patient_user_id):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Unauthorized'}
+        return flask.jsonify(response), response['status']
+
+    try:
+        conn = replica_connection(shard_for(patient_user_id))
+        conn.autocommit = False
+        cur = conn.cursor()
+
+        cur.execute(PATIENT_DASHBOARD_STATEMENT, {'patient': patient_user_id})
+        response = json_response(cur.fetchone()[0])
+
+        # commit the transaction
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/dashboard/<patient_user_id> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+        # an error occurred, rollback
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    if (isinstance(response, flask.Response)):
+        return response
     return flask.jsonify(response), response['status']
 
 
@@ -765,14 +1639,34 @@ def get_prescriptions(person_id, user_id, user_type):
 ##
 ## Add Prescription
 ##
+## With ?include=side_effects the result is {"id": ..., "side_effects": {medicine: [...]}}
+## instead of the id, to warn about the side effects of what was prescribed
+##
 ## Only doctors can use this endpoint
 ##
 ## To use it, access:
 ##
 ## http://localhost:8080/dbproj/prescription
 ##
+def prescription_medicines(medicines):
+    # the medicines of a prescription as parallel lists (names, doses, frequencies),
+    # adapted by psycopg2 as arrays and zipped back into medicine_type in SQL
+    if (not isinstance(medicines, list) or not medicines):
+        raise ValueError('medicines must be a non empty list')
+
+    columns = ([], [], [])
+    for medicine in medicines:
+        if (not isinstance(medicine, dict)):
+            raise ValueError('Invalid medicine')
+        for column, field in zip(columns, ['name', 'posology_dose', 'posology_frequency']):
+            if field not in medicine:
+                raise ValueError(f'{field} value not in medicine')
+            column.append(str(medicine[field]))
+    return columns
+
 @app.route('/dbproj/prescription', methods=['POST'])
 @token_required(['doctor'])
+@admission_control('write')
 def add_prescription(user_id, user_type):
     logger.info('POST /dbproj/prescription')
 
@@ -785,30 +1679,42 @@ def add_prescription(user_id, user_type):
             response = {'status': StatusCodes['api_error'], 'results': f'{arg} value not in payload'}
             return flask.jsonify(response), response['status']
 
-    required_med_fields = ['name', 'posology_dose', 'posology_frequency']
-    for medicine in payload['medicines']:
-        for field in required_med_fields:
-            if field not in medicine:
-                response = {'status': StatusCodes['api_error'], 'results': f'{field} value not in medicine'}
-                return flask.jsonify(response), response['status']
+    try:
+        payload['event_id'] = int(payload['event_id'])
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid event_id'}
+        return flask.jsonify(response), response['status']
 
-    medicine_info = ", ".join(
-                    f"({med['name']}, {med['posology_dose']}, {med['posology_frequency']})" for med in payload['medicines']
-                )
-    print(medicine_info)
+    try:
+        names, doses, frequencies = prescription_medicines(payload.get('medicines'))
+        side_effects = include_side_effects()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'errors': str(error)}
+        return flask.jsonify(response), response['status']
 
-    statement = 'SELECT add_prescription(%s, %s, %s, ARRAY[%s]::medicine_type[])'
-    values = (payload['type'], payload['validity'], payload['event_id'], medicine_info,)
+    statement = '''
+        SELECT add_prescription(%s, %s, %s, ARRAY(
+            SELECT ROW(m.name, m.dose, m.freq)::medicine_type
+            FROM UNNEST(%s::varchar[], %s::varchar[], %s::varchar[]) WITH ORDINALITY AS m(name, dose, freq, position)
+            ORDER BY m.position
+        ))
+    '''
+    values = (payload['type'], payload['validity'], payload['event_id'], names, doses, frequencies,)
 
     try:
-        conn = db_connection()
+        # the appointment or hospitalization id tells the shard of the patient
+        conn = db_connection(shard_of(payload['event_id']))
         conn.autocommit = False
         cur = conn.cursor()
         
         cur.execute(statement, values)
         prescription_id = cur.fetchone()[0]
 
-        response = {'status': StatusCodes['success'], 'results': prescription_id}
+        if (side_effects):
+            effects, version = medicine_index.get()
+            response = {'status': StatusCodes['success'], 'results': {'id': prescription_id, 'side_effects': {name: effects.get(name, []) for name in names}}}
+        else:
+            response = {'status': StatusCodes['success'], 'results': prescription_id}
 
         conn.commit()
 
@@ -823,6 +1729,259 @@ def add_prescription(user_id, user_type):
     return flask.jsonify(response), response['status']
 
 
+##
+## POST
+##
+## Add Prescriptions (ward round)
+##
+## {"prescriptions": [{"type": ..., "event_id": ..., "validity": ..., "medicines": [...]}, ...]}
+## with each prescription like POST /dbproj/prescription. All of them are created or
+## none, with one statement per table (add_prescriptions); the ids are returned in
+## the order of the request. With several shards each shard is a transaction of its
+## own (see commit_shards): if a shard fails to commit after
+## others did, the answer is a 500 whose results are the ids with null for the
+## prescriptions that were not created (send those again)
+##
+## Only doctors can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/prescriptions
+##
+PRESCRIPTION_BATCH_MAX = 1000
+
+@app.route('/dbproj/prescriptions', methods=['POST'])
+@token_required(['doctor'])
+@admission_control('write')
+def add_prescriptions(user_id, user_type):
+    logger.info('POST /dbproj/prescriptions')
+
+    payload = flask.request.get_json(silent=True)
+
+    logger.debug(f'POST /dbproj/prescriptions - token_id: {user_id}, token_type: {user_type}')
+
+    prescriptions = payload.get('prescriptions') if isinstance(payload, dict) else None
+    if (not isinstance(prescriptions, list) or not prescriptions or len(prescriptions) > PRESCRIPTION_BATCH_MAX):
+        response = {'status': StatusCodes['api_error'], 'errors': f'prescriptions must be a list of 1 to {PRESCRIPTION_BATCH_MAX} prescriptions'}
+        return flask.jsonify(response), response['status']
+
+    # the parallel arrays of add_prescriptions, per shard
+    batches = {}
+    for index, prescription in enumerate(prescriptions):
+        try:
+            if (not isinstance(prescription, dict)):
+                raise ValueError('Invalid prescription')
+            for arg in ['type', 'event_id', 'validity']:
+                if arg not in prescription:
+                    raise ValueError(f'{arg} value not in prescription')
+            try:
+                event_id = int(prescription['event_id'])
+            except (TypeError, ValueError):
+                raise ValueError('Invalid event_id')
+            names, doses, frequencies = prescription_medicines(prescription.get('medicines'))
+        except ValueError as error:
+            response = {'status': StatusCodes['api_error'], 'errors': f'prescription {index}: {error}'}
+            return flask.jsonify(response), response['status']
+
+        batch = batches.setdefault(shard_of(event_id), {'indexes': [], 'values': ([], [], [], [], [], [], [])})
+        types, validities, event_ids, positions, medicine_names, medicine_doses, medicine_frequencies = batch['values']
+        batch['indexes'].append(index)
+        types.append(prescription['type'])
+        validities.append(prescription['validity'])
+        event_ids.append(event_id)
+        positions.extend([len(types)] * len(names))
+        medicine_names.extend(names)
+        medicine_doses.extend(doses)
+        medicine_frequencies.extend(frequencies)
+
+    statement = '''
+        SELECT created_id
+        FROM add_prescriptions(%s::varchar[], %s::date[], %s::bigint[], %s::integer[], %s::varchar[], %s::varchar[], %s::varchar[])
+    '''
+
+    # one transaction per shard, committed once every shard has succeeded (see commit_shards)
+    connections = {}
+    try:
+        prescription_ids = [None] * len(prescriptions)
+        for shard, batch in batches.items():
+            conn = db_connection(shard)
+            connections[shard] = conn
+            conn.autocommit = False
+            cur = conn.cursor()
+
+            cur.execute(statement, batch['values'])
+            for index, (prescription_id,) in zip(batch['indexes'], cur.fetchall()):
+                prescription_ids[index] = prescription_id
+
+        committed, failed = commit_shards(connections)
+        if (failed):
+            logger.error(f'POST /dbproj/prescriptions - shards {list(failed)} failed to commit after shards {committed}: {failed}')
+            for shard in failed:
+                for index in batches[shard]['indexes']:
+                    prescription_ids[index] = None
+            response = {'status': StatusCodes['internal_error'],
+                        'errors': f'Shards {list(failed)} failed to commit, only the prescriptions with an id were created',
+                        'results': prescription_ids}
+        else:
+            response = {'status': StatusCodes['success'], 'results': prescription_ids}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /dbproj/prescriptions - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+        # an error occurred, rollback
+        for conn in connections.values():
+            conn.rollback()
+
+    finally:
+        for conn in connections.values():
+            conn.close()
+
+    return flask.jsonify(response), response['status']
+
+
+##
+## GET
+##
+## Side effects
+##
+## The known side effects of medicines, with their severity:
+## {"<medicine>": [{"occurrence": ..., "description": ..., "degree": ...}, ...], ...}
+## (an empty list for a medicine without any). Served from an in-process index,
+## so a lookup costs no database round trip
+##
+## Available to every user
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/side_effects?medicine=<name>&medicine=<name>
+##
+# each worker process keeps medicine -> side effects in memory, loaded on first use
+# and again after side_effect or reaction_severity change: their triggers NOTIFY on
+# MEDICINE_INDEX_CHANNEL (object_definition.sql) and a thread LISTENs to it. While it
+# is not listening (starting, connection lost) the index is loaded for every lookup.
+# Side effects are reference data, read from shard 0
+MEDICINE_INDEX_CHANNEL = 'care_sync_side_effects'
+MEDICINE_INDEX_RECONNECT = 3    # seconds before listening again after losing the connection
+SIDE_EFFECTS_MAX_MEDICINES = 100
+
+MEDICINE_INDEX_STATEMENT = '''
+    SELECT rs.medicine_name, se.occurrence, se.description, rs.degree
+    FROM reaction_severity AS rs
+    JOIN side_effect AS se ON se.occurrence = rs.side_effect_occurrence
+    ORDER BY rs.medicine_name, se.occurrence
+'''
+
+class MedicineIndex:
+    def __init__(self, listen=True):
+        self.effects = None     # medicine -> side effects, None until (re)loaded
+        self.version = None     # changes with the contents, the same in every process
+        self.listen = listen
+        self.listening = False
+        self.thread = None
+        self.generation = 0     # bumped by every invalidation
+        self.lock = threading.Lock()
+
+    def get(self):
+        # (effects, version) as of now; the index is loaded without holding the lock,
+        # so a reload does not block the requests of the other threads, and it is only
+        # kept if no invalidation arrived while it was being loaded
+        with self.lock:
+            if (self.listen and self.thread is None):
+                self.thread = threading.Thread(target=self.listener, name='medicine-index', daemon=True)
+                self.thread.start()
+            if (self.effects is not None and self.listening):
+                return self.effects, self.version
+            generation = self.generation
+
+        effects, version = self.load()
+        with self.lock:
+            if (self.generation == generation):
+                self.effects = effects
+                self.version = version
+        return effects, version
+
+    def load(self):
+        conn = db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(MEDICINE_INDEX_STATEMENT)
+            rows = cur.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+
+        effects = {}
+        for medicine_name, occurrence, description, degree in rows:
+            effects.setdefault(medicine_name, []).append({'occurrence': occurrence, 'description': description, 'degree': degree})
+        return effects, format(zlib.crc32(json.dumps(rows).encode()), '08x')
+
+    def invalidate(self, listening):
+        with self.lock:
+            self.effects = None
+            self.listening = listening
+            self.generation += 1
+
+    def listener(self):
+        while True:
+            conn = None
+            try:
+                conn = db_connection()
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f'LISTEN {MEDICINE_INDEX_CHANNEL}')
+                # changes made before LISTEN were not notified
+                self.invalidate(True)
+                while True:
+                    if (select.select([conn], [], [], CHANGE_FEED_HEARTBEAT) == ([], [], [])):
+                        continue
+                    conn.poll()
+                    if (conn.notifies):
+                        conn.notifies.clear()
+                        self.invalidate(True)
+            except psycopg2.Error as error:
+                logger.error(f'medicine index - error: {error}')
+            finally:
+                if conn is not None:
+                    conn.close()
+
+            self.invalidate(False)
+            time.sleep(MEDICINE_INDEX_RECONNECT)
+
+medicine_index = MedicineIndex()
+
+def include_side_effects():
+    # whether the request asks for ?include=side_effects
+    include = flask.request.args.get('include')
+    if (include is not None and include != 'side_effects'):
+        raise ValueError('include must be side_effects')
+    return include is not None
+
+@app.route('/dbproj/side_effects', methods=['GET'])
+@token_required(['assistant', 'nurse', 'doctor', 'patient'])
+@admission_control('read')
+def get_side_effects(user_id, user_type):
+    logger.info('GET /dbproj/side_effects')
+
+    medicines = flask.request.args.getlist('medicine')
+
+    logger.debug(f'medicines: {medicines}, token_id: {user_id}, token_type: {user_type}')
+
+    if (not medicines or len(medicines) > SIDE_EFFECTS_MAX_MEDICINES):
+        response = {'status': StatusCodes['api_error'], 'errors': f'Give 1 to {SIDE_EFFECTS_MAX_MEDICINES} medicine values'}
+        return flask.jsonify(response), response['status']
+
+    try:
+        effects, version = medicine_index.get()
+        response = {'status': StatusCodes['success'], 'results': {medicine: effects.get(medicine, []) for medicine in medicines}}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/side_effects - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return flask.jsonify(response), response['status']
+
+
 ##
 ## POST
 ##
@@ -836,6 +1995,7 @@ def add_prescription(user_id, user_type):
 ##
 @app.route('/dbproj/bills/<bill_id>', methods=['POST'])
 @token_required(['patient'])
+@admission_control('write')
 def execute_payment(bill_id, user_id, user_type):
     logger.info('POST /dbproj/bills/<bill_id>')
     payload = flask.request.get_json()
@@ -863,8 +2023,10 @@ def execute_payment(bill_id, user_id, user_type):
     '''
     values = (bill_id, bill_id, payload['amount'], payload['payment_method'], user_id,)
 
+    ensure_payment_partitions()
+
     try:
-        conn = db_connection()
+        conn = db_connection(shard_of(bill_id))
         conn.autocommit = False
         cur = conn.cursor()
 
@@ -875,6 +2037,7 @@ def execute_payment(bill_id, user_id, user_type):
 
         # commit the transaction
         conn.commit()
+        stale_report_jobs(months=[time.strftime('%Y-%m-01')])
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'POST /dbproj/bills/<bill_id> - error: {error}')
@@ -892,164 +2055,497 @@ def execute_payment(bill_id, user_id, user_type):
 
 
 ##
-## GET
+## POST
 ##
-## List Top 3 patients
+## Import payments
 ##
-## Only assistants can use this endpoint
+## Applies a bank/insurer settlement file in one transaction per shard, the body is either
+## CSV (header line, then bill_id,amount,payment_method) or NDJSON when sent as application/x-ndjson
+## ({"bill_id": ..., "amount": ..., "payment_method": ...} per line)
+## Valid lines are applied, the others are returned with the reason they were rejected
+## (line is the number of the payment in the file, not counting the CSV header)
+## With several shards, if a shard fails to commit after others did, the answer is a 500
+## with {"shards": n, "committed_shards": [...], "failed_shards": {shard: error}, "rejected": [...]}:
+## only the lines of the bills of the committed shards (shard (bill_id - 1) % n, shard 0
+## for a line without a valid bill) were applied, send the others again
 ##
-## To use it, access: 
+## Only assistants can use this endpoint
 ##
-## http://localhost:8080/dbproj/top3
+## To use it, access:
 ##
-@app.route('/dbproj/top3', methods=['GET'])
+## http://localhost:8080/dbproj/bills/import
+##
+class PaymentRows:
+    # file-like object read by COPY, turns each line of the body into a CSV row with exactly
+    # the three staging columns; a line that cannot be parsed becomes an empty row, which
+    # import_payments rejects as an invalid line instead of the whole COPY failing;
+    # parse turns a line of the body into [bill_id, amount, payment_method]
+    def __init__(self, stream, parse, header=False):
+        self.stream = stream
+        self.parse = parse
+        self.header = header
+        self.buffer = ''
+        self.pending = self.rows()
+
+    def rows(self):
+        while True:
+            line = self.stream.readline()
+            if not line:
+                return
+            if (self.header):
+                self.header = False
+                continue
+            if not line.strip():
+                continue
+
+            try:
+                row = self.parse(line)
+            except (ValueError, AttributeError, csv.Error):
+                row = [None, None, None]
+            yield row
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size):
+            row = next(self.pending, None)
+            if row is None:
+                break
+
+            out = io.StringIO()
+            csv.writer(out).writerow(row)
+            self.buffer += out.getvalue()
+
+        if (size < 0):
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def parse_ndjson_payment(line):
+    payment = json.loads(line)
+    return [payment.get('bill_id'), payment.get('amount'), payment.get('payment_method')]
+
+def parse_csv_payment(line):
+    # one line at a time, a stray quote cannot swallow the lines after it
+    fields = next(csv.reader([line.decode('utf-8')], strict=True))
+    if (len(fields) != 3):
+        raise ValueError('expected bill_id, amount and payment_method')
+    return fields
+
+
+PAYMENT_SPOOL_SIZE = 1024 * 1024 # bytes of a shard's rows kept in memory before spilling to disk
+
+def split_payment_rows(source):
+    # with several shards: the rows of each shard, numbered like the file, in a spooled
+    # file per shard (a line without a valid bill goes to shard 0, which rejects it)
+    parts = [tempfile.SpooledTemporaryFile(PAYMENT_SPOOL_SIZE, mode='w+', newline='') for _ in shards]
+    writers = [csv.writer(part) for part in parts]
+    for line, row in enumerate(source.rows(), 1):
+        try:
+            shard = shard_of(row[0])
+        except (TypeError, ValueError):
+            shard = 0
+        writers[shard].writerow([line] + row)
+
+    for part in parts:
+        part.seek(0)
+    return parts
+
+
+@app.route('/dbproj/bills/import', methods=['POST'])
 @token_required(['assistant'])
-def get_top3(user_id, user_type):
-    logger.info('GET /dbproj/top3')
-
-    conn = db_connection()
-    conn.autocommit = False
-    cur = conn.cursor()
-    statement = ''' 
-        SELECT DISTINCT ON (payment.bill_id)
-            patient.name AS patient_name,
-            tp.patient_id AS patient_id,
-            tp.total_amount AS total_amount,
-
-            appointment.id AS appointment_id,
-            appointment.start_time AS appointment_start,
-            appointment_doctor.name AS doctor_name,
-            appointment_doctor.email AS doctor_id,
-
-            NULL AS surgery_id,
-            NULL AS surgery_start,
-            NULL AS surgery_doctor,
-            NULL AS surgery_doctor_id
-        FROM 
-            top_patients tp
-            JOIN patient ON tp.patient_id = patient.cc
-            LEFT JOIN appointment ON patient.cc = appointment.patient_cc
-            LEFT JOIN payment ON appointment.bill_id = payment.bill_id
-            LEFT JOIN employee appointment_doctor ON appointment_doctor.email = appointment.doctor_email
-        WHERE
-            EXTRACT(MONTH FROM payment.date_time) = EXTRACT(MONTH FROM CURRENT_DATE)
-            AND EXTRACT(YEAR FROM payment.date_time) = EXTRACT(YEAR FROM CURRENT_DATE)
-
-        UNION 
-
-        SELECT DISTINCT ON (payment.bill_id)
-            patient.name AS patient_name,
-            tp.patient_id AS patient_id,
-            tp.total_amount AS total_amount,
-
-            NULL AS appointment_id,
-            NULL AS appointment_start,
-            NULL AS doctor_name,
-            NULL AS doctor_id,
-
-            surgery.id AS surgery_id,
-            surgery.start_time AS surgery_start,
-            surgery_doctor.name AS surgery_doctor,
-            surgery_doctor.email AS surgery_doctor_id
-        FROM 
-            top_patients tp
-            JOIN patient ON tp.patient_id = patient.cc
-            LEFT JOIN hospitalization ON patient.cc = hospitalization.patient_cc
-            LEFT JOIN surgery ON hospitalization.id = surgery.hospitalization_id
-            LEFT JOIN payment ON hospitalization.bill_id = payment.bill_id
-            LEFT JOIN employee surgery_doctor ON surgery_doctor.email = surgery.doctor_email
-        WHERE
-            EXTRACT(MONTH FROM payment.date_time) = EXTRACT(MONTH FROM CURRENT_DATE)
-            AND EXTRACT(YEAR FROM payment.date_time) = EXTRACT(YEAR FROM CURRENT_DATE)
-
-        ORDER BY 
-            total_amount DESC, patient_id;
-        '''
+@admission_control('write')
+def import_payments(user_id, user_type):
+    logger.info('POST /dbproj/bills/import')
+
+    logger.debug(f'POST /dbproj/bills/import - content_type: {flask.request.mimetype}, token_id: {user_id}, token_type: {user_type}')
+
+    # the body is streamed into the staging table, it is never loaded whole
+    if (flask.request.mimetype == 'application/x-ndjson'):
+        source = PaymentRows(flask.request.stream, parse_ndjson_payment)
+    else:
+        source = PaymentRows(flask.request.stream, parse_csv_payment, header=True)
+    copy_statement = 'COPY payment_staging(bill_id, amount, method) FROM STDIN WITH (FORMAT csv)'
+    sources = [source]
+
+    # with several shards each shard applies the lines of its bills, in a transaction
+    # of its own, and the transactions are committed once every shard has staged its
+    # lines (see commit_shards)
+    if (len(shards) > 1):
+        copy_statement = 'COPY payment_staging(line, bill_id, amount, method) FROM STDIN WITH (FORMAT csv)'
+        sources = split_payment_rows(source)
 
+    ensure_payment_partitions()
 
+    connections = {}
     try:
-        cur.execute(statement)
-        rows = cur.fetchall()
-        logger.debug('GET /dbproj/top3 - parse')
-        i = 0
-        result = [] 
-        appointment_idx = 3
-        surgery_idx = 7
-        while i < len(rows):
-            client = rows[i][0]
-            client_id = rows[i][1]
-            total_amount = rows[i][2]
-            result.append({'client': client, 'cc': client_id, 'total_amount': total_amount, 'procedures': []})
-            while i < len(rows) and rows[i][0] == client:
-                if rows[i][appointment_idx]:
-                    result[-1]['procedures'].append({'type': 'appointment', 'id': rows[i][appointment_idx], 'start_time': rows[i][appointment_idx + 1], 'doctor_name': rows[i][appointment_idx + 2], 'doctor_email': rows[i][appointment_idx + 3]})
-                    i += 1
-                    continue
-                if rows[i][surgery_idx]:
-                    result[-1]['procedures'].append({'type': 'surgery', 'id': rows[i][surgery_idx], 'start_time': rows[i][surgery_idx + 1], 'doctor_name': rows[i][surgery_idx + 2], 'doctor_email': rows[i][surgery_idx + 3]})
-                    i += 1
-        for i in range(len(result)):
-            if result[i]['total_amount'] == 0:
-                result.pop(i)
+        staged = 0
+        rejected = {}
+        for shard, shard_source in enumerate(sources):
+            conn = db_connection(shard)
+            connections[shard] = conn
+            conn.autocommit = False
+            cur = conn.cursor()
+
+            cur.execute('''
+                CREATE TEMP TABLE payment_staging (
+                    line BIGINT GENERATED BY DEFAULT AS IDENTITY,
+                    bill_id TEXT,
+                    amount TEXT,
+                    method TEXT
+                ) ON COMMIT DROP
+            ''')
+            cur.copy_expert(copy_statement, shard_source)
+            staged += cur.rowcount
+
+            cur.execute('SELECT * FROM import_payments()')
+            rows = cur.fetchall()
+
+            rejected[shard] = [{'line': row[0], 'errors': row[1]} for row in rows]
+
+        # commit the transaction
+        committed, failed = commit_shards(connections)
+        stale_report_jobs(months=[time.strftime('%Y-%m-01')])
+        rejected = sorted([rejection for shard in committed for rejection in rejected[shard]], key=lambda rejection: rejection['line'])
+        if (failed):
+            logger.error(f'POST /dbproj/bills/import - shards {list(failed)} failed to commit after shards {committed}: {failed}')
+            response = {'status': StatusCodes['internal_error'],
+                        'errors': f'Shards {list(failed)} failed to commit, only the lines of the bills of shards {committed} were applied',
+                        'results': {'shards': len(shards), 'committed_shards': committed, 'failed_shards': failed, 'rejected': rejected}}
+        else:
+            response = {'status': StatusCodes['success'], 'results': {'applied': staged - len(rejected), 'rejected': rejected}}
 
     except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'GET /departments/<ndep> - error: {error}')
-        result = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        logger.error(f'POST /dbproj/bills/import - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+        # an error occurred, rollback
+        for conn in connections.values():
+            conn.rollback()
 
     finally:
-        if conn is not None:
+        for conn in connections.values():
             conn.close()
-        if result == []:
-            result ={'status': StatusCodes['success'], 'results': 'No data found'}
-    return flask.jsonify(result)
+        for shard_source in sources:
+            if (shard_source is not source):
+                shard_source.close()
+
+    return flask.jsonify(response), response['status']
 
 
 
 ##
 ## GET
 ##
-## Daily Summary
+## Export payments or bills
+##
+## CSV of the payments made (payments) or of the bills of the appointments and
+## hospitalizations (bills) between two days, both included, with the patient of
+## each. Postgres writes the CSV (COPY ... TO STDOUT) and it is sent as it comes, in
+## chunks, gzip compressed when the client accepts it, so the API never holds the
+## whole export; a client that reads slowly slows the COPY down instead
 ##
 ## Only assistants can use this endpoint
 ##
 ## To use it, access:
 ##
-## http://localhost:8080/dbproj/daily/<year-month-day>
-##
-@app.route('/dbproj/daily/<date>', methods=['GET'])
-@token_required(['assistant'])
-def daily_summary(date, user_id, user_type):
-    logger.info(f'GET /dbproj/daily/<date>')
-
-    logger.debug(f'GET /dbproj/daily/{date} - token_id: {user_id}, token_type: {user_type}')
-
-    statement = '''
-        SELECT
-            COALESCE(SUM(hms.total_amount_spent), 0) AS amount_spent,
-            COALESCE(SUM(hc.surgery_count), 0) AS surgeries,
-            COALESCE(SUM(hc.prescription_count), 0) AS prescriptions
-        FROM hospitalization AS h
-        LEFT JOIN hospitalization_counts AS hc ON h.id = hc.id
-        LEFT JOIN hospitalization_money_spent AS hms ON h.id = hms.id
-        WHERE h.entry_time::date = %s;
+## http://localhost:8080/dbproj/export/payments?from=<year-month-day>&to=<year-month-day>
+## OR
+## http://localhost:8080/dbproj/export/bills?from=<year-month-day>&to=<year-month-day>
+##
+EXPORT_CHUNK = 64 * 1024    # bytes per chunk sent
+EXPORT_QUEUE = 16           # chunks buffered between the COPY and the client
+EXPORT_STATEMENTS = {
+    'payments': '''
+        SELECT pay.id AS payment_id, pay.date_time, pay.amount, pay.method, pay.bill_id,
+            pp.patient_cc, (SELECT p.name FROM patient AS p WHERE p.cc = pp.patient_cc) AS patient_name
+        FROM payment AS pay
+        -- lookups by key per payment, like the top patients
+        CROSS JOIN LATERAL (
+            SELECT COALESCE(
+                (SELECT a.patient_cc FROM appointment AS a WHERE a.bill_id = pay.bill_id),
+                (SELECT h.patient_cc FROM hospitalization AS h WHERE h.bill_id = pay.bill_id)
+            ) AS patient_cc
+        ) AS pp
+        WHERE pay.date_time >= %(from)s::date AND pay.date_time < %(to)s::date + 1
+        ORDER BY pay.date_time, pay.id
+    ''',
+    'bills': '''
+        WITH events AS (
+            SELECT 'appointment' AS type, a.id, a.start_time AS event_time, a.bill_id, a.patient_cc
+            FROM appointment AS a
+            WHERE a.start_time >= %(from)s::date AND a.start_time < %(to)s::date + 1
+            UNION ALL
+            SELECT 'hospitalization', h.id, h.entry_time, h.bill_id, h.patient_cc
+            FROM hospitalization AS h
+            WHERE h.entry_time >= %(from)s::date AND h.entry_time < %(to)s::date + 1
+        )
+        -- lookups by key per bill, whatever the size of the history
+        SELECT b.id AS bill_id, e.type AS event_type, e.id AS event_id, e.event_time,
+            e.patient_cc, (SELECT p.name FROM patient AS p WHERE p.cc = e.patient_cc) AS patient_name, b.amount,
+            (SELECT COALESCE(SUM(pay.amount), 0) FROM payment AS pay WHERE pay.bill_id = b.id) AS paid_amount, b.paid
+        FROM events AS e
+        JOIN bill AS b ON b.id = e.bill_id
+        ORDER BY e.event_time, b.id
     '''
-    values = (date,)
+}
 
+class CopyStream:
+    # file-like object COPY writes to, from its own thread, while the response
+    # takes the chunks from a bounded queue; closing it stops the COPY
+    def __init__(self):
+        self.chunks = queue.Queue(EXPORT_QUEUE)
+        self.buffer = []
+        self.size = 0
+        self.closed = threading.Event()
+
+    def put(self, item):
+        while True:
+            if (self.closed.is_set()):
+                raise IOError('export cancelled')
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if (self.size >= EXPORT_CHUNK):
+            self.flush()
+
+    def flush(self):
+        if (self.buffer):
+            self.put(b''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def finish(self, error=None):
+        # the end of the export: None when it is complete, else the error
+        self.flush()
+        self.put(error)
+
+def export_copy(stream, kind, values):
+    # runs in its own thread: the export of every shard, one after the other
     try:
-        conn = db_connection()
+        for shard in range(len(shards)):
+            conn = replica_connection(shard)
+            try:
+                cur = conn.cursor()
+                header = 'true' if shard == 0 else 'false'
+                statement = cur.mogrify(EXPORT_STATEMENTS[kind], values).decode()
+                cur.copy_expert(f'COPY ({statement}) TO STDOUT WITH (FORMAT csv, HEADER {header})', stream)
+                conn.commit()
+            finally:
+                conn.close()
+        stream.finish()
+    except (Exception, psycopg2.DatabaseError) as error:
+        if (not stream.closed.is_set()):
+            logger.error(f'GET /dbproj/export/{kind} - error: {error}')
+            stream.finish(error)
+
+@app.route('/dbproj/export/<kind>', methods=['GET'])
+@token_required(['assistant'])
+def export_csv(kind, user_id, user_type):
+    logger.info(f'GET /dbproj/export/{kind}')
+
+    logger.debug(f'args: {flask.request.args}, token_id: {user_id}, token_type: {user_type}')
+
+    if (kind not in EXPORT_STATEMENTS):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Export payments or bills'}
+        return flask.jsonify(response), response['status']
+
+    values = {'from': flask.request.args.get('from'), 'to': flask.request.args.get('to')}
+    try:
+        if (time.strptime(values['from'], '%Y-%m-%d') > time.strptime(values['to'], '%Y-%m-%d')):
+            raise ValueError
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid from or to, expected year-month-day with from not after to'}
+        return flask.jsonify(response), response['status']
+
+    # the slot (and the connection) is held until the export is sent, not until this
+    # function returns, so admission_control cannot be used
+    if (not admission.acquire('analytics')):
+        logger.warning(f'GET /dbproj/export/{kind} - shed (analytics queue full)')
+        response = {'status': StatusCodes['unavailable'], 'errors': 'Server busy, try again later'}
+        return flask.jsonify(response), response['status'], {'Retry-After': str(ADMISSION_RETRY_AFTER)}
+
+    stream = CopyStream()
+    compress = 'gzip' in flask.request.accept_encodings
+    threading.Thread(target=export_copy, args=(stream, kind, values), name='export', daemon=True).start()
+
+    released = threading.Lock()
+
+    def close():
+        # at the end of the export or when the server closes the response, whichever comes first
+        stream.closed.set()
+        if (released.acquire(blocking=False)):
+            admission.release('analytics')
+
+    def chunks():
+        compressor = zlib.compressobj(wbits=31) if compress else None # gzip
+        try:
+            while True:
+                chunk = stream.chunks.get()
+                if (isinstance(chunk, Exception)):
+                    # too late for an error status: end the response without its last
+                    # chunk, the client sees an incomplete transfer
+                    raise chunk
+                if (chunk is None):
+                    break
+                if (compress):
+                    chunk = compressor.compress(chunk)
+                # an empty chunk would end a chunked response
+                if (chunk):
+                    yield chunk
+            if (compress):
+                yield compressor.flush()
+        finally:
+            close()
+
+    headers = {'Content-Disposition': f'attachment; filename="{kind}_{values["from"]}_{values["to"]}.csv"', 'X-Accel-Buffering': 'no'}
+    if (compress):
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    response = flask.Response(chunks(), mimetype='text/csv', headers=headers)
+    response.call_on_close(close)
+    return response
+
+
+##
+## GET
+##
+## List Top N patients
+##
+## Patients who spent the most in a month, ranked with ties (a tie at rank N returns every tied patient)
+## The month defaults to the current one
+##
+## Only assistants can use this endpoint
+##
+## To use it, access: 
+##
+## http://localhost:8080/dbproj/top3
+## OR
+## http://localhost:8080/dbproj/top/<n>?month=<year-month>
+##
+TOP_PATIENTS_MAX = 100
+
+# ranking and the per-patient procedure list are computed in Postgres,
+# only the procedures of the ranked patients are looked up
+TOP_PATIENTS_STATEMENT = f'''
+    WITH month_payments AS (
+        -- one index lookup per payment of the month, whatever the size of the history
+        SELECT COALESCE(
+                (SELECT a.patient_cc FROM appointment AS a WHERE a.bill_id = pay.bill_id),
+                (SELECT h.patient_cc FROM hospitalization AS h WHERE h.bill_id = pay.bill_id)
+            ) AS patient_cc, pay.bill_id, pay.amount
+        FROM payment AS pay
+        WHERE pay.date_time >= %(month)s::date AND pay.date_time < %(month)s::date + INTERVAL '1 month'
+    ),
+    ranked AS (
+        SELECT patient_cc, SUM(amount) AS total_amount, RANK() OVER (ORDER BY SUM(amount) DESC) AS rank
+        FROM month_payments
+        GROUP BY patient_cc
+    ),
+    top_n AS (
+        SELECT patient_cc, total_amount, rank
+        FROM ranked
+        WHERE rank <= %(n)s
+    ),
+    procedures AS (
+        SELECT t.patient_cc, 'appointment' AS type, a.id, a.start_time, e.name AS doctor_name, e.email AS doctor_email
+        FROM top_n AS t
+        JOIN appointment AS a ON a.patient_cc = t.patient_cc
+        JOIN employee AS e ON e.email = a.doctor_email
+        WHERE a.bill_id IN (SELECT bill_id FROM month_payments)
+        UNION ALL
+        SELECT t.patient_cc, 'surgery', s.id, s.start_time, e.name, e.email
+        FROM top_n AS t
+        JOIN hospitalization AS h ON h.patient_cc = t.patient_cc
+        JOIN surgery AS s ON s.hospitalization_id = h.id
+        JOIN employee AS e ON e.email = s.doctor_email
+        WHERE h.bill_id IN (SELECT bill_id FROM month_payments)
+    )
+    SELECT t.rank, (SELECT p.name FROM patient AS p WHERE p.cc = t.patient_cc), t.patient_cc, t.total_amount, COALESCE((
+            SELECT json_agg(json_build_object(
+                'type', pr.type,
+                'id', pr.id,
+                'start_time', to_char(pr.start_time, '{HTTP_DATE_FORMAT}'),
+                'doctor_name', pr.doctor_name,
+                'doctor_email', pr.doctor_email
+            ) ORDER BY pr.start_time)
+            FROM procedures AS pr
+            WHERE pr.patient_cc = t.patient_cc
+        ), '[]') AS procedures
+    FROM top_n AS t
+    ORDER BY t.rank, t.patient_cc
+'''
+
+TOP_PATIENTS_JSON_STATEMENT = f'''
+    SELECT COALESCE(json_agg(json_build_object(
+        'rank', t.rank,
+        'client', t.name,
+        'cc', t.patient_cc,
+        'total_amount', t.total_amount,
+        'procedures', t.procedures
+    ) ORDER BY t.rank, t.patient_cc), '[]')::text
+    FROM ({TOP_PATIENTS_STATEMENT}) AS t
+'''
+
+@app.route('/dbproj/top3', methods=['GET'])
+@app.route('/dbproj/top/<int:n>', methods=['GET'])
+@token_required(['assistant'])
+@admission_control('analytics')
+def get_top_patients(user_id, user_type, n=3):
+    logger.info(f'GET /dbproj/top/{n}')
+
+    logger.debug(f'n: {n}, args: {flask.request.args}, token_id: {user_id}, token_type: {user_type}')
+
+    if (n < 1 or n > TOP_PATIENTS_MAX):
+        response = {'status': StatusCodes['api_error'], 'errors': f'n must be between 1 and {TOP_PATIENTS_MAX}'}
+        return flask.jsonify(response), response['status']
+
+    month = flask.request.args.get('month', time.strftime('%Y-%m'))
+    try:
+        time.strptime(month, '%Y-%m')
+    except ValueError:
+        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid month, expected year-month'}
+        return flask.jsonify(response), response['status']
+
+    values = {'month': f'{month}-01', 'n': n}
+
+    if (len(shards) > 1):
+        try:
+            response = {'status': StatusCodes['success'], 'results': gather_top_patients(values)}
+        except psycopg2.Error as error:
+            logger.error(f'GET /dbproj/top/{n} - error: {error}')
+            response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return flask.jsonify(response), response['status']
+
+    try:
+        conn = replica_connection()
         conn.autocommit = False
         cur = conn.cursor()
 
-        cur.execute(statement, values)
-        amount_spent, surgeries, prescriptions = cur.fetchone()
+        if (db_json_rendering):
+            cur.execute(TOP_PATIENTS_JSON_STATEMENT, values)
+            response = json_response(cur.fetchone()[0])
+        else:
+            cur.execute(TOP_PATIENTS_STATEMENT, values)
+            rows = cur.fetchall()
+
+            results = []
+            for row in rows:
+                results.append({'rank': row[0], 'client': row[1], 'cc': row[2], 'total_amount': row[3], 'procedures': row[4]})
 
-        response = {'status': StatusCodes['success'], 'results': {'amount_spent': amount_spent, 'surgeries': surgeries, 'prescriptions': prescriptions}}
+            response = {'status': StatusCodes['success'], 'results': results}
 
         # commit the transaction
         conn.commit()
 
     except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'POST /dbproj/daily/<date> - error: {error}')
+        logger.error(f'GET /dbproj/top/{n} - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
         # an error occurred, rollback
@@ -1057,7 +2553,121 @@ def daily_summary(date, user_id, user_type):
 
     finally:
         if conn is not None:
-            conn.close()        
+            conn.close()
+
+    if (isinstance(response, flask.Response)):
+        return response
+    return flask.jsonify(response), response['status']
+
+
+
+##
+## GET
+##
+## Daily Summary
+##
+## Amount spent (payments of the bills), surgeries and prescriptions of the
+## hospitalizations that started on a day, or of every day of a range, both included:
+## [{"day": "<year-month-day>", "amount_spent": ..., "surgeries": ..., "prescriptions": ...}, ...]
+## with the days without hospitalizations as zeros. One grouped statement over the
+## hospitalizations of the range (each one looked up by index), so a year costs about
+## what a day does
+##
+## Only assistants can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/daily/<year-month-day>
+## OR
+## http://localhost:8080/dbproj/daily?from=<year-month-day>&to=<year-month-day>
+##
+DAILY_MAX_DAYS = 366
+
+DAILY_SUMMARY_STATEMENT = '''
+    SELECT
+        to_char(d.day, 'YYYY-MM-DD'),
+        COALESCE(SUM(h.amount_spent), 0)::bigint,
+        COALESCE(SUM(h.surgeries), 0)::bigint,
+        COALESCE(SUM(h.prescriptions), 0)::bigint
+    FROM generate_series(%(from)s::date, %(to)s::date, INTERVAL '1 day') AS d(day)
+    LEFT JOIN (
+        SELECT
+            h.entry_time::date AS day,
+            (SELECT SUM(p.amount) FROM payment AS p WHERE p.bill_id = h.bill_id) AS amount_spent,
+            (SELECT COUNT(*) FROM surgery AS s WHERE s.hospitalization_id = h.id) AS surgeries,
+            (SELECT COUNT(*) FROM hospitalization_prescription AS hp WHERE hp.hospitalization_id = h.id) AS prescriptions
+        FROM hospitalization AS h
+        WHERE h.entry_time >= %(from)s::date AND h.entry_time < %(to)s::date + 1
+    ) AS h ON h.day = d.day
+    GROUP BY d.day
+    ORDER BY d.day;
+'''
+
+def daily_series(first, last):
+    # every shard returns the same days, in order
+    series = None
+    for rows in scatter(DAILY_SUMMARY_STATEMENT, {'from': first, 'to': last}):
+        if (series is None):
+            series = [list(row) for row in rows]
+            continue
+        for day, row in zip(series, rows):
+            for column in range(1, len(row)):
+                day[column] += row[column]
+    return [{'day': day, 'amount_spent': amount_spent, 'surgeries': surgeries, 'prescriptions': prescriptions}
+            for day, amount_spent, surgeries, prescriptions in series]
+
+@app.route('/dbproj/daily/<date>', methods=['GET'])
+@token_required(['assistant'])
+@admission_control('analytics')
+def daily_summary(date, user_id, user_type):
+    logger.info(f'GET /dbproj/daily/<date>')
+
+    logger.debug(f'GET /dbproj/daily/{date} - token_id: {user_id}, token_type: {user_type}')
+
+    try:
+        date = datetime.date.fromisoformat(date)
+    except ValueError:
+        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid date'}
+        return flask.jsonify(response), response['status']
+
+    try:
+        (day,) = daily_series(date, date)
+        del day['day']
+        response = {'status': StatusCodes['success'], 'results': day}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/daily/<date> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return flask.jsonify(response), response['status']
+
+
+@app.route('/dbproj/daily', methods=['GET'])
+@token_required(['assistant'])
+@admission_control('analytics')
+def daily_summary_series(user_id, user_type):
+    logger.info('GET /dbproj/daily')
+
+    logger.debug(f'args: {flask.request.args}, token_id: {user_id}, token_type: {user_type}')
+
+    args = flask.request.args
+    try:
+        first = datetime.date.fromisoformat(args['from'])
+        last = datetime.date.fromisoformat(args['to'])
+    except (KeyError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Give from and to (year-month-day)'}
+        return flask.jsonify(response), response['status']
+
+    if (first > last or (last - first).days + 1 > DAILY_MAX_DAYS):
+        response = {'status': StatusCodes['api_error'], 'errors': f'from must not be after to, and the series at most {DAILY_MAX_DAYS} days'}
+        return flask.jsonify(response), response['status']
+
+    try:
+        response = {'status': StatusCodes['success'], 'results': daily_series(first, last)}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/daily - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
     return flask.jsonify(response), response['status']
 
@@ -1073,8 +2683,24 @@ def daily_summary(date, user_id, user_type):
 ##
 ## http://localhost:8080/dbproj/report
 ##
+# the report rendered by Postgres: doctors tied for a month are joined like the Python path does
+REPORT_JSON_STATEMENT = '''
+    SELECT COALESCE(json_agg(json_build_object('month', r.surgery_month, 'doctor_name', r.doctor_name, 'surgeries', r.surgery_count) ORDER BY r.surgery_month), '[]')::text
+    FROM (
+        SELECT dms.surgery_month, string_agg(e.name, ', ') AS doctor_name, dms.surgery_count
+        FROM doctor_monthly_surgeries AS dms
+        JOIN max_monthly_surgery_count AS month_maxs
+            ON dms.surgery_month = month_maxs.surgery_month
+            AND dms.surgery_count = month_maxs.max_surgery_count
+        JOIN employee AS e
+            ON dms.doctor_email = e.email
+        GROUP BY dms.surgery_month, dms.surgery_count
+    ) AS r
+'''
+
 @app.route('/dbproj/report', methods=['GET'])
 @token_required(['assistant'])
+@admission_control('analytics')
 def generate_monthly_report(user_id, user_type):
     logger.info('GET /dbproj/report')
 
@@ -1091,30 +2717,592 @@ def generate_monthly_report(user_id, user_type):
         ORDER BY dms.surgery_month;
     '''
 
+    if (db_json_rendering):
+        statement = REPORT_JSON_STATEMENT
+
+    if (len(shards) > 1):
+        try:
+            response = {'status': StatusCodes['success'], 'results': gather_monthly_report()}
+        except psycopg2.Error as error:
+            logger.error(f'GET /dbproj/report - error: {error}')
+            response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return flask.jsonify(response), response['status']
+
     try:
-        conn = db_connection()
+        conn = replica_connection()
         conn.autocommit = False
         cur = conn.cursor()
 
         cur.execute(statement)
-        rows = cur.fetchall()
+
+        if (db_json_rendering):
+            response = json_response(cur.fetchone()[0])
+        else:
+            rows = cur.fetchall()
+
+            results = []
+            last_month = None
+            for row in rows:
+                if (last_month != row[0]):
+                    results.append({'month': row[0], 'doctor_name': row[1], 'surgeries': row[2]})
+                else:
+                    results[-1]['doctor_name'] += ', ' + row[1]
+                last_month = row[0]
+
+            response = {'status': StatusCodes['success'], 'results': results}
+
+        # commit the transaction
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/report - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+        # an error occurred, rollback
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    if (isinstance(response, flask.Response)):
+        return response
+    return flask.jsonify(response), response['status']
+
+
+##
+## Cross-shard reports
+##
+## With several shards the top patients and the monthly report are computed on every
+## shard and merged here (a patient, with all their bills and surgeries, is on one shard)
+##
+def gather_top_patients(values):
+    # a patient in the top n of all shards is in the top n of their shard
+    rows = [row for shard_rows in scatter(TOP_PATIENTS_STATEMENT, values) for row in shard_rows]
+    rows.sort(key=lambda row: (-row[3], row[2]))
+
+    results = []
+    for position, row in enumerate(rows):
+        rank = results[-1]['rank'] if (results and results[-1]['total_amount'] == row[3]) else position + 1
+        if (rank > values['n']):
+            break
+        results.append({'rank': rank, 'client': row[1], 'cc': row[2], 'total_amount': row[3], 'procedures': row[4]})
+
+    return results
+
+def gather_monthly_report():
+    counts = {} # (month, doctor) -> surgeries on every shard
+    for shard_rows in scatter('SELECT surgery_month, doctor_email, surgery_count FROM doctor_monthly_surgeries'):
+        for month, doctor, surgery_count in shard_rows:
+            counts[(month, doctor)] = counts.get((month, doctor), 0) + surgery_count
+
+    month_maxs = {}
+    for (month, doctor), surgery_count in counts.items():
+        month_maxs[month] = max(month_maxs.get(month, 0), surgery_count)
+    top_doctors = sorted((month, doctor) for (month, doctor), surgery_count in counts.items() if surgery_count == month_maxs[month])
+
+    # employees are on every shard
+    conn = replica_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT email, name FROM employee WHERE email = ANY(%s)', (list({doctor for _, doctor in top_doctors}),))
+        names = dict(cur.fetchall())
+        conn.commit()
+    finally:
+        conn.close()
+
+    results = []
+    for month, doctor in top_doctors:
+        if (results and results[-1]['month'] == month):
+            results[-1]['doctor_name'] += ', ' + names[doctor]
+        else:
+            results.append({'month': month, 'doctor_name': names[doctor], 'surgeries': month_maxs[month]})
+
+    return results
+
+REPORT_JOB_GATHER = {
+    'report': lambda params: gather_monthly_report(),
+    'top': gather_top_patients
+}
+
+# report_job lives on shard 0, whose triggers only see the surgeries and payments of
+# shard 0: with several shards the writers mark the jobs stale themselves
+def stale_report_jobs(surgeries=False, months=()):
+    if (len(shards) == 1):
+        return
+
+    conn = None
+    try:
+        conn = db_connection()
+        # bookkeeping after the commit of the request, which must not fail it
+        conn.deadline = None
+        cur = conn.cursor()
+        if (surgeries):
+            cur.execute("UPDATE report_job SET stale = TRUE WHERE kind IN ('report', 'top') AND NOT stale")
+        if (months):
+            cur.execute("UPDATE report_job SET stale = TRUE WHERE kind = 'top' AND NOT stale AND (params->>'month')::date = ANY(%s::date[])", (list(months),))
+        conn.commit()
+    except psycopg2.Error as error:
+        logger.warning(f'could not mark the report jobs stale: {error}')
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+##
+## Report jobs
+##
+## Reports computed by a pool of REPORT_JOB_WORKERS threads per worker process
+## instead of inside the request. Jobs live in report_job: a submission identical to
+## a current job (queued, running or done and not stale) gets that job instead of a
+## new computation, and a done job keeps its result until the triggers of
+## object_definition.sql mark it stale. Each job thread holds one connection while it
+## runs, outside the admission slots, so count them in the connection budget
+##
+REPORT_JOB_WORKERS = 2
+REPORT_JOB_TIMEOUT = 600        # seconds after which a job still queued or running is abandoned
+REPORT_JOB_RETENTION = '1 day'  # stale and failed jobs are deleted after this
+REPORT_JOB_MAX_WAIT = 30        # longest ?wait= of a poll
+
+REPORT_JOB_STATEMENTS = {
+    'report': REPORT_JSON_STATEMENT,
+    'top': TOP_PATIENTS_JSON_STATEMENT
+}
+
+REPORT_JOB_JSON_STATEMENT = '''
+    SELECT json_build_object(
+        'id', id,
+        'type', kind,
+        'params', params,
+        'state', status,
+        'stale', stale,
+        'submitted_at', submitted_at,
+        'finished_at', finished_at,
+        'result', result,
+        'error', error
+    )::text
+    FROM report_job
+    WHERE id = %s
+'''
+
+report_job_executor = concurrent.futures.ThreadPoolExecutor(credentials.get('report_job_workers', REPORT_JOB_WORKERS), thread_name_prefix='report-job')
+report_jobs_running = {} # job id -> threading.Event set when the job of this process ends
+report_jobs_lock = threading.Lock()
+
+def report_job_params(payload):
+    # normalised, so identical requests have identical params
+    if (payload.get('type') == 'report'):
+        return 'report', {}
+
+    if (payload.get('type') == 'top'):
+        n = payload.get('n', 3)
+        if (not isinstance(n, int) or isinstance(n, bool) or n < 1 or n > TOP_PATIENTS_MAX):
+            raise ValueError(f'n must be between 1 and {TOP_PATIENTS_MAX}')
+        month = payload.get('month', time.strftime('%Y-%m'))
+        try:
+            time.strptime(month, '%Y-%m')
+        except (TypeError, ValueError):
+            raise ValueError('Invalid month, expected year-month')
+        return 'top', {'n': n, 'month': f'{month}-01'}
+
+    raise ValueError('type must be report or top')
+
+def run_report_job(job_id, kind, params):
+    conn = None
+    try:
+        conn = db_connection()
+        cur = conn.cursor()
+        cur.execute("UPDATE report_job SET status = 'running' WHERE id = %s", (job_id,))
+        conn.commit()
+
+        # the result is computed where the synchronous endpoint reads (a replica when there is one)
+        if (len(shards) > 1):
+            result = json.dumps(REPORT_JOB_GATHER[kind](params), default=str)
+        else:
+            source = replica_connection()
+            try:
+                source_cur = source.cursor()
+                source_cur.execute(REPORT_JOB_STATEMENTS[kind], params)
+                result = source_cur.fetchone()[0]
+                source.commit()
+            finally:
+                source.close()
+
+        cur.execute("UPDATE report_job SET status = 'done', result = %s, finished_at = CURRENT_TIMESTAMP WHERE id = %s", (result, job_id))
+        conn.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'report job {job_id} - error: {error}')
+        if conn is not None:
+            conn.rollback()
+            try:
+                cur.execute("UPDATE report_job SET status = 'failed', error = %s, finished_at = CURRENT_TIMESTAMP WHERE id = %s", (str(error), job_id))
+                conn.commit()
+            except psycopg2.Error as error:
+                logger.error(f'report job {job_id} - could not record the failure: {error}')
+    finally:
+        if conn is not None:
+            conn.close()
+        with report_jobs_lock:
+            report_jobs_running.pop(job_id).set()
+
+
+##
+## POST
+##
+## Submit a report job
+##
+## {"type": "report"} for the monthly report, {"type": "top", "n": 3, "month": "2024-05"}
+## for the top patients (n and month are optional, like /dbproj/top). Answers 202 with
+## the job (see GET /dbproj/jobs/<job_id>), which may already be done when an identical
+## job was submitted before
+##
+## Only assistants can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/jobs
+##
+@app.route('/dbproj/jobs', methods=['POST'])
+@token_required(['assistant'])
+@admission_control('read')
+def submit_report_job(user_id, user_type):
+    logger.info('POST /dbproj/jobs')
+    payload = flask.request.get_json()
+
+    logger.debug(f'POST /dbproj/jobs - payload: {payload}, token_id: {user_id}, token_type: {user_type}')
+
+    if (not isinstance(payload, dict)):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Payload must be a JSON object'}
+        return flask.jsonify(response), response['status']
+
+    try:
+        kind, params = report_job_params(payload)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'errors': str(error)}
+        return flask.jsonify(response), response['status']
+
+    conn = None
+    try:
+        conn = db_connection()
+        conn.autocommit = False
+        cur = conn.cursor()
+
+        cur.execute(f'''
+            DELETE FROM report_job
+            WHERE (stale OR status = 'failed') AND submitted_at < CURRENT_TIMESTAMP - INTERVAL '{REPORT_JOB_RETENTION}';
+            UPDATE report_job SET status = 'failed', error = 'abandoned'
+            WHERE kind = %(kind)s AND params = %(params)s AND status IN ('queued', 'running')
+                AND submitted_at < CURRENT_TIMESTAMP - %(timeout)s * INTERVAL '1 second';
+            -- the current job when there is one (coalesced), in the same statement: the
+            -- no-op update locks it, so it cannot turn stale or failed in between
+            -- (xmax is 0 only for the inserted row)
+            INSERT INTO report_job(kind, params)
+            VALUES(%(kind)s, %(params)s)
+            ON CONFLICT (kind, params) WHERE NOT stale AND status <> 'failed' DO UPDATE SET id = report_job.id
+            RETURNING id, (xmax = 0)
+        ''', {'kind': kind, 'params': json.dumps(params), 'timeout': REPORT_JOB_TIMEOUT})
+        job_id, created = cur.fetchone()
+        cur.execute(REPORT_JOB_JSON_STATEMENT, (job_id,))
+        job = cur.fetchone()[0]
+
+        # commit the transaction
+        conn.commit()
+
+        # the request that created the job runs it
+        if (created):
+            with report_jobs_lock:
+                report_jobs_running[job_id] = threading.Event()
+            report_job_executor.submit(run_report_job, job_id, kind, params)
+
+        body = '{"status": %d, "results": %s}' % (StatusCodes['accepted'], job)
+        response = flask.Response(body, status=StatusCodes['accepted'], mimetype='application/json')
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /dbproj/jobs - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+        # an error occurred, rollback
+        if conn is not None:
+            conn.rollback()
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    if (isinstance(response, flask.Response)):
+        return response
+    return flask.jsonify(response), response['status']
+
+
+##
+## GET
+##
+## Report job
+##
+## The state (queued, running, done or failed) of a job and, once done, its result;
+## stale is true when the data behind the result changed since (submit it again for
+## a fresh one). With ?wait=<seconds> (at most REPORT_JOB_MAX_WAIT) the answer waits
+## for a job of this worker to end, without holding a connection while waiting
+##
+## Only assistants can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/jobs/<job_id>?wait=<seconds>
+##
+@app.route('/dbproj/jobs/<int:job_id>', methods=['GET'])
+@token_required(['assistant'])
+def get_report_job(job_id, user_id, user_type):
+    logger.info('GET /dbproj/jobs/<job_id>')
+
+    logger.debug(f'job_id: {job_id}, args: {flask.request.args}, token_id: {user_id}, token_type: {user_type}')
+
+    try:
+        wait = min(float(flask.request.args.get('wait', 0)), REPORT_JOB_MAX_WAIT)
+    except ValueError:
+        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid wait'}
+        return flask.jsonify(response), response['status']
+
+    with report_jobs_lock:
+        finished = report_jobs_running.get(job_id)
+    if (finished is not None and wait > 0):
+        finished.wait(wait)
+
+    return read_report_job(job_id)
+
+@admission_control('read')
+def read_report_job(job_id):
+    conn = None
+    try:
+        conn = db_connection()
+        conn.autocommit = False
+        cur = conn.cursor()
+
+        cur.execute(REPORT_JOB_JSON_STATEMENT, (job_id,))
+        if (not cur.rowcount):
+            response = {'status': StatusCodes['api_error'], 'errors': 'Job not found'}
+        else:
+            response = json_response(cur.fetchone()[0])
+
+        # commit the transaction
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/jobs/<job_id> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+        # an error occurred, rollback
+        if conn is not None:
+            conn.rollback()
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    if (isinstance(response, flask.Response)):
+        return response
+    return flask.jsonify(response), response['status']
+
+
+##
+## GET
+##
+## Census
+##
+## Patients hospitalised and the patients of each responsable nurse, at an instant
+## (?at=<timestamp>, default now) or every step hours over a range
+## (?from=<timestamp>&to=<timestamp>&step=<hours>, step defaults to 1):
+## {"at": ..., "patients": ..., "nurses": [{"email": ..., "patients": ...}, ...]}
+## per instant, a list of them for a range. Each instant is a lookup in the GiST
+## index on the stays, the whole series is one statement
+##
+## Only assistants and nurses can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/census?at=<year-month-dayThour:minute>
+## OR
+## http://localhost:8080/dbproj/census?from=<timestamp>&to=<timestamp>&step=<hours>
+##
+CENSUS_MAX_POINTS = 24 * 92 # an hourly series of three months
+
+CENSUS_STATEMENT = '''
+    SELECT i.at, COALESCE(SUM(n.patients), 0)::bigint, COALESCE(json_object_agg(n.nurse_email, n.patients) FILTER (WHERE n.nurse_email IS NOT NULL), '{}')
+    FROM generate_series(%(from)s::timestamp, %(to)s::timestamp, %(step)s * INTERVAL '1 hour') AS i(at)
+    LEFT JOIN LATERAL (
+        SELECT h.nurse_email, COUNT(*) AS patients
+        FROM hospitalization AS h
+        WHERE tsrange(h.entry_time, h.exit_time) @> i.at
+        GROUP BY h.nurse_email
+    ) AS n ON TRUE
+    GROUP BY i.at
+    ORDER BY i.at
+'''
+
+@app.route('/dbproj/census', methods=['GET'])
+@token_required(['assistant', 'nurse'])
+@admission_control('analytics')
+def get_census(user_id, user_type):
+    logger.info('GET /dbproj/census')
+
+    logger.debug(f'args: {flask.request.args}, token_id: {user_id}, token_type: {user_type}')
+
+    args = flask.request.args
+    series = ('from' in args or 'to' in args)
+    try:
+        if (series):
+            start = datetime.datetime.fromisoformat(args['from'])
+            end = datetime.datetime.fromisoformat(args['to'])
+            step = float(args.get('step', 1))
+        else:
+            start = end = datetime.datetime.fromisoformat(args['at']) if ('at' in args) else datetime.datetime.now().replace(microsecond=0)
+            step = 1
+    except (KeyError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Give at, or from and to (timestamps) and optionally step (hours)'}
+        return flask.jsonify(response), response['status']
+
+    if (not step > 0 or end < start or (end - start) / datetime.timedelta(hours=step) >= CENSUS_MAX_POINTS):
+        response = {'status': StatusCodes['api_error'], 'errors': f'from must not be after to, step must be positive and the series at most {CENSUS_MAX_POINTS} points'}
+        return flask.jsonify(response), response['status']
+
+    values = {'from': start, 'to': end, 'step': step}
+
+    try:
+        # nurses look after patients of every shard, the counts of the shards add up
+        census = {}
+        for rows in scatter(CENSUS_STATEMENT, values):
+            for at, patients, nurses in rows:
+                point = census.setdefault(at, {'patients': 0, 'nurses': {}})
+                point['patients'] += patients
+                for email, nurse_patients in nurses.items():
+                    point['nurses'][email] = point['nurses'].get(email, 0) + nurse_patients
 
         results = []
-        last_month = None
+        for at in sorted(census):
+            nurses = [{'email': email, 'patients': nurse_patients} for email, nurse_patients in sorted(census[at]['nurses'].items(), key=lambda nurse: (-nurse[1], nurse[0]))]
+            results.append({'at': at.isoformat(), 'patients': census[at]['patients'], 'nurses': nurses})
+
+        response = {'status': StatusCodes['success'], 'results': results if series else results[0]}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/census - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return flask.jsonify(response), response['status']
+
+
+##
+## GET
+##
+## Nurse team
+##
+## Lists every nurse supervised (directly or not) by the given nurse
+##
+## Only employees can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/nurses/<nurse_email>/team
+##
+@app.route('/dbproj/nurses/<nurse_email>/team', methods=['GET'])
+@token_required(['assistant', 'nurse', 'doctor'])
+@admission_control('read')
+def get_nurse_team(nurse_email, user_id, user_type):
+    logger.info('GET /dbproj/nurses/<nurse_email>/team')
+
+    logger.debug(f'nurse_email: {nurse_email}, token_id: {user_id}, token_type: {user_type}')
+
+    # one index scan on the closure primary key (ancestor_email, descendant_email)
+    statement = '''
+        SELECT e.emp_num, e.name, e.email, nc.depth
+        FROM nurse_closure AS nc
+        JOIN employee AS e ON e.email = nc.descendant_email
+        WHERE nc.ancestor_email = %s AND nc.depth > 0
+        ORDER BY nc.depth, e.name;
+    '''
+    value = (nurse_email,)
+
+    try:
+        conn = replica_connection()
+        conn.autocommit = False
+        cur = conn.cursor()
+
+        cur.execute(statement, value)
+        rows = cur.fetchall()
+
+        team = []
         for row in rows:
-            if (last_month != row[0]):
-                results.append({'month': row[0], 'doctor_name': row[1], 'surgeries': row[2]})
-            else:
-                results[-1]['doctor_name'] += ', ' + row[1]
-            last_month = row[0]
+            team.append({'id': int(row[0]), 'name': row[1], 'email': row[2], 'depth': row[3]})
 
-        response = {'status': StatusCodes['success'], 'results': results}
+        response = {'status': StatusCodes['success'], 'results': team}
 
         # commit the transaction
         conn.commit()
 
     except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'GET /dbproj/report - error: {error}')
+        logger.error(f'GET /dbproj/nurses/<nurse_email>/team - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+        # an error occurred, rollback
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return flask.jsonify(response), response['status']
+
+
+##
+## GET
+##
+## Nurse chain of command
+##
+## Lists the superiors of the given nurse, from the direct superior up to the top
+##
+## Only employees can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/nurses/<nurse_email>/superiors
+##
+@app.route('/dbproj/nurses/<nurse_email>/superiors', methods=['GET'])
+@token_required(['assistant', 'nurse', 'doctor'])
+@admission_control('read')
+def get_nurse_superiors(nurse_email, user_id, user_type):
+    logger.info('GET /dbproj/nurses/<nurse_email>/superiors')
+
+    logger.debug(f'nurse_email: {nurse_email}, token_id: {user_id}, token_type: {user_type}')
+
+    # served by the unique index on (descendant_email, depth), already in chain order
+    statement = '''
+        SELECT e.emp_num, e.name, e.email, nc.depth
+        FROM nurse_closure AS nc
+        JOIN employee AS e ON e.email = nc.ancestor_email
+        WHERE nc.descendant_email = %s AND nc.depth > 0
+        ORDER BY nc.depth;
+    '''
+    value = (nurse_email,)
+
+    try:
+        conn = replica_connection()
+        conn.autocommit = False
+        cur = conn.cursor()
+
+        cur.execute(statement, value)
+        rows = cur.fetchall()
+
+        superiors = []
+        for row in rows:
+            superiors.append({'id': int(row[0]), 'name': row[1], 'email': row[2], 'depth': row[3]})
+
+        response = {'status': StatusCodes['success'], 'results': superiors}
+
+        # commit the transaction
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/nurses/<nurse_email>/superiors - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
         # an error occurred, rollback
@@ -1127,6 +3315,236 @@ def generate_monthly_report(user_id, user_type):
     return flask.jsonify(response), response['status']
 
 
+##
+## POST
+##
+## Archive closed history
+##
+## Moves paid appointments and hospitalizations (with their surgeries, bills,
+## payments and expired prescriptions) older than the retention window to the archive schema
+##
+## Only assistants can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/archive
+##
+ARCHIVE_MIN_RETENTION_DAYS = 366 # the monthly report looks one year back
+
+@app.route('/dbproj/archive', methods=['POST'])
+@token_required(['assistant'])
+@admission_control('analytics')
+def archive_history(user_id, user_type):
+    logger.info('POST /dbproj/archive')
+    payload = flask.request.get_json(silent=True) or {}
+
+    logger.debug(f'POST /dbproj/archive - payload: {payload}, token_id: {user_id}, token_type: {user_type}')
+
+    if (not isinstance(payload, dict)):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Payload must be a JSON object'}
+        return flask.jsonify(response), response['status']
+
+    try:
+        retention_days = int(payload.get('retention_days', 2 * ARCHIVE_MIN_RETENTION_DAYS))
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid retention_days'}
+        return flask.jsonify(response), response['status']
+
+    if (retention_days < ARCHIVE_MIN_RETENTION_DAYS):
+        response = {'status': StatusCodes['api_error'], 'errors': f'retention_days must be at least {ARCHIVE_MIN_RETENTION_DAYS}'}
+        return flask.jsonify(response), response['status']
+
+    statement = "SELECT * FROM archive_history(%s * INTERVAL '1 day')"
+    values = (retention_days,)
+
+    if (len(shards) > 1):
+        # each shard archives (and commits) its own history
+        try:
+            appointments, hospitalizations = [sum(column) for column in zip(*[rows[0] for rows in scatter(statement, values, read=False)])]
+            stale_report_jobs(surgeries=True)
+            response = {'status': StatusCodes['success'], 'results': {'appointments': appointments, 'hospitalizations': hospitalizations}}
+        except psycopg2.Error as error:
+            logger.error(f'POST /dbproj/archive - error: {error}')
+            response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return flask.jsonify(response), response['status']
+
+    try:
+        conn = db_connection()
+        conn.autocommit = False
+        cur = conn.cursor()
+
+        cur.execute(statement, values)
+        appointments, hospitalizations = cur.fetchone()
+
+        # commit the transaction
+        conn.commit()
+        response = {'status': StatusCodes['success'], 'results': {'appointments': appointments, 'hospitalizations': hospitalizations}}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /dbproj/archive - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+        # an error occurred, rollback
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return flask.jsonify(response), response['status']
+
+
+##
+## GET
+##
+## Profiles
+##
+## The saved profiles (see profile_call), newest first:
+## [{"name": ..., "route": ..., "duration_ms": ..., "time": ..., "size": ...}, ...]
+## and one of them, in the binary format of cProfile (python -m pstats <file>, snakeviz)
+## or, with ?format=text, as the pstats listing sorted by cumulative time
+##
+## Only assistants can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/profiles
+## OR
+## http://localhost:8080/dbproj/profiles/<name>?format=text
+##
+@app.route('/dbproj/profiles', methods=['GET'])
+@token_required(['assistant'])
+def get_profiles(user_id, user_type):
+    logger.info('GET /dbproj/profiles')
+
+    logger.debug(f'token_id: {user_id}, token_type: {user_type}')
+
+    profiles = []
+    for name in sorted(profile_names(), reverse=True):
+        saved_at, _, route, duration = PROFILE_NAME.fullmatch(name).groups()
+        try:
+            size = os.path.getsize(os.path.join(profile_dir, name))
+        except FileNotFoundError:
+            # dropped from the ring meanwhile
+            continue
+        profiles.append({'name': name, 'route': route, 'duration_ms': int(duration),
+                         'time': datetime.datetime.fromtimestamp(int(saved_at) / 1000, datetime.timezone.utc).isoformat(), 'size': size})
+
+    response = {'status': StatusCodes['success'], 'results': profiles}
+    return flask.jsonify(response), response['status']
+
+
+@app.route('/dbproj/profiles/<name>', methods=['GET'])
+@token_required(['assistant'])
+def get_profile(name, user_id, user_type):
+    logger.info('GET /dbproj/profiles/<name>')
+
+    logger.debug(f'name: {name}, token_id: {user_id}, token_type: {user_type}')
+
+    # only the names in the ring, nothing else of the disk
+    if (name not in profile_names()):
+        response = {'status': StatusCodes['api_error'], 'errors': 'Profile not found'}
+        return flask.jsonify(response), response['status']
+
+    path = os.path.join(profile_dir, name)
+    try:
+        if (flask.request.args.get('format') == 'text'):
+            listing = io.StringIO()
+            pstats.Stats(path, stream=listing).sort_stats('cumulative').print_stats(PROFILE_TEXT_LINES)
+            return flask.Response(listing.getvalue(), mimetype='text/plain')
+
+        with open(path, 'rb') as profile:
+            data = profile.read()
+    except FileNotFoundError:
+        # dropped from the ring meanwhile
+        response = {'status': StatusCodes['api_error'], 'errors': 'Profile not found'}
+        return flask.jsonify(response), response['status']
+
+    return flask.Response(data, mimetype='application/octet-stream', headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
+
+##
+## GET
+##
+## Route metrics
+##
+## Per endpoint under admission control: its class, its deadline in seconds and how many
+## requests it got, shed (503) and timed out (504) since this worker process started
+## (add them up over the workers). Served from memory, without admission control
+##
+## Only assistants can use this endpoint
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/metrics
+##
+@app.route('/dbproj/metrics', methods=['GET'])
+@token_required(['assistant'])
+def get_route_metrics(user_id, user_type):
+    logger.info('GET /dbproj/metrics')
+
+    logger.debug(f'token_id: {user_id}, token_type: {user_type}')
+
+    counters = route_metrics.snapshot()
+    results = {}
+    for route, (route_class, budget) in sorted(route_budgets.items()):
+        results[route] = dict({'class': route_class, 'deadline': budget, 'requests': 0, 'shed': 0, 'timeouts': 0}, **counters.get(route, {}))
+
+    response = {'status': StatusCodes['success'], 'results': results}
+    return flask.jsonify(response), response['status']
+
+
+##
+## GET
+##
+## Change feed
+##
+## Server-sent events for new appointments, surgeries, prescriptions and payments:
+## assistants get every event, patients the events about them, doctors and nurses
+## the events they take part in. A 'reset' event means events may have been missed
+## (fetch the lists again). The stream ends when the token expires, reconnect with
+## a new one. Streams are long lived, so they are not subject to admission control
+## (they hold no database connection, the worker shares one LISTEN connection)
+##
+## Available to every user
+##
+## To use it, access:
+##
+## http://localhost:8080/dbproj/events
+##
+@app.route('/dbproj/events', methods=['GET'])
+@token_required(['assistant', 'nurse', 'doctor', 'patient'])
+def get_events(user_id, user_type):
+    logger.info('GET /dbproj/events')
+
+    logger.debug(f'token_id: {user_id}, token_type: {user_type}')
+
+    subscriber = change_feed.subscribe(change_feed_filter(user_id, user_type))
+    if (subscriber is None):
+        logger.warning('GET /dbproj/events - shed (too many subscribers)')
+        response = {'status': StatusCodes['unavailable'], 'errors': 'Server busy, try again later'}
+        return flask.jsonify(response), response['status'], {'Retry-After': str(ADMISSION_RETRY_AFTER)}
+
+    def stream():
+        try:
+            # how long browsers wait before reconnecting, in milliseconds
+            yield f'retry: {CHANGE_FEED_RECONNECT * 1000}\n\n'
+            end = time.monotonic() + CHANGE_FEED_MAX_AGE
+            while (time.monotonic() < end):
+                try:
+                    event = subscriber.get(timeout=CHANGE_FEED_HEARTBEAT)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                if (event is None):
+                    break
+                yield f'event: {event["event"]}\ndata: {json.dumps(event)}\n\n'
+        finally:
+            change_feed.unsubscribe(subscriber)
+
+    return flask.Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 ##########################################################
 ## MAIN
 ##########################################################
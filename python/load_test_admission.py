@@ -0,0 +1,118 @@
+##
+## Load test for the admission control of care_sync.py
+##
+## Books appointments one after the other, first on an idle server and then while
+## a storm of clients keeps requesting /dbproj/report and /dbproj/top3, and prints
+## the booking latency percentiles and the status codes of both.
+##
+## Start the API first (python care_sync.py), then:
+##
+##   python load_test_admission.py --assistant <email> <password> --patient <cc> <password> --doctor <email>
+##
+## Every run books 2 * --bookings appointments, starting --start days ahead at
+## one hour intervals, so use a different --start (or a fresh database) per run.
+##
+
+import argparse
+import collections
+import datetime
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+def request(url, method, path, token=None, body=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = token
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url + path, data=data, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, None
+    except OSError as error:
+        return type(error).__name__, None
+
+
+def login(url, username, password):
+    status, body = request(url, 'PUT', '/dbproj/user', body={'username': username, 'password': password})
+    if status != 200:
+        raise SystemExit(f'login failed for {username}: {status}')
+    return body['results']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def book(args, token, first):
+    latencies = []
+    statuses = collections.Counter()
+    for i in range(args.bookings):
+        when = first + datetime.timedelta(hours=i)
+        start = time.monotonic()
+        status, _ = request(args.url, 'POST', '/dbproj/appointment', token, {'doctor_id': args.doctor, 'appointment_time': when.isoformat()})
+        latencies.append(time.monotonic() - start)
+        statuses[status] += 1
+    return latencies, statuses
+
+
+def storm(args, token, stop, statuses):
+    paths = ['/dbproj/report', '/dbproj/top3']
+    i = 0
+    while not stop.is_set():
+        status, _ = request(args.url, 'GET', paths[i % len(paths)], token)
+        statuses[status] += 1
+        i += 1
+        if status == 503:
+            # well behaved clients honour Retry-After
+            stop.wait(args.retry_after)
+
+
+def report(name, latencies, statuses):
+    print(f'{name:>12}: p50 {percentile(latencies, 50) * 1000:8.1f} ms  '
+          f'p99 {percentile(latencies, 99) * 1000:8.1f} ms  '
+          f'max {max(latencies) * 1000:8.1f} ms  statuses {dict(statuses)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Booking latency during a report storm')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--assistant', nargs=2, required=True, metavar=('EMAIL', 'PASSWORD'))
+    parser.add_argument('--patient', nargs=2, required=True, metavar=('CC', 'PASSWORD'))
+    parser.add_argument('--doctor', required=True)
+    parser.add_argument('--bookings', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=150, help='concurrent report clients')
+    parser.add_argument('--retry-after', type=float, default=1, help='seconds a shed report client waits')
+    parser.add_argument('--start', type=int, default=1, help='days from now of the first booking')
+    args = parser.parse_args()
+
+    assistant = login(args.url, *args.assistant)
+    patient = login(args.url, int(args.patient[0]), args.patient[1])
+    first = (datetime.datetime.now() + datetime.timedelta(days=args.start)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    idle = book(args, patient, first)
+
+    stop = threading.Event()
+    storm_statuses = collections.Counter()
+    clients = [threading.Thread(target=storm, args=(args, assistant, stop, storm_statuses)) for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+    time.sleep(1)
+    loaded = book(args, patient, first + datetime.timedelta(hours=args.bookings))
+    stop.set()
+    for client in clients:
+        client.join()
+
+    report('idle', *idle)
+    report('report storm', *loaded)
+    print(f'{"storm":>12}: statuses {dict(storm_statuses)}')
+
+
+if __name__ == '__main__':
+    main()
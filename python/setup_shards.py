@@ -0,0 +1,84 @@
+##
+## Creates the shard databases of care_sync.py
+##
+## Creates --shards empty databases next to the one of the API configuration
+## (<database>_0, <database>_1, ...), loads tables.sql and object_definition.sql
+## in each and numbers its ids with configure_shard, then prints the "shards"
+## entry to add to the configuration (see encrypt_data.py). Existing rows are not
+## moved: start from empty shards, or re-import the data through the API.
+##
+## Run it from the repository root, as a user allowed to create databases:
+##
+##   python python/setup_shards.py --shards 4
+##
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import care_sync
+
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sql')
+
+
+def load_script(name):
+    # psql meta-commands (\c) are for database_setup.sql, each shard is connected to directly
+    with open(os.path.join(SQL_DIR, name), encoding='utf-8') as script:
+        return ''.join(line for line in script if not line.startswith('\\'))
+
+
+def create_shard(database, index, count):
+    conn = care_sync.psycopg2.connect(
+        user = care_sync.credentials['user'],
+        password = care_sync.credentials['password'],
+        host = care_sync.credentials['host'],
+        port = care_sync.credentials['port'],
+        database = 'postgres'
+    )
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        cur.execute(f'CREATE DATABASE "{database}"')
+    finally:
+        conn.close()
+
+    conn = care_sync.psycopg2.connect(
+        user = care_sync.credentials['user'],
+        password = care_sync.credentials['password'],
+        host = care_sync.credentials['host'],
+        port = care_sync.credentials['port'],
+        database = database
+    )
+    try:
+        conn.set_client_encoding('UTF8')
+        cur = conn.cursor()
+        cur.execute(load_script('tables.sql'))
+        cur.execute(load_script('object_definition.sql'))
+        cur.execute('SELECT configure_shard(%s, %s)', (index, count))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create the shard databases')
+    parser.add_argument('--shards', type=int, required=True)
+    parser.add_argument('--prefix', default=care_sync.credentials['database'], help='shard i is <prefix>_<i>')
+    args = parser.parse_args()
+
+    if (args.shards < 2):
+        raise SystemExit('--shards must be at least 2')
+
+    databases = [f'{args.prefix}_{index}' for index in range(args.shards)]
+    for index, database in enumerate(databases):
+        create_shard(database, index, args.shards)
+        print(f'created {database}')
+
+    print(json.dumps({'shards': [{'database': database} for database in databases]}, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+##
+## Stress test of the write paths of care_sync.py
+##
+## Registers its own doctors, nurses and patients, then has --clients threads fire
+## a random mix of conflicting writes, in process (Flask test client, no HTTP
+## server): appointments and surgeries with nurse roles (new hospitalizations or
+## added to one of the patient's) on a few shared slots, and payments, several
+## clients at a time on the same bills. A deadlock or serialization failure is
+## retried with a backoff, a shed request (503) after its Retry-After, a timeout
+## (504) right away; rejections (unavailable, exceeds the bill) are final.
+##
+## Then it checks, on every shard, for the users of the run:
+##   - no overlapping bookings per doctor, nurse or patient (appointments are 30
+##     minute slots, surgeries their own span; hospitalization stays are not
+##     bookings, schedule_surgery only checks the surgery against them)
+##   - bills of 50 per appointment, and 2000 per surgery for hospitalizations
+##   - payments that never exceed their bill, and paid only when they add up to it
+## and prints the throughput, the abort and retry rates, the backend time spent
+## waiting for locks (pg_stat_activity, sampled) and the violations found; the
+## exit status is 1 when there is any.
+##
+## Everything is committed, so run it against a scratch database; each run uses
+## its own users (--run), from the repository root:
+##
+##   python python/stress_write_paths.py --clients 16 --operations 200
+##
+
+import argparse
+import collections
+import datetime
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import care_sync
+
+
+PASSWORD = 'stress-test'
+EMPLOYEE = {'password': PASSWORD, 'birthday': '1980-01-01', 'salary': 1000, 'contract_issue_date': '2020-01-01', 'contract_due_date': '2030-01-01'}
+NURSE_ROLES = ['anesthetist', 'instrumentist', 'circulating']
+PAYMENT_AMOUNTS = [10, 25, 50, 500, 2000]
+
+# errors worth retrying, the others are final
+RETRY_ERRORS = ('deadlock detected', 'could not serialize access')
+REJECTIONS = ('unavailable', 'exceeds bill amount', 'already paid')
+
+COUNTERS = ['attempts', 'committed', 'rejected', 'aborted', 'shed', 'timeouts', 'failed', 'retries']
+
+BOOKINGS_STATEMENT = '''
+    SELECT 'doctor', a.doctor_email, a.start_time, a.start_time + INTERVAL '30 minutes', 'appointment ' || a.id
+    FROM appointment AS a
+    WHERE a.patient_cc = ANY(%(patients)s)
+    UNION ALL
+    SELECT 'patient', a.patient_cc::text, a.start_time, a.start_time + INTERVAL '30 minutes', 'appointment ' || a.id
+    FROM appointment AS a
+    WHERE a.patient_cc = ANY(%(patients)s)
+    UNION ALL
+    SELECT 'nurse', ar.nurse_email, a.start_time, a.start_time + INTERVAL '30 minutes', 'appointment ' || a.id
+    FROM appointment_role AS ar
+    JOIN appointment AS a ON a.id = ar.appointment_id
+    WHERE a.patient_cc = ANY(%(patients)s)
+    UNION ALL
+    SELECT 'doctor', s.doctor_email, s.start_time, s.end_time, 'surgery ' || s.id
+    FROM surgery AS s
+    JOIN hospitalization AS h ON h.id = s.hospitalization_id
+    WHERE h.patient_cc = ANY(%(patients)s)
+    UNION ALL
+    SELECT 'patient', h.patient_cc::text, s.start_time, s.end_time, 'surgery ' || s.id
+    FROM surgery AS s
+    JOIN hospitalization AS h ON h.id = s.hospitalization_id
+    WHERE h.patient_cc = ANY(%(patients)s)
+    UNION ALL
+    SELECT 'nurse', sr.nurse_email, s.start_time, s.end_time, 'surgery ' || s.id
+    FROM surgery_role AS sr
+    JOIN surgery AS s ON s.id = sr.surgery_id
+    JOIN hospitalization AS h ON h.id = s.hospitalization_id
+    WHERE h.patient_cc = ANY(%(patients)s)
+'''
+
+BILLS_STATEMENT = '''
+    SELECT
+        b.id,
+        b.amount,
+        CASE WHEN a.id IS NOT NULL THEN 50 ELSE 2000 * (SELECT count(*) FROM surgery AS s WHERE s.hospitalization_id = h.id) END,
+        (SELECT COALESCE(sum(p.amount), 0) FROM payment AS p WHERE p.bill_id = b.id),
+        b.paid
+    FROM bill AS b
+    LEFT JOIN appointment AS a ON a.bill_id = b.id
+    LEFT JOIN hospitalization AS h ON h.bill_id = b.id
+    WHERE COALESCE(a.patient_cc, h.patient_cc) = ANY(%(patients)s)
+'''
+
+LOCK_WAITS_STATEMENT = '''
+    SELECT count(*)
+    FROM pg_stat_activity
+    WHERE datname = current_database() AND wait_event_type = 'Lock'
+'''
+
+
+class Stats:
+    def __init__(self):
+        self.counters = collections.defaultdict(collections.Counter)
+        self.latencies = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def count(self, operation, counter, latency=None):
+        with self.lock:
+            self.counters[operation][counter] += 1
+            if latency is not None:
+                self.latencies[operation].append(latency)
+
+
+class LockWaits:
+    # backends waiting for a lock, counted every interval on every shard
+    def __init__(self, interval):
+        self.interval = interval
+        self.waiting = 0.0
+        self.most = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        connections = [care_sync.db_connection(shard) for shard in range(len(care_sync.shards))]
+        try:
+            for conn in connections:
+                conn.autocommit = True
+            last = time.monotonic()
+            while not self.stop.wait(self.interval):
+                waiting = 0
+                for conn in connections:
+                    cur = conn.cursor()
+                    cur.execute(LOCK_WAITS_STATEMENT)
+                    waiting += cur.fetchone()[0]
+                now = time.monotonic()
+                self.waiting += waiting * (now - last)
+                self.most = max(self.most, waiting)
+                last = now
+        finally:
+            for conn in connections:
+                conn.close()
+
+
+def shard_rows(shard, statement, values=None):
+    conn = care_sync.db_connection(shard)
+    try:
+        cur = conn.cursor()
+        cur.execute(statement, values)
+        return cur.fetchall()
+    finally:
+        conn.close()
+
+
+def call(client, stats, operation, method, path, token, payload, retries):
+    # the result of the request, None when it did not commit
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            stats.count(operation, 'retries')
+        start = time.perf_counter()
+        response = getattr(client, method)(path, headers={'Authorization': token}, json=payload)
+        stats.count(operation, 'attempts', time.perf_counter() - start)
+        body = response.get_json() or {}
+
+        if response.status_code == 200:
+            stats.count(operation, 'committed')
+            return body['results']
+        if response.status_code == 503:
+            stats.count(operation, 'shed')
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+            continue
+        if response.status_code == 504:
+            stats.count(operation, 'timeouts')
+            continue
+
+        error = str(body.get('errors', ''))
+        if any(retry in error for retry in RETRY_ERRORS):
+            stats.count(operation, 'aborted')
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+            continue
+        stats.count(operation, 'rejected' if any(rejection in error for rejection in REJECTIONS) else 'failed')
+        return None
+    return None
+
+
+class Workload:
+    def __init__(self, args, tokens, doctors, nurses, patients):
+        self.args = args
+        self.tokens = tokens
+        self.doctors = doctors
+        self.nurses = nurses
+        self.patients = patients
+        self.bills = collections.defaultdict(list)
+        self.hospitalizations = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        first = (datetime.datetime.now() + datetime.timedelta(days=args.start)).replace(hour=0, minute=0, second=0, microsecond=0)
+        # few slots, so that bookings conflict
+        self.slots = [first + datetime.timedelta(days=day, hours=hour) for day in range(args.days) for hour in range(8, 18)]
+
+    def appointment(self, client, stats, rng):
+        patient = rng.choice(self.patients)
+        slot = rng.choice(self.slots) + datetime.timedelta(minutes=rng.choice([0, 30]))
+        appointment_id = call(client, stats, 'appointment', 'post', '/dbproj/appointment', self.tokens[patient],
+                              {'doctor_id': rng.choice(self.doctors), 'appointment_time': slot.isoformat()}, self.args.retries)
+        if appointment_id is not None:
+            (bill_id,) = shard_rows(care_sync.shard_of(appointment_id), 'SELECT bill_id FROM appointment WHERE id = %s', (appointment_id,))[0]
+            with self.lock:
+                self.bills[patient].append(bill_id)
+
+    def surgery(self, client, stats, rng):
+        patient = rng.choice(self.patients)
+        start = rng.choice(self.slots)
+        end = start + datetime.timedelta(hours=rng.choice([1, 2]))
+        nurses = rng.sample(self.nurses, rng.randint(1, 2))
+        payload = {'patient_id': patient, 'doctor': rng.choice(self.doctors), 'nurses': [[nurse, rng.choice(NURSE_ROLES)] for nurse in nurses],
+                   'surgery_start': start.isoformat(), 'surgery_end': end.isoformat()}
+        with self.lock:
+            hospitalizations = list(self.hospitalizations[patient])
+        if hospitalizations and rng.random() < 0.5:
+            path = f'/dbproj/surgery/{rng.choice(hospitalizations)}'
+        else:
+            path = '/dbproj/surgery'
+            payload.update({'hospitalization_entry_time': (start - datetime.timedelta(minutes=30)).isoformat(),
+                            'hospitalization_exit_time': (end + datetime.timedelta(minutes=30)).isoformat(),
+                            'hospitalization_responsable_nurse': rng.choice(self.nurses)})
+        result = call(client, stats, 'surgery', 'post', path, self.tokens['assistant'], payload, self.args.retries)
+        if result is not None:
+            with self.lock:
+                if result['hospitalization_id'] not in self.hospitalizations[patient]:
+                    self.hospitalizations[patient].append(result['hospitalization_id'])
+                    self.bills[patient].append(result['bill_id'])
+
+    def payment(self, client, stats, rng):
+        with self.lock:
+            payers = [patient for patient in self.patients if self.bills[patient]]
+            if not payers:
+                return
+            patient = rng.choice(payers)
+            bill_id = rng.choice(self.bills[patient])
+        call(client, stats, 'payment', 'post', f'/dbproj/bills/{bill_id}', self.tokens[patient],
+             {'amount': rng.choice(PAYMENT_AMOUNTS), 'payment_method': 'card'}, self.args.retries)
+
+    def run(self, seed, stats):
+        rng = random.Random(seed)
+        client = care_sync.app.test_client()
+        operations = [self.appointment, self.surgery, self.payment]
+        for _ in range(self.args.operations):
+            rng.choices(operations, weights=self.args.mix)[0](client, stats, rng)
+
+
+def register(args):
+    client = care_sync.app.test_client()
+
+    def post(path, payload):
+        response = client.post(path, json=payload)
+        if response.status_code != 200:
+            raise SystemExit(f'{path}: {response.get_json()}')
+
+    def login(username):
+        response = client.put('/dbproj/user', json={'username': username, 'password': PASSWORD})
+        if response.status_code != 200:
+            raise SystemExit(f'login failed for {username}: {response.get_json()}')
+        return response.get_json()['results']
+
+    # numbers and emails of the run
+    base = 8000000000 + args.run * 1000
+    domain = f'run{args.run}.stress.test'
+    numbers = iter(range(base, base + 1000))
+
+    assistant = f'assistant@{domain}'
+    post('/dbproj/register/assistant', dict(EMPLOYEE, cc=next(numbers), contract_id=args.run * 1000, name='Assistant', email=assistant))
+    tokens = {'assistant': login(assistant)}
+
+    nurses = [f'nurse{i}@{domain}' for i in range(args.nurses)]
+    for i, nurse in enumerate(nurses):
+        number = next(numbers)
+        superior = {'superior_email': nurses[0]} if i > 0 else {}
+        post('/dbproj/register/nurse', dict(EMPLOYEE, cc=number, contract_id=number, name=f'Nurse {i}', email=nurse, **superior))
+
+    doctors = [f'doctor{i}@{domain}' for i in range(args.doctors)]
+    for i, doctor in enumerate(doctors):
+        number = next(numbers)
+        post('/dbproj/register/doctor', dict(EMPLOYEE, cc=number, contract_id=number, name=f'Doctor {i}', email=doctor, license_id=f'{domain}-{i}',
+                                             license_issue_date='2020-01-01', license_due_date='2030-01-01', license_company='Stress',
+                                             specialties=[{'specialty_name': f'surgery {domain} {i}', 'parent_specialty': 'surgery'}]))
+
+    patients = []
+    for i in range(args.patients):
+        cc = next(numbers)
+        post('/dbproj/register/patient', {'cc': cc, 'name': f'Patient {i}', 'password': PASSWORD, 'health_number': cc,
+                                          'emergency_contact': 1, 'birthday': '1990-01-01', 'email': f'patient{i}@{domain}'})
+        tokens[cc] = login(cc)
+        patients.append(cc)
+
+    return tokens, doctors, nurses, patients
+
+
+def overlaps(bookings):
+    # (kind, who, start, end, event) rows -> pairs of events of the same person that overlap
+    found = []
+    people = collections.defaultdict(list)
+    for kind, who, start, end, event in bookings:
+        people[(kind, who)].append((start, end, event))
+    for (kind, who), events in people.items():
+        events.sort()
+        for i, (start, end, event) in enumerate(events):
+            for other_start, other_end, other in events[i + 1:]:
+                if other_start >= end:
+                    break
+                found.append(f'{kind} {who}: {event} and {other}')
+    return found
+
+
+def check(patients):
+    values = {'patients': patients}
+    # doctors and nurses have bookings on every shard, compare them all together
+    bookings = [row for shard in range(len(care_sync.shards)) for row in shard_rows(shard, BOOKINGS_STATEMENT, values)]
+    bills = [row for shard in range(len(care_sync.shards)) for row in shard_rows(shard, BILLS_STATEMENT, values)]
+    return {
+        'overlapping bookings': overlaps(bookings),
+        'bills with a wrong amount': [f'bill {bill_id}: {amount} instead of {expected}' for bill_id, amount, expected, _, _ in bills if amount != expected],
+        'bills paid beyond their amount': [f'bill {bill_id}: {payments} paid of {amount}' for bill_id, amount, _, payments, _ in bills if payments > amount],
+        'bills with a wrong paid flag': [f'bill {bill_id}: paid {paid} with {payments} of {amount}' for bill_id, amount, _, payments, paid in bills
+                                         if paid != (payments == amount)]
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent bookings and payments, then invariant checks')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--operations', type=int, default=200, help='operations per client')
+    parser.add_argument('--mix', type=int, nargs=3, default=[5, 2, 3], metavar=('APPOINTMENTS', 'SURGERIES', 'PAYMENTS'), help='weights of the operations')
+    parser.add_argument('--doctors', type=int, default=4)
+    parser.add_argument('--nurses', type=int, default=6)
+    parser.add_argument('--patients', type=int, default=20)
+    parser.add_argument('--days', type=int, default=2, help='days with slots (10 hourly slots each)')
+    parser.add_argument('--start', type=int, default=1, help='days from now of the first slot')
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--sample-interval', type=float, default=0.01, help='seconds between lock wait samples')
+    parser.add_argument('--run', type=int, default=int(time.time()) % 1000000, help='numbers the users of the run')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    care_sync.logger = logging.getLogger('stress_write_paths')
+    # the rejections are expected, only the summary matters
+    care_sync.logger.setLevel(logging.CRITICAL)
+
+    tokens, doctors, nurses, patients = register(args)
+    workload = Workload(args, tokens, doctors, nurses, patients)
+    stats = Stats()
+    seeds = random.Random(args.seed)
+    clients = [threading.Thread(target=workload.run, args=(seeds.random(), stats)) for _ in range(args.clients)]
+
+    lock_waits = LockWaits(args.sample_interval)
+    lock_waits.thread.start()
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    lock_waits.stop.set()
+    lock_waits.thread.join()
+
+    total = collections.Counter()
+    for counters in stats.counters.values():
+        total.update(counters)
+    operations = args.clients * args.operations
+    print(f'run {args.run}: {args.clients} clients, {operations} operations in {elapsed:.1f} s, '
+          f'{total["committed"] / elapsed:.1f} commits/s')
+    print(f'{"":<12}' + ''.join(f'{counter:>10}' for counter in COUNTERS) + f'{"p50 ms":>10}{"p99 ms":>10}')
+    for operation in ('appointment', 'surgery', 'payment'):
+        counters = stats.counters[operation]
+        latencies = stats.latencies[operation] or [0]
+        print(f'{operation:<12}' + ''.join(f'{counters[counter]:>10}' for counter in COUNTERS)
+              + f'{percentile(latencies, 50) * 1000:10.1f}{percentile(latencies, 99) * 1000:10.1f}')
+    print(f'abort rate {total["aborted"] / max(total["attempts"], 1):.2%} of the attempts, '
+          f'retry rate {total["retries"] / max(operations, 1):.2%} of the operations')
+    print(f'lock waits: {lock_waits.waiting:.2f} s of backend time (sampled every {args.sample_interval * 1000:.0f} ms), '
+          f'at most {lock_waits.most} backends at once')
+
+    violations = check(patients)
+    print('invariants:')
+    for invariant, found in violations.items():
+        print(f'  {invariant}: {len(found)}')
+        for violation in found[:10]:
+            print(f'    {violation}')
+    if any(violations.values()):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+##
+## Plan regression tests
+##
+## Calls every endpoint of care_sync.py against a seeded database and fails when
+## a statement it runs, including the ones inside the plpgsql functions and
+## triggers it calls, reads a large table (LARGE_ROWS rows or more once seeded,
+## partitions of payment one by one) with a sequential scan.
+##
+## The seed and everything the endpoints write live in one transaction that is
+## rolled back at the end, so any database with the project schema will do
+## (the one in config.enc is used). From the repository root:
+##
+##   python -m pytest -q python/test_plans.py
+##
+## Two checks per endpoint:
+##   - pg_stat_xact_user_tables.seq_scan of the large tables before and after
+##     the request: catches every scan, nested ones included
+##   - EXPLAIN of each SELECT the endpoint sent: names the plan that did it
+##
+
+import datetime
+import itertools
+import logging
+import os
+
+import psycopg2
+import pytest
+
+# care_sync reads secret.key and config.enc from the working directory
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import care_sync
+
+
+LARGE_ROWS = 1000
+
+PASSWORD = 'plan-test'
+PATIENT = 9000000001        # registered through the API, books and pays
+BULK_PATIENT = 9100000001   # one of the seeded patients, read by the list endpoints
+PATIENTS = 2000
+DOCTORS = 20
+NURSES = 20
+
+SEED = '''
+    SELECT create_payment_partitions((CURRENT_DATE - INTERVAL '3 months')::date, (CURRENT_DATE + INTERVAL '3 months')::date);
+
+    INSERT INTO patient(cc, health_num, name, hashcode, emergency_contact, birthday, email)
+    SELECT 9100000000 + g, 9100000000 + g, 'Patient ' || g, 'x', 1, '1990-01-01', 'p' || g || '@plan.test'
+    FROM generate_series(1, %(patients)s) AS g;
+
+    INSERT INTO employee(email, cc, name, hashcode, birthday, contract_id, salary, contract_issue_date, contract_due_date)
+    SELECT role || g || '@plan.test', 9200000000 + g + CASE role WHEN 'doctor' THEN 0 ELSE 1000 END, role || ' ' || g, 'x', '1980-01-01',
+        9200000000 + g + CASE role WHEN 'doctor' THEN 0 ELSE 1000 END, 1000, '2020-01-01', '2030-01-01'
+    FROM generate_series(1, %(doctors)s) AS g, (VALUES ('doctor'), ('nurse')) AS r(role);
+    INSERT INTO doctor(email, license_id, license_company_name, license_issue_date, license_due_date)
+    SELECT 'doctor' || g || '@plan.test', 'PLAN' || g, 'X', '2020-01-01', '2030-01-01' FROM generate_series(1, %(doctors)s) AS g;
+    INSERT INTO nurse(email) SELECT 'nurse' || g || '@plan.test' FROM generate_series(1, %(nurses)s) AS g;
+    INSERT INTO nurse_closure(ancestor_email, descendant_email, depth)
+    SELECT 'nurse' || g || '@plan.test', 'nurse' || g || '@plan.test', 0 FROM generate_series(1, %(nurses)s) AS g;
+
+    -- an appointment every hour for the last four and a half years (bills come from the trigger)
+    INSERT INTO appointment(start_time, doctor_email, patient_cc)
+    SELECT date_trunc('hour', now()) - g * INTERVAL '1 hour', 'doctor' || (1 + g %% %(doctors)s) || '@plan.test', 9100000001 + g %% %(patients)s
+    FROM generate_series(1, 40000) AS g;
+
+    INSERT INTO hospitalization(entry_time, exit_time, nurse_email, patient_cc)
+    SELECT date_trunc('hour', now()) - g * INTERVAL '4 hours', date_trunc('hour', now()) - g * INTERVAL '4 hours' + INTERVAL '2 days',
+        'nurse' || (1 + g %% %(nurses)s) || '@plan.test', 9100000001 + g %% %(patients)s
+    FROM generate_series(1, 5000) AS g;
+    INSERT INTO surgery(start_time, end_time, doctor_email, hospitalization_id)
+    SELECT h.entry_time + INTERVAL '1 hour', h.entry_time + INTERVAL '3 hours', 'doctor' || (1 + h.id %% %(doctors)s) || '@plan.test', h.id
+    FROM hospitalization AS h WHERE h.patient_cc > 9100000000;
+
+    INSERT INTO appointment_role(role, appointment_id, nurse_email)
+    SELECT 'aux', a.id, 'nurse' || (1 + a.id %% %(nurses)s) || '@plan.test' FROM appointment AS a WHERE a.patient_cc > 9100000000 AND a.id %% 4 = 0;
+    INSERT INTO surgery_role(role, surgery_id, nurse_email)
+    SELECT 'aux', s.id, 'nurse' || (1 + s.id %% %(nurses)s) || '@plan.test' FROM surgery AS s WHERE s.doctor_email LIKE '%%@plan.test';
+
+    INSERT INTO medicine(name) SELECT 'plan medicine ' || g FROM generate_series(1, 20) AS g ON CONFLICT DO NOTHING;
+    INSERT INTO side_effect(occurrence, description) VALUES ('plan nausea', 'Nausea'), ('plan rash', 'Skin rash') ON CONFLICT DO NOTHING;
+    INSERT INTO reaction_severity(degree, side_effect_occurrence, medicine_name)
+    SELECT 'mild', se.occurrence, 'plan medicine ' || g FROM generate_series(1, 20) AS g, (VALUES ('plan nausea'), ('plan rash')) AS se(occurrence) ON CONFLICT DO NOTHING;
+    CREATE TEMP TABLE plan_prescription ON COMMIT DROP AS
+    SELECT nextval('prescription_id_seq') AS id, a.id AS appointment_id
+    FROM appointment AS a WHERE a.patient_cc > 9100000000 AND a.id %% 4 = 1;
+    INSERT INTO prescription(id, validity) SELECT id, CURRENT_DATE + 365 FROM plan_prescription;
+    INSERT INTO appointment_prescription(appointment_id, prescription_id) SELECT appointment_id, id FROM plan_prescription;
+    INSERT INTO medicine_dosage(quantity, frequency, medicine_name, prescription_id)
+    SELECT '1', 'daily', 'plan medicine ' || (1 + (id + m) %% 20), id FROM plan_prescription, generate_series(0, 1) AS m;
+    CREATE TEMP TABLE plan_hosp_prescription ON COMMIT DROP AS
+    SELECT nextval('prescription_id_seq') AS id, h.id AS hospitalization_id
+    FROM hospitalization AS h, generate_series(1, 2) WHERE h.patient_cc > 9100000000;
+    INSERT INTO prescription(id, validity) SELECT id, CURRENT_DATE + 365 FROM plan_hosp_prescription;
+    INSERT INTO hospitalization_prescription(prescription_id, hospitalization_id) SELECT id, hospitalization_id FROM plan_hosp_prescription;
+    INSERT INTO medicine_dosage(quantity, frequency, medicine_name, prescription_id)
+    SELECT '1', 'daily', 'plan medicine ' || (1 + id %% 20), id FROM plan_hosp_prescription;
+
+    -- the last three months of payments, half of the bills (marked paid, so they can be archived)
+    INSERT INTO payment(amount, method, date_time, bill_id)
+    SELECT 10, 'card', date_trunc('minute', now()) - (b.id %% 90) * INTERVAL '1 day', b.id
+    FROM bill AS b
+    WHERE b.id %% 2 = 0 AND (
+        EXISTS (SELECT 1 FROM appointment AS a WHERE a.bill_id = b.id AND a.patient_cc > 9100000000)
+        OR EXISTS (SELECT 1 FROM hospitalization AS h WHERE h.bill_id = b.id AND h.patient_cc > 9100000000)
+    );
+    UPDATE bill SET paid = TRUE WHERE id IN (SELECT bill_id FROM payment);
+'''
+
+
+class RecordingCursor:
+    def __init__(self, cursor, statements):
+        self.cursor = cursor
+        self.statements = statements
+
+    def execute(self, statement, values=None):
+        self.statements.append(self.cursor.mogrify(statement, values).decode())
+        return self.cursor.execute(statement, values)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SeededConnection:
+    # what the endpoints get instead of a new connection: the seeded transaction, where
+    # commit and rollback work on a savepoint
+    savepoints = itertools.count()
+
+    def __init__(self, conn, statements):
+        self.conn = conn
+        self.statements = statements
+        self.savepoint = f'endpoint_{next(self.savepoints)}'
+        self.conn.cursor().execute(f'SAVEPOINT {self.savepoint}')
+
+    def __setattr__(self, name, value):
+        if name != 'autocommit':
+            super().__setattr__(name, value)
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self.conn.cursor(*args, **kwargs), self.statements)
+
+    def commit(self):
+        self.conn.cursor().execute(f'RELEASE SAVEPOINT {self.savepoint}; SAVEPOINT {self.savepoint}')
+
+    def rollback(self):
+        self.conn.cursor().execute(f'ROLLBACK TO SAVEPOINT {self.savepoint}')
+
+    def close(self):
+        self.rollback()
+        self.conn.cursor().execute(f'RELEASE SAVEPOINT {self.savepoint}')
+
+
+@pytest.fixture(scope='module')
+def seeded():
+    try:
+        conn = care_sync.db_connection()
+    except psycopg2.OperationalError as error:
+        pytest.skip(f'no database: {error}')
+
+    statements = []
+    connect = lambda *args: SeededConnection(conn, statements)
+    originals = care_sync.db_connection, care_sync.replica_connection, care_sync.medicine_index
+    care_sync.db_connection = care_sync.replica_connection = connect
+    # no LISTEN thread on the seeded connection: the index is loaded by every lookup
+    care_sync.medicine_index = care_sync.MedicineIndex(listen=False)
+    care_sync.logger = logging.getLogger('test_plans')
+    client = care_sync.app.test_client()
+
+    try:
+        employee = {'password': PASSWORD, 'contract_issue_date': '2024-01-01', 'contract_due_date': '2030-01-01', 'birthday': '1990-01-01', 'salary': 1000}
+        registrations = [
+            ('patient', {'cc': PATIENT, 'name': 'Plan', 'password': PASSWORD, 'health_number': PATIENT, 'emergency_contact': 1, 'birthday': '1990-01-01', 'email': 'patient@plan.test'}),
+            ('assistant', dict(employee, cc=9000000002, name='Plan', contract_id=9000000002, email='assistant@plan.test')),
+            ('nurse', dict(employee, cc=9000000003, name='Plan', contract_id=9000000003, email='head@plan.test')),
+            ('nurse', dict(employee, cc=9000000004, name='Plan', contract_id=9000000004, email='team@plan.test', superior_email='head@plan.test')),
+            ('doctor', dict(employee, cc=9000000005, name='Plan', contract_id=9000000005, email='doctor@plan.test', license_id='PLAN', license_issue_date='2020-01-01',
+                            license_due_date='2030-01-01', license_company='X', specialties=[{'specialty_name': 'plan', 'parent_specialty': 'plan parent'}]))
+        ]
+        for role, payload in registrations:
+            response = client.post(f'/dbproj/register/{role}', json=payload)
+            assert response.status_code == 200, response.get_json()
+
+        cur = conn.cursor()
+        cur.execute(SEED, {'patients': PATIENTS, 'doctors': DOCTORS, 'nurses': NURSES})
+        # bills of the registered patient: one paid in part, one untouched
+        cur.execute('''
+            INSERT INTO appointment(start_time, doctor_email, patient_cc)
+            SELECT date_trunc('hour', now()) - g * INTERVAL '1 hour' - INTERVAL '30 minutes', 'doctor1@plan.test', %s
+            FROM generate_series(1, 2) AS g
+            RETURNING bill_id
+        ''', (PATIENT,))
+        bills = [row[0] for row in cur.fetchall()]
+        cur.execute("INSERT INTO payment(amount, method, date_time, bill_id) VALUES (10, 'card', now(), %s)", (bills[0],))
+        cur.execute('SELECT id, entry_time FROM hospitalization WHERE patient_cc = %s ORDER BY id LIMIT 1', (BULK_PATIENT,))
+        hospitalization, entry_time = cur.fetchone()
+        cur.execute('SELECT id FROM appointment WHERE patient_cc = %s ORDER BY id DESC LIMIT 1', (PATIENT,))
+        appointment = cur.fetchone()[0]
+        # statistics from every row, not a sample: the plans (the archive's joins above
+        # all) are the same on every run
+        cur.execute('SET LOCAL default_statistics_target = 1000')
+        cur.execute('ANALYZE')
+        large = large_tables(cur)
+
+        tokens = {}
+        for role, username in [('patient', PATIENT), ('assistant', 'assistant@plan.test'), ('nurse', 'head@plan.test'), ('doctor', 'doctor@plan.test')]:
+            response = client.put('/dbproj/user', json={'username': username, 'password': PASSWORD})
+            assert response.status_code == 200, response.get_json()
+            tokens[role] = response.get_json()['results']
+
+        yield {'client': client, 'large': large, 'conn': conn, 'statements': statements, 'tokens': tokens, 'bills': bills,
+               'hospitalization': hospitalization, 'hospitalization_time': entry_time + datetime.timedelta(hours=20), 'appointment': appointment}
+
+    finally:
+        care_sync.db_connection, care_sync.replica_connection, care_sync.medicine_index = originals
+        conn.rollback()
+        conn.close()
+
+
+def when(days, hour=10):
+    return (datetime.datetime.now() + datetime.timedelta(days=days)).replace(hour=hour, minute=0, second=0, microsecond=0).isoformat()
+
+
+# (name, role, method, path, payload, tables a full scan is expected on)
+# paths and payloads are formatted with the seed
+CASES = [
+    ('register patient', None, 'post', '/dbproj/register/patient',
+        {'cc': 9000000011, 'name': 'Plan', 'password': PASSWORD, 'health_number': 9000000011, 'emergency_contact': 1, 'birthday': '1990-01-01', 'email': 'x@plan.test'}, set()),
+    ('login patient', None, 'put', '/dbproj/user', {'username': PATIENT, 'password': PASSWORD}, set()),
+    ('login employee', None, 'put', '/dbproj/user', {'username': 'assistant@plan.test', 'password': PASSWORD}, set()),
+    ('appointments', 'assistant', 'get', f'/dbproj/appointments/{BULK_PATIENT}', None, set()),
+    ('appointments archived', 'assistant', 'get', f'/dbproj/appointments/{BULK_PATIENT}?archived=true', None, set()),
+    ('prescriptions', 'assistant', 'get', f'/dbproj/prescriptions/{BULK_PATIENT}', None, set()),
+    ('prescriptions with side effects', 'assistant', 'get', f'/dbproj/prescriptions/{BULK_PATIENT}?include=side_effects', None, set()),
+    ('patient dashboard', 'assistant', 'get', f'/dbproj/dashboard/{BULK_PATIENT}', None, set()),
+    ('side effects', 'doctor', 'get', '/dbproj/side_effects?medicine=plan medicine 1&medicine=plan medicine 2', None, set()),
+    ('schedule appointment', 'patient', 'post', '/dbproj/appointment', {'doctor_id': 'doctor1@plan.test', 'appointment_time': when(5)}, set()),
+    ('schedule surgery', 'assistant', 'post', '/dbproj/surgery',
+        {'patient_id': PATIENT, 'doctor': 'doctor2@plan.test', 'nurses': [['nurse3@plan.test', 'aux']], 'surgery_start': when(6), 'surgery_end': when(6, 12),
+         'hospitalization_entry_time': when(6, 9), 'hospitalization_exit_time': when(8), 'hospitalization_responsable_nurse': 'team@plan.test',
+         'hospitalization_team': 'head@plan.test'}, set()),
+    ('schedule surgery in hospitalization', 'assistant', 'post', '/dbproj/surgery/{hospitalization}',
+        {'patient_id': BULK_PATIENT, 'doctor': 'doctor@plan.test', 'nurses': [], 'surgery_start': '{surgery_start}', 'surgery_end': '{surgery_end}'}, set()),
+    ('add prescription', 'doctor', 'post', '/dbproj/prescription',
+        {'type': 'appointment', 'event_id': '{appointment}', 'validity': '2030-01-01', 'medicines': [{'name': 'plan medicine 1', 'posology_dose': '1', 'posology_frequency': 'daily'}]}, set()),
+    ('add prescriptions', 'doctor', 'post', '/dbproj/prescriptions',
+        {'prescriptions': [{'type': 'hospitalization', 'event_id': '{hospitalization}', 'validity': '2030-01-01', 'medicines': [{'name': 'plan medicine 2', 'posology_dose': '1', 'posology_frequency': 'daily'}]},
+                           {'type': 'appointment', 'event_id': '{appointment}', 'validity': '2030-01-01', 'medicines': [{'name': 'plan medicine 3', 'posology_dose': '2', 'posology_frequency': 'weekly'}]}]}, set()),
+    ('execute payment', 'patient', 'post', '/dbproj/bills/{bill}', {'amount': 10, 'payment_method': 'card'}, set()),
+    ('import payments', 'assistant', 'post', '/dbproj/bills/import', 'bill_id,amount,payment_method\n{bill},5,card\n', set()),
+    # exports read their days whole: payments pruned to the partition, the appointments and
+    # hospitalizations of the range through their BRIN indexes, which on the seeded sizes
+    # (a few block ranges per table) can cost as much as a scan
+    ('export payments', 'assistant', 'get', '/dbproj/export/payments?from={day}&to={day}', None, {'payment'}),
+    ('export bills', 'assistant', 'get', '/dbproj/export/bills?from={day}&to={day}', None, {'appointment', 'hospitalization'}),
+    # a month (or day) of payments is read whole, pruned to its partition
+    ('top3', 'assistant', 'get', '/dbproj/top3', None, {'payment'}),
+    ('top n month', 'assistant', 'get', '/dbproj/top/10?month={month}', None, {'payment'}),
+    # the hospitalizations of the range through their BRIN index (as for the exports), the
+    # rest of the daily summary by index
+    ('daily', 'assistant', 'get', '/dbproj/daily/{day}', None, {'hospitalization'}),
+    ('daily series', 'assistant', 'get', '/dbproj/daily?from={month_ago}&to={day}', None, {'hospitalization'}),
+    # a year of surgeries
+    ('report', 'assistant', 'get', '/dbproj/report', None, {'surgery'}),
+    ('census', 'nurse', 'get', '/dbproj/census?at={day}T12:00', None, set()),
+    ('census series', 'assistant', 'get', '/dbproj/census?from={month_ago}T00:00&to={day}T00:00', None, set()),
+    ('nurse team', 'nurse', 'get', '/dbproj/nurses/head@plan.test/team', None, set()),
+    ('nurse superiors', 'nurse', 'get', '/dbproj/nurses/team@plan.test/superiors', None, set()),
+    # archiving is a batch job: its slice of appointments (about 2% of them, with their
+    # paid bills) is hash joined against the appointment tables and bill, the
+    # hospitalizations are read through their BRIN index (as for the exports); the
+    # rest of the moves (prescriptions, surgeries, payments) are index lookups
+    ('archive', 'assistant', 'post', '/dbproj/archive', {'retention_days': 1600},
+        {'appointment', 'appointment_role', 'appointment_prescription', 'bill', 'hospitalization'}),
+]
+
+
+def fill(value, values):
+    if isinstance(value, str):
+        return value.format(**values)
+    if isinstance(value, dict):
+        return {key: fill(item, values) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, values) for item in value]
+    return value
+
+
+def large_tables(cur):
+    # table (or partition) -> the name the endpoints use for it
+    cur.execute('''
+        SELECT c.relname, COALESCE(root.relname, c.relname)
+        FROM pg_class AS c
+        JOIN pg_namespace AS n ON n.oid = c.relnamespace
+        LEFT JOIN pg_class AS root ON root.oid = pg_partition_root(c.oid) AND root.oid <> c.oid
+        WHERE n.nspname = 'public' AND c.relkind = 'r' AND c.reltuples >= %s
+    ''', (LARGE_ROWS,))
+    return dict(cur.fetchall())
+
+
+def seq_scans(cur):
+    cur.execute("SELECT relname, seq_scan FROM pg_stat_xact_user_tables WHERE schemaname = 'public'")
+    return dict(cur.fetchall())
+
+
+def plan_seq_scans(plan):
+    found = set()
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Schema') == 'public':
+        found.add(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found |= plan_seq_scans(child)
+    return found
+
+
+def explain(cur, statements):
+    plans = []
+    for statement in statements:
+        for part in statement.split(';'):
+            part = part.strip()
+            if not part.upper().startswith(('SELECT', 'WITH')):
+                continue
+            cur.execute('SAVEPOINT explain')
+            try:
+                cur.execute('EXPLAIN (FORMAT JSON, VERBOSE) ' + part)
+                plans.append((part, cur.fetchone()[0][0]['Plan']))
+            except psycopg2.Error:
+                # e.g. the statement reads a temporary table dropped at commit
+                pass
+            finally:
+                cur.execute('ROLLBACK TO SAVEPOINT explain')
+    return plans
+
+
+@pytest.mark.parametrize('name, role, method, path, payload, expected', CASES, ids=[case[0] for case in CASES])
+def test_no_seq_scan_on_large_tables(seeded, name, role, method, path, payload, expected):
+    values = {
+        'bill': seeded['bills'][1 if name == 'import payments' else 0],
+        'hospitalization': seeded['hospitalization'],
+        'surgery_start': seeded['hospitalization_time'].isoformat(),
+        'surgery_end': (seeded['hospitalization_time'] + datetime.timedelta(hours=2)).isoformat(),
+        'appointment': seeded['appointment'],
+        'month': datetime.date.today().strftime('%Y-%m'),
+        'day': (datetime.date.today() - datetime.timedelta(days=1)).isoformat(),
+        'month_ago': (datetime.date.today() - datetime.timedelta(days=31)).isoformat()
+    }
+    headers = {'Authorization': seeded['tokens'][role]} if role else {}
+    cur = seeded['conn'].cursor()
+    seeded['statements'].clear()
+
+    before = seq_scans(cur)
+    if isinstance(payload, str):
+        response = getattr(seeded['client'], method)(fill(path, values), headers=headers, data=fill(payload, values), content_type='text/csv')
+    else:
+        response = getattr(seeded['client'], method)(fill(path, values), headers=headers, json=fill(payload, values))
+    after = seq_scans(cur)
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+    large = seeded['large']
+    scanned = {large[table] for table, count in after.items() if count > before.get(table, 0) and table in large}
+    plans = explain(cur, seeded['statements'])
+    in_plans = [(statement, large[table]) for statement, plan in plans for table in plan_seq_scans(plan) if table in large and large[table] not in expected]
+
+    assert not (scanned - expected), (
+        f'{name}: sequential scan on {sorted(scanned - expected)}\n'
+        + '\n'.join(f'-- seq scan on {table} in:\n{statement}' for statement, table in in_plans)
+    )
+    assert not in_plans, '\n'.join(f'-- seq scan on {table} in:\n{statement}' for statement, table in in_plans)
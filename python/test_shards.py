@@ -0,0 +1,206 @@
+##
+## Sharding tests
+##
+## Creates two scratch shard databases with setup_shards.py next to the one in
+## config.enc (the configured user must be allowed to create databases), points
+## care_sync.py at them and checks that patient data is routed by patient, that
+## reference data and ids stay consistent, that cross-patient reports merge the
+## shards and that staff bookings conflict across shards. The databases are
+## dropped at the end. From the repository root:
+##
+##   python -m pytest -q python/test_shards.py
+##
+
+import datetime
+import logging
+import os
+
+import psycopg2
+import pytest
+
+# care_sync reads secret.key and config.enc from the working directory
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import care_sync
+import setup_shards
+
+
+SHARDS = 2
+PREFIX = 'care_sync_test_shard'
+PASSWORD = 'shard-test'
+
+EMPLOYEE = {'password': PASSWORD, 'birthday': '1980-01-01', 'salary': 1000, 'contract_issue_date': '2020-01-01', 'contract_due_date': '2030-01-01'}
+
+
+def drop_shards():
+    conn = psycopg2.connect(user=care_sync.credentials['user'], password=care_sync.credentials['password'],
+                            host=care_sync.credentials['host'], port=care_sync.credentials['port'], database='postgres')
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        for index in range(SHARDS):
+            cur.execute(f'DROP DATABASE IF EXISTS "{PREFIX}_{index}" WITH (FORCE)')
+    finally:
+        conn.close()
+
+
+def shard_rows(shard, statement, values=None):
+    conn = care_sync.db_connection(shard)
+    try:
+        cur = conn.cursor()
+        cur.execute(statement, values)
+        return cur.fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(scope='module')
+def api():
+    try:
+        drop_shards()
+        for index in range(SHARDS):
+            setup_shards.create_shard(f'{PREFIX}_{index}', index, SHARDS)
+    except psycopg2.Error as error:
+        pytest.skip(f'cannot create the shard databases: {error}')
+
+    originals = care_sync.shards, care_sync.replicas, care_sync.replica_status
+    care_sync.shards = [dict(care_sync.credentials, replicas=[], database=f'{PREFIX}_{index}') for index in range(SHARDS)]
+    care_sync.replicas = [[] for _ in range(SHARDS)]
+    care_sync.replica_status = [[] for _ in range(SHARDS)]
+    care_sync.logger = logging.getLogger('test_shards')
+    client = care_sync.app.test_client()
+
+    def call(method, path, token=None, **kwargs):
+        headers = {'Authorization': token} if token else {}
+        return getattr(client, method)(path, headers=headers, **kwargs)
+
+    # two patients on shard 0, one on shard 1
+    wanted = [0, 0, 1]
+    patients = {}
+    cc = 7000000000
+    while (wanted):
+        cc += 1
+        if (care_sync.shard_for(cc) in wanted):
+            wanted.remove(care_sync.shard_for(cc))
+            patients[cc] = care_sync.shard_for(cc)
+    for cc in patients:
+        response = call('post', '/dbproj/register/patient', json={'cc': cc, 'name': f'Patient {cc}', 'password': PASSWORD, 'health_number': cc,
+                                                                   'emergency_contact': 1, 'birthday': '1990-01-01', 'email': f'{cc}@shard.test'})
+        assert response.status_code == 200, response.get_json()
+
+    call('post', '/dbproj/register/assistant', json=dict(EMPLOYEE, cc=1, contract_id=1, name='Assistant', email='assistant@shard.test'))
+    call('post', '/dbproj/register/nurse', json=dict(EMPLOYEE, cc=2, contract_id=2, name='Nurse', email='nurse@shard.test'))
+    call('post', '/dbproj/register/doctor', json=dict(EMPLOYEE, cc=3, contract_id=3, name='Doctor', email='doctor@shard.test', license_id='S1',
+                                                      license_issue_date='2020-01-01', license_due_date='2030-01-01', license_company='X',
+                                                      specialties=[{'specialty_name': 'surgery', 'parent_specialty': 'medicine'}]))
+
+    def login(username):
+        response = call('put', '/dbproj/user', json={'username': username, 'password': PASSWORD})
+        assert response.status_code == 200, response.get_json()
+        return response.get_json()['results']
+
+    yield call, login, patients
+
+    care_sync.shards, care_sync.replicas, care_sync.replica_status = originals
+    drop_shards()
+
+
+def next_slot(days, hour):
+    return (datetime.datetime.now() + datetime.timedelta(days=days)).replace(hour=hour, minute=0, second=0, microsecond=0).isoformat()
+
+
+def test_patients_live_on_their_shard(api):
+    call, login, patients = api
+    for cc, shard in patients.items():
+        for other in range(SHARDS):
+            found = shard_rows(other, 'SELECT cc FROM patient WHERE cc = %s', (cc,))
+            assert found == ([(cc,)] if other == shard else [])
+        # and log in there
+        login(cc)
+
+
+def test_reference_data_on_every_shard(api):
+    employees = [shard_rows(shard, 'SELECT email, emp_num FROM employee ORDER BY email') for shard in range(SHARDS)]
+    assert len(employees[0]) == 3
+    assert all(rows == employees[0] for rows in employees)
+
+
+def test_ids_tell_the_shard(api):
+    call, login, patients = api
+    for day, (cc, shard) in enumerate(patients.items(), 1):
+        response = call('post', '/dbproj/appointment', login(cc), json={'doctor_id': 'doctor@shard.test', 'appointment_time': next_slot(day, 9)})
+        assert response.status_code == 200, response.get_json()
+        appointment_id = response.get_json()['results']
+        assert care_sync.shard_of(appointment_id) == shard
+        assert shard_rows(shard, 'SELECT patient_cc FROM appointment WHERE id = %s', (appointment_id,)) == [(cc,)]
+
+        response = call('get', f'/dbproj/appointments/{cc}', login(cc))
+        assert [appointment['id'] for appointment in response.get_json()['results']] == [appointment_id]
+
+
+def test_staff_conflict_across_shards(api):
+    call, login, patients = api
+    first, second = [next(cc for cc, shard in patients.items() if shard == index) for index in range(2)]
+    slot = next_slot(20, 11)
+
+    response = call('post', '/dbproj/appointment', login(first), json={'doctor_id': 'doctor@shard.test', 'appointment_time': slot})
+    assert response.status_code == 200, response.get_json()
+    response = call('post', '/dbproj/appointment', login(second), json={'doctor_id': 'doctor@shard.test', 'appointment_time': slot})
+    assert response.status_code == 500
+    assert 'unavailable' in response.get_json()['errors']
+
+    # a surgery of the same doctor overlapping the appointment, on the other shard
+    response = call('post', '/dbproj/surgery', login('assistant@shard.test'), json={
+        'patient_id': second, 'doctor': 'doctor@shard.test', 'nurses': [],
+        'surgery_start': slot, 'surgery_end': next_slot(20, 13),
+        'hospitalization_entry_time': next_slot(20, 10), 'hospitalization_exit_time': next_slot(22, 10),
+        'hospitalization_responsable_nurse': 'nurse@shard.test'})
+    assert response.status_code == 500
+    assert 'unavailable' in response.get_json()['errors']
+
+
+def test_top_patients_merge_the_shards(api):
+    call, login, patients = api
+    assistant = login('assistant@shard.test')
+
+    # every patient has a bill from test_ids_tell_the_shard: pay a different amount on each
+    for amount, (cc, shard) in enumerate(patients.items(), 1):
+        (bill_id,) = shard_rows(shard, 'SELECT a.bill_id FROM appointment AS a WHERE a.patient_cc = %s ORDER BY a.id LIMIT 1', (cc,))[0]
+        response = call('post', f'/dbproj/bills/{bill_id}', login(cc), json={'amount': amount, 'payment_method': 'card'})
+        assert response.status_code == 200, response.get_json()
+
+    expected = list(reversed(patients))
+    response = call('get', '/dbproj/top3', assistant)
+    assert [patient['cc'] for patient in response.get_json()['results']] == expected
+    assert [patient['rank'] for patient in response.get_json()['results']] == [1, 2, 3]
+
+    response = call('get', '/dbproj/top/1', assistant)
+    assert [patient['cc'] for patient in response.get_json()['results']] == expected[:1]
+
+
+def test_import_splits_the_file_by_shard(api):
+    call, login, patients = api
+    bills = [shard_rows(shard, 'SELECT a.bill_id FROM appointment AS a WHERE a.patient_cc = %s ORDER BY a.id LIMIT 1', (cc,))[0][0]
+             for cc, shard in patients.items()]
+    lines = ['bill_id,amount,payment_method'] + [f'{bill_id},1,transfer' for bill_id in bills] + ['not-a-bill,1,transfer', f'{bills[-1]},100000,transfer']
+
+    response = call('post', '/dbproj/bills/import', login('assistant@shard.test'), data='\n'.join(lines) + '\n', content_type='text/csv')
+    assert response.status_code == 200, response.get_json()
+    results = response.get_json()['results']
+    assert results['applied'] == len(bills)
+    # numbered like the file, whatever shard rejected them
+    assert [rejection['line'] for rejection in results['rejected']] == [len(bills) + 1, len(bills) + 2]
+
+
+def test_ward_round_across_shards(api):
+    call, login, patients = api
+    appointments = [shard_rows(shard, 'SELECT a.id FROM appointment AS a WHERE a.patient_cc = %s ORDER BY a.id LIMIT 1', (cc,))[0][0]
+                    for cc, shard in patients.items()]
+    prescriptions = [{'type': 'appointment', 'event_id': appointment_id, 'validity': '2030-01-01',
+                      'medicines': [{'name': 'paracetamol', 'posology_dose': '1 g', 'posology_frequency': 'daily'}]} for appointment_id in appointments]
+
+    response = call('post', '/dbproj/prescriptions', login('doctor@shard.test'), json={'prescriptions': prescriptions})
+    assert response.status_code == 200, response.get_json()
+    # in the order of the request, each on the shard of its appointment
+    for prescription_id, appointment_id in zip(response.get_json()['results'], appointments):
+        assert care_sync.shard_of(prescription_id) == care_sync.shard_of(appointment_id)
+        assert shard_rows(care_sync.shard_of(appointment_id), 'SELECT appointment_id FROM appointment_prescription WHERE prescription_id = %s', (prescription_id,)) == [(appointment_id,)]
@@ -4,6 +4,9 @@ CREATE DATABASE prjdb;
 
 CREATE USER prjadmin WITH PASSWORD 'prjadmin';
 
+-- lets the API see whether a read replica is still streaming (pg_stat_wal_receiver)
+GRANT pg_read_all_stats TO prjadmin;
+
 \c prjdb;
 
 GRANT ALL ON SCHEMA PUBLIC TO prjadmin;
@@ -0,0 +1,39 @@
+/*
+	Migration 001 - nurse supervision closure table
+
+	Adds nurse_closure (every ancestor/descendant pair of nurse_hierarchy, with
+	the distance between them) and fills it from the existing hierarchy.
+	After running this file, reload object_definition.sql so that add_nurse
+	keeps the closure up to date and schedule_surgery accepts a team.
+*/
+\c prjdb;
+
+BEGIN;
+
+CREATE TABLE nurse_closure (
+	ancestor_email	 VARCHAR(128),
+	descendant_email	 VARCHAR(128),
+	depth		 INTEGER NOT NULL,
+	PRIMARY KEY(ancestor_email, descendant_email)
+);
+
+ALTER TABLE nurse_closure ADD UNIQUE (descendant_email, depth);
+ALTER TABLE nurse_closure ADD CONSTRAINT nurse_closure_fk1 FOREIGN KEY (ancestor_email) REFERENCES nurse(email);
+ALTER TABLE nurse_closure ADD CONSTRAINT nurse_closure_fk2 FOREIGN KEY (descendant_email) REFERENCES nurse(email);
+
+INSERT INTO nurse_closure(ancestor_email, descendant_email, depth)
+WITH RECURSIVE chain AS (
+	SELECT email AS ancestor_email, email AS descendant_email, 0 AS depth
+	FROM nurse
+	UNION ALL
+	SELECT nh.superior_email, c.descendant_email, c.depth + 1
+	FROM chain AS c
+	JOIN nurse_hierarchy AS nh ON nh.nurse_email = c.ancestor_email
+)
+SELECT ancestor_email, descendant_email, depth
+FROM chain;
+
+-- schedule_surgery gained a hosp_team argument, drop the old signature to avoid ambiguous calls
+DROP FUNCTION IF EXISTS schedule_surgery(BIGINT, VARCHAR, VARCHAR[], VARCHAR[], TIMESTAMP, TIMESTAMP, BIGINT, TIMESTAMP, TIMESTAMP, VARCHAR);
+
+COMMIT;
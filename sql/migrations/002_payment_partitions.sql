@@ -0,0 +1,55 @@
+/*
+	Migration 002 - monthly range partitioning of payment
+
+	Rebuilds payment as a table partitioned by date_time, copies the existing
+	rows through the default partition and then spreads them into one
+	partition per month (create_payment_partitions moves them out of the
+	default partition). Also adds the BRIN indexes on the appointment,
+	surgery and hospitalization time columns.
+	Run it with psql from this directory: it includes object_definition.sql.
+*/
+\c prjdb;
+
+BEGIN;
+
+ALTER TABLE payment RENAME TO payment_old;
+ALTER INDEX payment_pkey RENAME TO payment_old_pkey;
+
+CREATE TABLE payment (
+	id	 BIGINT NOT NULL DEFAULT nextval('payment_id_seq'),
+	amount	 INTEGER NOT NULL,
+	method	 VARCHAR(128) NOT NULL,
+	date_time TIMESTAMP NOT NULL,
+	bill_id BIGINT,
+	PRIMARY KEY(id,bill_id,date_time)
+) PARTITION BY RANGE (date_time);
+
+CREATE TABLE payment_default PARTITION OF payment DEFAULT;
+
+ALTER TABLE payment_old DROP CONSTRAINT payment_fk1;
+ALTER TABLE payment ADD CONSTRAINT payment_fk1 FOREIGN KEY (bill_id) REFERENCES bill(id);
+ALTER SEQUENCE payment_id_seq OWNED BY payment.id;
+
+INSERT INTO payment(id, amount, method, date_time, bill_id)
+SELECT id, amount, method, date_time, bill_id
+FROM payment_old;
+
+-- views and functions must point at the new table before the old one is dropped
+\ir ../object_definition.sql
+
+SELECT create_payment_partitions(
+	COALESCE((SELECT MIN(date_time) FROM payment)::date, CURRENT_DATE),
+	(CURRENT_DATE + INTERVAL '3 months')::date
+);
+
+-- views no longer defined in object_definition.sql still read the old table
+DROP VIEW IF EXISTS top_patients;
+DROP VIEW IF EXISTS monthly_payments;
+
+DROP TABLE payment_old;
+
+CREATE INDEX appointment_start_time_brin ON appointment USING BRIN (start_time);
+CREATE INDEX surgery_start_time_brin ON surgery USING BRIN (start_time);
+CREATE INDEX hospitalization_entry_time_brin ON hospitalization USING BRIN (entry_time);
+
+COMMIT;
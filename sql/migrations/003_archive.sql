@@ -0,0 +1,29 @@
+/*
+	Migration 003 - archive schema for closed history
+
+	Creates the append-only archive tables used by archive_history.
+	Run it with psql from this directory: it includes object_definition.sql.
+*/
+\c prjdb;
+
+BEGIN;
+
+CREATE SCHEMA archive;
+
+CREATE TABLE archive.bill (LIKE bill);
+CREATE TABLE archive.payment (LIKE payment);
+CREATE TABLE archive.appointment (LIKE appointment);
+CREATE TABLE archive.appointment_role (LIKE appointment_role);
+CREATE TABLE archive.hospitalization (LIKE hospitalization);
+CREATE TABLE archive.surgery (LIKE surgery);
+CREATE TABLE archive.surgery_role (LIKE surgery_role);
+CREATE TABLE archive.prescription (LIKE prescription);
+CREATE TABLE archive.medicine_dosage (LIKE medicine_dosage);
+CREATE TABLE archive.appointment_prescription (LIKE appointment_prescription);
+CREATE TABLE archive.hospitalization_prescription (LIKE hospitalization_prescription);
+
+CREATE INDEX archive_appointment_patient ON archive.appointment (patient_cc);
+
+\ir ../object_definition.sql
+
+COMMIT;
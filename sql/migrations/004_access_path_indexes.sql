@@ -0,0 +1,25 @@
+/*
+	Migration 004 - indexes on the foreign key access paths
+
+	Built CONCURRENTLY so bookings and payments keep running while they are
+	created (payment is partitioned, which does not support it, so its index is
+	built on each partition by a plain CREATE INDEX).
+	Run it with psql from this directory: it includes object_definition.sql
+	for the index-friendly conflict checks.
+*/
+\c prjdb;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS appointment_patient ON appointment (patient_cc);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS appointment_doctor_start ON appointment (doctor_email, start_time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS hospitalization_patient ON hospitalization (patient_cc);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS surgery_hospitalization ON surgery (hospitalization_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS surgery_doctor_start ON surgery (doctor_email, start_time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS surgery_end_time ON surgery (end_time);
+CREATE INDEX IF NOT EXISTS payment_bill ON payment (bill_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS appointment_role_nurse ON appointment_role (nurse_email);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS surgery_role_nurse ON surgery_role (nurse_email);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS appointment_prescription_appointment ON appointment_prescription (appointment_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS hospitalization_prescription_hospitalization ON hospitalization_prescription (hospitalization_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS medicine_dosage_prescription ON medicine_dosage (prescription_id);
+
+\ir ../object_definition.sql
@@ -0,0 +1,21 @@
+/*
+	Migration 005 - patient versions for conditional GET
+
+	Adds patient_version, the per-patient counter behind the ETag of
+	/dbproj/appointments/<id> and /dbproj/prescriptions/<id>. Patients without a
+	row are at version 0, the triggers of object_definition.sql create the row on
+	the first change. Run it with psql from this directory.
+*/
+\c prjdb;
+
+BEGIN;
+
+CREATE TABLE patient_version (
+	patient_cc	 BIGINT,
+	version		 BIGINT NOT NULL DEFAULT 1,
+	PRIMARY KEY(patient_cc)
+);
+
+\ir ../object_definition.sql
+
+COMMIT;
@@ -0,0 +1,29 @@
+/*
+	Migration 006 - asynchronous report jobs
+
+	Adds report_job, the jobs of /dbproj/jobs with their stored results, and
+	the index that lets identical submissions share the current job.
+	Run it with psql from this directory: it includes object_definition.sql.
+*/
+\c prjdb;
+
+BEGIN;
+
+CREATE TABLE report_job (
+	id		 BIGSERIAL,
+	kind		 VARCHAR(32) NOT NULL,
+	params		 JSONB NOT NULL,
+	status		 VARCHAR(16) NOT NULL DEFAULT 'queued',
+	stale		 BOOLEAN NOT NULL DEFAULT FALSE,
+	result		 JSON,
+	error		 TEXT,
+	submitted_at	 TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	finished_at	 TIMESTAMP,
+	PRIMARY KEY(id)
+);
+
+CREATE UNIQUE INDEX report_job_current ON report_job (kind, params) WHERE NOT stale AND status <> 'failed';
+
+\ir ../object_definition.sql
+
+COMMIT;
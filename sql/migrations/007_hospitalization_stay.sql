@@ -0,0 +1,11 @@
+/*
+	Migration 007 - index on the hospitalization stays
+
+	GiST index on tsrange(entry_time, exit_time), for the census of
+	/dbproj/census (patients hospitalised at an instant). Built CONCURRENTLY
+	so admissions keep running while it is created.
+	Run it with psql from this directory.
+*/
+\c prjdb;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS hospitalization_stay ON hospitalization USING GIST (tsrange(entry_time, exit_time));
@@ -46,9 +46,16 @@ BEGIN
 	CALL add_emp(cc_num, name, hashcode, contract_id, sal, contract_issue_date, contract_due_date, birthday, email);
 	
 	INSERT INTO nurse VALUES(email);
+	INSERT INTO nurse_closure VALUES(email, email, 0);
 	IF (email_superior IS NOT NULL) THEN
 		INSERT INTO nurse_hierarchy
 		VALUES(email, email_superior);
+
+		-- every ancestor of the superior (including the superior) is an ancestor of the new nurse
+		INSERT INTO nurse_closure(ancestor_email, descendant_email, depth)
+		SELECT nc.ancestor_email, email, nc.depth + 1
+		FROM nurse_closure AS nc
+		WHERE nc.descendant_email = email_superior;
 	END IF;
 END;
 $$;
@@ -136,6 +143,18 @@ END;
 $$;
 
 
+/* CHANGE NOTIFICATIONS */
+-- delivered to the LISTEN connection of the API (change feed) when the transaction commits
+CREATE OR REPLACE FUNCTION notify_change(event VARCHAR, payload JSONB)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+	PERFORM pg_notify('care_sync', (jsonb_build_object('event', event) || payload)::text);
+END;
+$$;
+
+
 /* SCHEDULE APPOINTMENT */
 CREATE OR REPLACE FUNCTION appointment_trig() 
 RETURNS TRIGGER
@@ -167,25 +186,35 @@ BEGIN
 		RAISE EXCEPTION 'Cannot schedule appointment more than 3 months in advance';
 	END IF;
 
+	-- one EXISTS per access path, so each check is an index scan on the doctor or the patient
 	IF EXISTS (
+			-- Check appointment overlaps
 			SELECT 1
 			FROM appointment AS a
-			FULL OUTER JOIN surgery AS s ON TRUE
-			FULL OUTER JOIN hospitalization AS h ON s.hospitalization_id = h.id
-			WHERE
-				-- Check appointment overlaps
-				a.start_time = appointment_time
+			WHERE a.start_time = appointment_time
 				AND (a.doctor_email = doctor_id OR a.patient_cc = patient_id)
-			OR
-				-- Check surgery overlaps
-				tsrange(appointment_time, appointment_time + INTERVAL '30 minutes')
-				&& tsrange(s.start_time, s.end_time)
-				AND (s.doctor_email = doctor_id OR h.patient_cc = patient_id)
-			OR
-				-- Check hospitalization overlaps
-				tsrange(appointment_time, appointment_time + INTERVAL '30 minutes')
-				&& tsrange(h.entry_time, h.exit_time)
-				AND h.patient_cc = patient_id
+		) OR EXISTS (
+			-- Check surgery overlaps (doctor)
+			SELECT 1
+			FROM surgery AS s
+			WHERE s.doctor_email = doctor_id
+				AND s.start_time < appointment_time + INTERVAL '30 minutes'
+				AND s.end_time > appointment_time
+		) OR EXISTS (
+			-- Check surgery overlaps (patient)
+			SELECT 1
+			FROM hospitalization AS h
+			JOIN surgery AS s ON s.hospitalization_id = h.id
+			WHERE h.patient_cc = patient_id
+				AND s.start_time < appointment_time + INTERVAL '30 minutes'
+				AND s.end_time > appointment_time
+		) OR EXISTS (
+			-- Check hospitalization overlaps
+			SELECT 1
+			FROM hospitalization AS h
+			WHERE h.patient_cc = patient_id
+				AND h.entry_time < appointment_time + INTERVAL '30 minutes'
+				AND h.exit_time > appointment_time
 		) THEN
 		RAISE EXCEPTION 'Doctor or patient unavailable at this time';
 	END IF;
@@ -194,6 +223,14 @@ BEGIN
 	VALUES(appointment_time, doctor_id, patient_id)
 	RETURNING id INTO appointment_id;
 
+	PERFORM notify_change('appointment', jsonb_build_object(
+		'id', appointment_id,
+		'start_time', appointment_time,
+		'patient_cc', patient_id,
+		'doctors', jsonb_build_array(doctor_id),
+		'nurses', '[]'::jsonb
+	));
+
 	RETURN appointment_id;
 
 	EXCEPTION
@@ -245,7 +282,7 @@ BEFORE INSERT ON surgery
 FOR EACH ROW
 EXECUTE FUNCTION surgery_trig();
 
-CREATE OR REPLACE FUNCTION schedule_surgery(patient_id BIGINT, doctor_id VARCHAR(128), nurse_id VARCHAR(128)[], nurse_role VARCHAR(128)[], surgery_start TIMESTAMP, surgery_end TIMESTAMP, hospitalization_id BIGINT, hosp_entry_time TIMESTAMP DEFAULT NULL, hosp_exit_time TIMESTAMP DEFAULT NULL, hosp_nurse VARCHAR(128) DEFAULT NULL)
+CREATE OR REPLACE FUNCTION schedule_surgery(patient_id BIGINT, doctor_id VARCHAR(128), nurse_id VARCHAR(128)[], nurse_role VARCHAR(128)[], surgery_start TIMESTAMP, surgery_end TIMESTAMP, hospitalization_id BIGINT, hosp_entry_time TIMESTAMP DEFAULT NULL, hosp_exit_time TIMESTAMP DEFAULT NULL, hosp_nurse VARCHAR(128) DEFAULT NULL, hosp_team VARCHAR(128) DEFAULT NULL)
 RETURNS TABLE (
     surg_id BIGINT,
     hosp_id BIGINT,
@@ -263,28 +300,53 @@ BEGIN
 		RAISE EXCEPTION 'Surgery start time must be before end time';
 	END IF;
 
+	-- one EXISTS per access path, so each check is an index scan on the doctor, the patient or the nurses
 	IF EXISTS (
+			-- Check appointment overlaps (doctor or patient)
 			SELECT 1
 			FROM appointment AS a
-			FULL OUTER JOIN appointment_role AS ar ON a.id = ar.appointment_id
-			FULL OUTER JOIN surgery AS s ON TRUE
-			FULL OUTER JOIN surgery_role AS sr ON s.id = sr.surgery_id
-			FULL OUTER JOIN hospitalization AS h ON s.hospitalization_id = h.id
-			WHERE
-				-- Check appointment overlaps
-				tsrange(a.start_time, a.start_time + INTERVAL '30 minutes')
-				&& tsrange(surgery_start, surgery_end)
-				AND (a.doctor_email = doctor_id OR a.patient_cc = patient_id OR ar.nurse_email = ANY(nurse_id))
-			OR
-				-- Check hospitalization overlaps
-				tsrange(h.entry_time, h.exit_time)
-				&& tsrange(surgery_start, surgery_end)
-				AND h.patient_cc = patient_id
-			OR
-				-- Check surgery overlaps
-				tsrange(s.start_time, s.end_time)
-				&& tsrange(surgery_start, surgery_end)
-				AND (s.doctor_email = doctor_id OR h.patient_cc = patient_id OR sr.nurse_email = ANY(nurse_id))
+			WHERE (a.doctor_email = doctor_id OR a.patient_cc = patient_id)
+				AND a.start_time < surgery_end
+				AND a.start_time > surgery_start - INTERVAL '30 minutes'
+		) OR EXISTS (
+			-- Check appointment overlaps (nurses)
+			SELECT 1
+			FROM appointment_role AS ar
+			JOIN appointment AS a ON a.id = ar.appointment_id
+			WHERE ar.nurse_email = ANY(nurse_id)
+				AND a.start_time < surgery_end
+				AND a.start_time > surgery_start - INTERVAL '30 minutes'
+		) OR EXISTS (
+			-- Check hospitalization overlaps (other than the one the surgery is added to)
+			SELECT 1
+			FROM hospitalization AS h
+			WHERE h.patient_cc = patient_id
+				AND h.entry_time < surgery_end
+				AND h.exit_time > surgery_start
+				AND h.id IS DISTINCT FROM hospitalization_id
+		) OR EXISTS (
+			-- Check surgery overlaps (doctor)
+			SELECT 1
+			FROM surgery AS s
+			WHERE s.doctor_email = doctor_id
+				AND s.start_time < surgery_end
+				AND s.end_time > surgery_start
+		) OR EXISTS (
+			-- Check surgery overlaps (patient)
+			SELECT 1
+			FROM hospitalization AS h
+			JOIN surgery AS s ON s.hospitalization_id = h.id
+			WHERE h.patient_cc = patient_id
+				AND s.start_time < surgery_end
+				AND s.end_time > surgery_start
+		) OR EXISTS (
+			-- Check surgery overlaps (nurses)
+			SELECT 1
+			FROM surgery_role AS sr
+			JOIN surgery AS s ON s.id = sr.surgery_id
+			WHERE sr.nurse_email = ANY(nurse_id)
+				AND s.start_time < surgery_end
+				AND s.end_time > surgery_start
 		) THEN
 		RAISE EXCEPTION 'Doctor, nurse or patient unavailable at this time';
 	END IF;
@@ -292,6 +354,12 @@ BEGIN
 	IF (hosp_entry_time IS NOT NULL) THEN
 		IF (hosp_entry_time >= hosp_exit_time) THEN
 			RAISE EXCEPTION 'Hospitalization entry time must be before exit time';
+		ELSIF (hosp_team IS NOT NULL AND NOT EXISTS (
+				SELECT 1
+				FROM nurse_closure AS nc
+				WHERE nc.ancestor_email = hosp_team AND nc.descendant_email = hosp_nurse
+			)) THEN
+			RAISE EXCEPTION 'Responsable nurse is not part of the team';
 		END IF;
 		INSERT INTO hospitalization(entry_time, exit_time, nurse_email, patient_cc)
 		VALUES(hosp_entry_time, hosp_exit_time, hosp_nurse, patient_id)
@@ -311,6 +379,16 @@ BEGIN
 		VALUES(UNNEST(nurse_role), surgery_id, UNNEST(nurse_id));
 	END IF;
 
+	PERFORM notify_change('surgery', jsonb_build_object(
+		'id', surgery_id,
+		'hospitalization_id', hospitalization_id,
+		'start_time', surgery_start,
+		'end_time', surgery_end,
+		'patient_cc', patient_id,
+		'doctors', jsonb_build_array(doctor_id),
+		'nurses', to_jsonb(array_remove(COALESCE(nurse_id, '{}') || hosp_nurse, NULL))
+	));
+
 	RETURN QUERY
 	SELECT surgery_id, hospitalization_id, hosp_bill_id;
 END;
@@ -375,17 +453,159 @@ BEGIN
 	INSERT INTO payment(amount, method, bill_id, date_time)
 	VALUES(payment_amount, payment_method, id_bill, CURRENT_TIMESTAMP);
 
+	PERFORM notify_change('payment', jsonb_build_object(
+		'bill_id', id_bill,
+		'amount', payment_amount,
+		'remaining', bill_amount - paid_amount - payment_amount,
+		'patient_cc', bill_patient,
+		'doctors', '[]'::jsonb,
+		'nurses', '[]'::jsonb
+	));
+
 	RETURN bill_amount - paid_amount - payment_amount;
 END;
 $$;
 
 
+/* BULK PAYMENTS */
+-- applies the rows COPYed into the payment_staging temporary table, returns the rejected lines
+CREATE OR REPLACE FUNCTION import_payments()
+RETURNS TABLE (
+	rejected_line BIGINT,
+	reason TEXT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+	CREATE TEMP TABLE payment_import ON COMMIT DROP AS
+	SELECT
+		ps.line,
+		CASE WHEN ps.bill_id ~ '^\s*[0-9]{1,18}\s*$' THEN TRIM(ps.bill_id)::BIGINT END AS bill_id,
+		CASE WHEN ps.amount ~ '^\s*-?[0-9]{1,9}\s*$' THEN TRIM(ps.amount)::INTEGER END AS amount,
+		NULLIF(TRIM(ps.method), '') AS method,
+		NULL::TEXT AS error
+	FROM payment_staging AS ps;
+
+	UPDATE payment_import AS pi
+	SET error = 'Invalid bill_id, amount or payment_method'
+	WHERE pi.bill_id IS NULL OR pi.amount IS NULL OR pi.method IS NULL;
+
+	UPDATE payment_import AS pi
+	SET error = 'Payment must be positive'
+	WHERE pi.error IS NULL AND pi.amount <= 0;
+
+	-- lock every bill of the file in id order, so concurrent imports and payments cannot deadlock
+	PERFORM 1
+	FROM bill AS b
+	WHERE b.id IN (SELECT pi.bill_id FROM payment_import AS pi WHERE pi.error IS NULL)
+	ORDER BY b.id
+	FOR UPDATE;
+
+	UPDATE payment_import AS pi
+	SET error = 'Bill not found'
+	WHERE pi.error IS NULL AND NOT EXISTS (SELECT 1 FROM bill AS b WHERE b.id = pi.bill_id);
+
+	UPDATE payment_import AS pi
+	SET error = 'Bill already paid'
+	FROM bill AS b
+	WHERE pi.error IS NULL AND b.id = pi.bill_id AND b.paid;
+
+	-- running total per bill in file order: once a bill would be overpaid its remaining lines are rejected
+	WITH paid AS (
+		SELECT p.bill_id, SUM(p.amount) AS amount
+		FROM payment AS p
+		WHERE p.bill_id IN (SELECT pi.bill_id FROM payment_import AS pi WHERE pi.error IS NULL)
+		GROUP BY p.bill_id
+	),
+	running AS (
+		SELECT
+			pi.line,
+			b.amount - COALESCE(paid.amount, 0) AS outstanding,
+			SUM(pi.amount) OVER (PARTITION BY pi.bill_id ORDER BY pi.line) AS running_amount
+		FROM payment_import AS pi
+		JOIN bill AS b ON b.id = pi.bill_id
+		LEFT JOIN paid ON paid.bill_id = pi.bill_id
+		WHERE pi.error IS NULL
+	)
+	UPDATE payment_import AS pi
+	SET error = 'Payment amount exceeds bill amount'
+	FROM running AS r
+	WHERE r.line = pi.line AND r.running_amount > r.outstanding;
+
+	INSERT INTO payment(amount, method, bill_id, date_time)
+	SELECT pi.amount, pi.method, pi.bill_id, CURRENT_TIMESTAMP
+	FROM payment_import AS pi
+	WHERE pi.error IS NULL;
+
+	UPDATE bill AS b
+	SET paid = TRUE
+	FROM (
+		SELECT p.bill_id, SUM(p.amount) AS amount
+		FROM payment AS p
+		WHERE p.bill_id IN (SELECT pi.bill_id FROM payment_import AS pi WHERE pi.error IS NULL)
+		GROUP BY p.bill_id
+	) AS total
+	WHERE b.id = total.bill_id AND b.amount = total.amount;
+
+	RETURN QUERY
+	SELECT pi.line, pi.error
+	FROM payment_import AS pi
+	WHERE pi.error IS NOT NULL
+	ORDER BY pi.line;
+END;
+$$;
+
+
+/* PAYMENT PARTITIONS */
+CREATE OR REPLACE FUNCTION create_payment_partitions(from_month DATE, to_month DATE)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+	month DATE := DATE_TRUNC('month', from_month);
+	partition_name VARCHAR;
+	created INTEGER := 0;
+BEGIN
+	-- concurrent callers (several workers at a month rollover) create the partitions one at a time
+	PERFORM pg_advisory_xact_lock(hashtext('create_payment_partitions'));
+
+	WHILE (month <= to_month) LOOP
+		partition_name := 'payment_' || TO_CHAR(month, 'YYYY_MM');
+
+		IF to_regclass('public.' || partition_name) IS NULL THEN
+			-- rows of this month that landed in the default partition are moved before attaching
+			EXECUTE format('CREATE TABLE %I (LIKE payment INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+			EXECUTE format('
+				WITH moved AS (
+					DELETE FROM payment_default
+					WHERE date_time >= %L AND date_time < %L
+					RETURNING *
+				)
+				INSERT INTO %I SELECT * FROM moved', month, month + INTERVAL '1 month', partition_name);
+			EXECUTE format('ALTER TABLE payment ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition_name, month, month + INTERVAL '1 month');
+			created := created + 1;
+		END IF;
+
+		month := month + INTERVAL '1 month';
+	END LOOP;
+
+	RETURN created;
+END;
+$$;
+
+
 /* ADD PRESCRIPTIONS AND MEDICINE */
-CREATE TYPE medicine_type AS (
-    name VARCHAR,
-    dose VARCHAR,
-    freq VARCHAR
-);
+DO $$
+BEGIN
+	IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'medicine_type') THEN
+		CREATE TYPE medicine_type AS (
+			name VARCHAR,
+			dose VARCHAR,
+			freq VARCHAR
+		);
+	END IF;
+END;
+$$;
 
 CREATE OR REPLACE FUNCTION add_prescription(type VARCHAR, val DATE, event_id BIGINT, medicines medicine_type[])
 RETURNS BIGINT
@@ -417,25 +637,46 @@ LANGUAGE plpgsql
 AS $$
 DECLARE
 	prescription_id BIGINT;
+	event_patient BIGINT;
+	event_doctors JSONB := '[]';
+	event_nurses JSONB := '[]';
 BEGIN
 	IF type = 'appointment' THEN
 		INSERT INTO prescription(validity)
 		VALUES (val)
 		RETURNING id INTO prescription_id;
 
-		INSERT INTO appointment_prescription
-		VALUES(prescription_id, event_id);
+		INSERT INTO appointment_prescription(appointment_id, prescription_id)
+		VALUES(event_id, prescription_id);
+
+		SELECT a.patient_cc, jsonb_build_array(a.doctor_email) INTO event_patient, event_doctors
+		FROM appointment AS a
+		WHERE a.id = event_id;
 	ELSIF type = 'hospitalization' THEN
 		INSERT INTO prescription(validity)
 		VALUES (val)
 		RETURNING id INTO prescription_id;
 
-		INSERT INTO hospitalization_prescription
+		INSERT INTO hospitalization_prescription(prescription_id, hospitalization_id)
 		VALUES(prescription_id, event_id);
+
+		SELECT h.patient_cc, jsonb_build_array(h.nurse_email) INTO event_patient, event_nurses
+		FROM hospitalization AS h
+		WHERE h.id = event_id;
 	ELSE
 		RAISE EXCEPTION 'Invalid event';
 	END IF;
 
+	PERFORM notify_change('prescription', jsonb_build_object(
+		'id', prescription_id,
+		'type', type,
+		'event_id', event_id,
+		'validity', val,
+		'patient_cc', event_patient,
+		'doctors', event_doctors,
+		'nurses', event_nurses
+	));
+
 	RETURN prescription_id;
 
 	EXCEPTION
@@ -446,6 +687,429 @@ BEGIN
 END;
 $$;
 
+-- many prescriptions at once (a ward round), set based: the i-th prescription is
+-- (types[i], vals[i], event_ids[i]) and the medicines are parallel arrays whose
+-- medicine_positions tell the prescription (i) each one belongs to
+CREATE OR REPLACE FUNCTION add_prescriptions(types VARCHAR[], vals DATE[], event_ids BIGINT[], medicine_positions INTEGER[], medicine_names VARCHAR[], doses VARCHAR[], freqs VARCHAR[])
+RETURNS TABLE (
+	created_id BIGINT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+	IF EXISTS (SELECT 1 FROM UNNEST(types) AS t(type) WHERE t.type IS DISTINCT FROM 'appointment' AND t.type IS DISTINCT FROM 'hospitalization') THEN
+		RAISE EXCEPTION 'Invalid event';
+	END IF;
+
+	CREATE TEMP TABLE new_prescription ON COMMIT DROP AS
+	SELECT nextval(pg_get_serial_sequence('prescription', 'id')) AS id, p.position, p.type, p.val, p.event_id
+	FROM UNNEST(types, vals, event_ids) WITH ORDINALITY AS p(type, val, event_id, position);
+	-- a round is small next to the event tables: looked up by id, not hash joined
+	ANALYZE new_prescription;
+
+	INSERT INTO prescription(id, validity)
+	SELECT np.id, np.val
+	FROM new_prescription AS np;
+
+	INSERT INTO appointment_prescription(appointment_id, prescription_id)
+	SELECT np.event_id, np.id
+	FROM new_prescription AS np
+	WHERE np.type = 'appointment';
+
+	INSERT INTO hospitalization_prescription(prescription_id, hospitalization_id)
+	SELECT np.id, np.event_id
+	FROM new_prescription AS np
+	WHERE np.type = 'hospitalization';
+
+	INSERT INTO medicine(name)
+	SELECT DISTINCT m.name
+	FROM UNNEST(medicine_names) AS m(name)
+	ON CONFLICT (name) DO NOTHING;
+
+	INSERT INTO medicine_dosage(quantity, frequency, medicine_name, prescription_id)
+	SELECT m.dose, m.freq, m.name, np.id
+	FROM UNNEST(medicine_positions, medicine_names, doses, freqs) AS m(position, name, dose, freq)
+	JOIN new_prescription AS np ON np.position = m.position
+	ON CONFLICT (medicine_name, prescription_id) DO NOTHING;
+
+	PERFORM notify_change('prescription', jsonb_build_object(
+		'id', np.id,
+		'type', np.type,
+		'event_id', np.event_id,
+		'validity', np.val,
+		'patient_cc', COALESCE(a.patient_cc, h.patient_cc),
+		'doctors', CASE WHEN a.id IS NULL THEN '[]' ELSE jsonb_build_array(a.doctor_email) END,
+		'nurses', CASE WHEN h.id IS NULL THEN '[]' ELSE jsonb_build_array(h.nurse_email) END
+	))
+	FROM new_prescription AS np
+	LEFT JOIN appointment AS a ON np.type = 'appointment' AND a.id = np.event_id
+	LEFT JOIN hospitalization AS h ON np.type = 'hospitalization' AND h.id = np.event_id;
+
+	RETURN QUERY
+	SELECT np.id
+	FROM new_prescription AS np
+	ORDER BY np.position;
+
+	EXCEPTION
+		WHEN FOREIGN_KEY_VIOLATION THEN
+			RAISE EXCEPTION 'Event not found';
+END;
+$$;
+
+/* SIDE EFFECTS */
+-- the API keeps medicine -> side effects in memory (MedicineIndex in care_sync.py)
+-- and loads it again when told, at commit, that it changed
+CREATE OR REPLACE FUNCTION side_effect_changed_trig()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+	PERFORM pg_notify('care_sync_side_effects', TG_TABLE_NAME);
+	RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE TRIGGER side_effect_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON side_effect
+FOR EACH STATEMENT EXECUTE FUNCTION side_effect_changed_trig();
+
+CREATE OR REPLACE TRIGGER reaction_severity_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON reaction_severity
+FOR EACH STATEMENT EXECUTE FUNCTION side_effect_changed_trig();
+
+/* ARCHIVE CLOSED HISTORY */
+CREATE OR REPLACE FUNCTION archive_append_only()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+	RAISE EXCEPTION 'Archived history cannot be modified';
+END;
+$$;
+
+DO $$
+DECLARE
+	archive_table VARCHAR;
+BEGIN
+	FOR archive_table IN SELECT tablename FROM pg_tables WHERE schemaname = 'archive' LOOP
+		EXECUTE format('CREATE OR REPLACE TRIGGER append_only BEFORE UPDATE OR DELETE OR TRUNCATE ON archive.%I FOR EACH STATEMENT EXECUTE FUNCTION archive_append_only()', archive_table);
+	END LOOP;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION archive_history(retention INTERVAL)
+RETURNS TABLE (
+	appointments BIGINT,
+	hospitalizations BIGINT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+	-- paid appointments older than the retention window whose prescriptions already expired
+	CREATE TEMP TABLE archived_appointment ON COMMIT DROP AS
+	SELECT a.id, a.bill_id
+	FROM appointment AS a
+	JOIN bill AS b ON b.id = a.bill_id
+	WHERE b.paid
+		AND a.start_time < CURRENT_TIMESTAMP - retention
+		AND NOT EXISTS (
+			SELECT 1
+			FROM appointment_prescription AS ap
+			JOIN prescription AS p ON p.id = ap.prescription_id
+			WHERE ap.appointment_id = a.id AND p.validity >= CURRENT_DATE
+		);
+	ANALYZE archived_appointment;
+
+	-- same for hospitalizations (a bill of 0 has nothing left to pay), together with their surgeries
+	CREATE TEMP TABLE archived_hospitalization ON COMMIT DROP AS
+	SELECT h.id, h.bill_id
+	FROM hospitalization AS h
+	JOIN bill AS b ON b.id = h.bill_id
+	WHERE (b.paid OR b.amount = 0)
+		AND h.exit_time < CURRENT_TIMESTAMP - retention
+		AND h.entry_time < CURRENT_TIMESTAMP - retention -- implied, lets the entry_time index narrow the scan
+		AND NOT EXISTS (
+			SELECT 1
+			FROM surgery AS s
+			WHERE s.hospitalization_id = h.id AND s.end_time >= CURRENT_TIMESTAMP - retention
+		)
+		AND NOT EXISTS (
+			SELECT 1
+			FROM hospitalization_prescription AS hp
+			JOIN prescription AS p ON p.id = hp.prescription_id
+			WHERE hp.hospitalization_id = h.id AND p.validity >= CURRENT_DATE
+		);
+	ANALYZE archived_hospitalization;
+
+	CREATE TEMP TABLE archived_prescription ON COMMIT DROP AS
+	SELECT ap.prescription_id AS id
+	FROM appointment_prescription AS ap
+	WHERE ap.appointment_id IN (SELECT id FROM archived_appointment)
+	UNION ALL
+	SELECT hp.prescription_id
+	FROM hospitalization_prescription AS hp
+	WHERE hp.hospitalization_id IN (SELECT id FROM archived_hospitalization);
+	-- with statistics on the temporary tables a small batch is moved with index lookups
+	ANALYZE archived_prescription;
+
+	-- move rows children first so foreign keys hold at every step
+	WITH moved AS (
+		DELETE FROM medicine_dosage WHERE prescription_id IN (SELECT id FROM archived_prescription) RETURNING *
+	)
+	INSERT INTO archive.medicine_dosage SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM appointment_prescription WHERE prescription_id IN (SELECT id FROM archived_prescription) RETURNING *
+	)
+	INSERT INTO archive.appointment_prescription SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM hospitalization_prescription WHERE prescription_id IN (SELECT id FROM archived_prescription) RETURNING *
+	)
+	INSERT INTO archive.hospitalization_prescription SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM prescription WHERE id IN (SELECT id FROM archived_prescription) RETURNING *
+	)
+	INSERT INTO archive.prescription SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM appointment_role WHERE appointment_id IN (SELECT id FROM archived_appointment) RETURNING *
+	)
+	INSERT INTO archive.appointment_role SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM appointment WHERE id IN (SELECT id FROM archived_appointment) RETURNING *
+	)
+	INSERT INTO archive.appointment SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM surgery_role
+		WHERE surgery_id IN (
+			SELECT s.id
+			FROM surgery AS s
+			WHERE s.hospitalization_id IN (SELECT id FROM archived_hospitalization)
+		)
+		RETURNING *
+	)
+	INSERT INTO archive.surgery_role SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM surgery WHERE hospitalization_id IN (SELECT id FROM archived_hospitalization) RETURNING *
+	)
+	INSERT INTO archive.surgery SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM hospitalization WHERE id IN (SELECT id FROM archived_hospitalization) RETURNING *
+	)
+	INSERT INTO archive.hospitalization SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM payment
+		WHERE bill_id IN (SELECT bill_id FROM archived_appointment UNION ALL SELECT bill_id FROM archived_hospitalization)
+		RETURNING *
+	)
+	INSERT INTO archive.payment SELECT * FROM moved;
+
+	WITH moved AS (
+		DELETE FROM bill
+		WHERE id IN (SELECT bill_id FROM archived_appointment UNION ALL SELECT bill_id FROM archived_hospitalization)
+		RETURNING *
+	)
+	INSERT INTO archive.bill SELECT * FROM moved;
+
+	RETURN QUERY
+	SELECT (SELECT COUNT(*) FROM archived_appointment), (SELECT COUNT(*) FROM archived_hospitalization);
+END;
+$$;
+
+
+/* PATIENT VERSIONS */
+-- one statement level trigger per table and event, so a bulk import or an archive
+-- run bumps each patient once; the patients are read from the transition tables
+CREATE OR REPLACE FUNCTION patient_version_trig()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+	transition VARCHAR;
+	changed BIGINT[];
+	patients BIGINT[] := '{}';
+BEGIN
+	FOREACH transition IN ARRAY CASE TG_OP
+		WHEN 'INSERT' THEN ARRAY['new_rows']
+		WHEN 'DELETE' THEN ARRAY['old_rows']
+		ELSE ARRAY['new_rows', 'old_rows']
+	END LOOP
+		EXECUTE format(CASE TG_TABLE_NAME
+			WHEN 'appointment' THEN 'SELECT array_agg(r.patient_cc) FROM %I AS r'
+			WHEN 'hospitalization' THEN 'SELECT array_agg(r.patient_cc) FROM %I AS r'
+			WHEN 'appointment_prescription' THEN 'SELECT array_agg(a.patient_cc) FROM %I AS r JOIN appointment AS a ON a.id = r.appointment_id'
+			WHEN 'hospitalization_prescription' THEN 'SELECT array_agg(h.patient_cc) FROM %I AS r JOIN hospitalization AS h ON h.id = r.hospitalization_id'
+			WHEN 'bill' THEN 'SELECT array_agg(COALESCE(
+					(SELECT a.patient_cc FROM appointment AS a WHERE a.bill_id = r.id),
+					(SELECT h.patient_cc FROM hospitalization AS h WHERE h.bill_id = r.id)
+				)) FROM %I AS r'
+			WHEN 'payment' THEN 'SELECT array_agg(COALESCE(
+					(SELECT a.patient_cc FROM appointment AS a WHERE a.bill_id = r.bill_id),
+					(SELECT h.patient_cc FROM hospitalization AS h WHERE h.bill_id = r.bill_id)
+				)) FROM (SELECT DISTINCT bill_id FROM %I) AS r'
+		END, transition) INTO changed;
+		patients := patients || COALESCE(changed, '{}');
+	END LOOP;
+
+	-- in patient order, so concurrent statements lock the counters in the same order
+	INSERT INTO patient_version(patient_cc)
+	SELECT DISTINCT p.cc
+	FROM UNNEST(patients) AS p(cc)
+	WHERE p.cc IS NOT NULL
+	ORDER BY p.cc
+	ON CONFLICT (patient_cc) DO UPDATE SET version = patient_version.version + 1;
+
+	RETURN NULL;
+END;
+$$;
+
+DO $$
+DECLARE
+	versioned_table VARCHAR;
+BEGIN
+	-- the migrations before 005 load this file too, without patient_version yet
+	IF to_regclass('public.patient_version') IS NULL THEN
+		RETURN;
+	END IF;
+
+	FOREACH versioned_table IN ARRAY ARRAY['appointment', 'hospitalization', 'appointment_prescription', 'hospitalization_prescription', 'bill', 'payment'] LOOP
+		EXECUTE format('CREATE OR REPLACE TRIGGER patient_version_insert AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION patient_version_trig()', versioned_table);
+		EXECUTE format('CREATE OR REPLACE TRIGGER patient_version_update AFTER UPDATE ON %I REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION patient_version_trig()', versioned_table);
+		EXECUTE format('CREATE OR REPLACE TRIGGER patient_version_delete AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION patient_version_trig()', versioned_table);
+	END LOOP;
+END;
+$$;
+
+
+/* REPORT JOBS */
+-- a stored result stays valid until the data behind it changes: surgeries for the
+-- monthly report (and the procedures of the top patients), payments for the top
+-- patients of the months they were made in
+CREATE OR REPLACE FUNCTION report_job_stale_trig()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+	transition VARCHAR;
+	months DATE[] := '{}';
+	changed DATE[];
+BEGIN
+	IF TG_TABLE_NAME = 'surgery' THEN
+		UPDATE report_job SET stale = TRUE
+		WHERE kind IN ('report', 'top') AND NOT stale;
+		RETURN NULL;
+	END IF;
+
+	FOREACH transition IN ARRAY CASE TG_OP
+		WHEN 'INSERT' THEN ARRAY['new_rows']
+		WHEN 'DELETE' THEN ARRAY['old_rows']
+		ELSE ARRAY['new_rows', 'old_rows']
+	END LOOP
+		EXECUTE format('SELECT array_agg(DISTINCT date_trunc(''month'', r.date_time)::date) FROM %I AS r', transition) INTO changed;
+		months := months || COALESCE(changed, '{}');
+	END LOOP;
+
+	UPDATE report_job SET stale = TRUE
+	WHERE kind = 'top' AND NOT stale
+		AND (params->>'month')::date = ANY(months);
+
+	RETURN NULL;
+END;
+$$;
+
+DO $$
+DECLARE
+	source_table VARCHAR;
+BEGIN
+	-- the migrations before 006 load this file too, without report_job yet
+	IF to_regclass('public.report_job') IS NULL THEN
+		RETURN;
+	END IF;
+
+	FOREACH source_table IN ARRAY ARRAY['surgery', 'payment'] LOOP
+		EXECUTE format('CREATE OR REPLACE TRIGGER report_job_stale_insert AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION report_job_stale_trig()', source_table);
+		EXECUTE format('CREATE OR REPLACE TRIGGER report_job_stale_update AFTER UPDATE ON %I REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION report_job_stale_trig()', source_table);
+		EXECUTE format('CREATE OR REPLACE TRIGGER report_job_stale_delete AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION report_job_stale_trig()', source_table);
+	END LOOP;
+END;
+$$;
+
+
+/* SHARDING */
+-- patient-centric rows can be spread over several databases (shards in care_sync.py);
+-- every id created on shard i of n is i + 1 modulo n, so an id tells its shard.
+-- Run on each new, still empty, shard: SELECT configure_shard(i, n)
+CREATE OR REPLACE FUNCTION configure_shard(shard_index INTEGER, shard_count INTEGER)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+	sharded_table VARCHAR;
+	sequence_name VARCHAR;
+	last_id BIGINT;
+BEGIN
+	IF (shard_index < 0 OR shard_index >= shard_count) THEN
+		RAISE EXCEPTION 'Invalid shard % of %', shard_index, shard_count;
+	END IF;
+
+	FOREACH sharded_table IN ARRAY ARRAY['appointment', 'hospitalization', 'surgery', 'prescription', 'bill', 'payment'] LOOP
+		sequence_name := pg_get_serial_sequence(sharded_table, 'id');
+		EXECUTE format('SELECT GREATEST(last_value, 1) FROM %s', sequence_name) INTO last_id;
+		EXECUTE format('ALTER SEQUENCE %s INCREMENT BY %s', sequence_name, shard_count);
+		-- nextval returns the value set plus the increment, both in the shard's residue
+		PERFORM setval(sequence_name, last_id + ((shard_index + 1 - last_id) % shard_count + shard_count) % shard_count, TRUE);
+	END LOOP;
+END;
+$$;
+
+-- whether doctors or nurses have an appointment or a surgery overlapping [busy_start, busy_end)
+-- here; schedule_appointment and schedule_surgery check their own shard, the API asks the others
+CREATE OR REPLACE FUNCTION staff_busy(doctor_ids VARCHAR[], nurse_ids VARCHAR[], busy_start TIMESTAMP, busy_end TIMESTAMP)
+RETURNS BOOLEAN
+LANGUAGE plpgsql
+AS $$
+BEGIN
+	-- an appointment slot when no end is given
+	busy_end := COALESCE(busy_end, busy_start + INTERVAL '30 minutes');
+
+	RETURN EXISTS (
+			SELECT 1
+			FROM appointment AS a
+			WHERE a.doctor_email = ANY(doctor_ids)
+				AND a.start_time < busy_end
+				AND a.start_time > busy_start - INTERVAL '30 minutes'
+		) OR EXISTS (
+			SELECT 1
+			FROM appointment_role AS ar
+			JOIN appointment AS a ON a.id = ar.appointment_id
+			WHERE ar.nurse_email = ANY(nurse_ids)
+				AND a.start_time < busy_end
+				AND a.start_time > busy_start - INTERVAL '30 minutes'
+		) OR EXISTS (
+			SELECT 1
+			FROM surgery AS s
+			WHERE s.doctor_email = ANY(doctor_ids)
+				AND s.start_time < busy_end
+				AND s.end_time > busy_start
+		) OR EXISTS (
+			SELECT 1
+			FROM surgery_role AS sr
+			JOIN surgery AS s ON s.id = sr.surgery_id
+			WHERE sr.nurse_email = ANY(nurse_ids)
+				AND s.start_time < busy_end
+				AND s.end_time > busy_start
+		);
+END;
+$$;
+
+
 /* VIEWS */
 CREATE OR REPLACE VIEW appt_prescriptions AS
 SELECT ap.prescription_id AS id, a.patient_cc
@@ -458,25 +1122,6 @@ FROM hospitalization_prescription AS hp
 JOIN hospitalization AS h ON h.id = hp.hospitalization_id;
 
 
-CREATE OR REPLACE VIEW monthly_payments AS
-SELECT
-	p.cc AS patient_id,
-	SUM(pay.amount) AS total_amount
-FROM payment pay
-LEFT JOIN appointment a ON a.bill_id = pay.bill_id
-LEFT JOIN hospitalization h ON h.bill_id = pay.bill_id
-LEFT JOIN patient p ON p.cc = a.patient_cc OR p.cc = h.patient_cc
-WHERE
-	EXTRACT(YEAR FROM pay.date_time) = EXTRACT(YEAR FROM CURRENT_DATE)
-	AND EXTRACT(MONTH FROM pay.date_time) = EXTRACT(MONTH FROM CURRENT_DATE)
-GROUP BY p.cc;
-
-CREATE OR REPLACE VIEW top_patients AS
-SELECT patient_id, total_amount
-FROM monthly_payments
-ORDER BY total_amount DESC;
-
-
 CREATE OR REPLACE VIEW hospitalization_counts AS
 SELECT h.id, COUNT(DISTINCT s.id) AS surgery_count, COUNT(DISTINCT hp.prescription_id) AS prescription_count
 FROM hospitalization AS h
@@ -104,14 +104,17 @@ CREATE TABLE reaction_severity (
 	PRIMARY KEY(side_effect_occurrence,medicine_name)
 );
 
+-- monthly partitions are created by create_payment_partitions (object_definition.sql)
 CREATE TABLE payment (
 	id	 BIGSERIAL,
 	amount	 INTEGER NOT NULL,
 	method	 VARCHAR(128) NOT NULL,
 	date_time TIMESTAMP NOT NULL,
 	bill_id BIGINT,
-	PRIMARY KEY(id,bill_id)
-);
+	PRIMARY KEY(id,bill_id,date_time)
+) PARTITION BY RANGE (date_time);
+
+CREATE TABLE payment_default PARTITION OF payment DEFAULT;
 
 CREATE TABLE bill (
 	id	 BIGSERIAL,
@@ -157,6 +160,13 @@ CREATE TABLE nurse_hierarchy (
 	PRIMARY KEY(nurse_email)
 );
 
+CREATE TABLE nurse_closure (
+	ancestor_email	 VARCHAR(128),
+	descendant_email	 VARCHAR(128),
+	depth		 INTEGER NOT NULL,
+	PRIMARY KEY(ancestor_email, descendant_email)
+);
+
 CREATE TABLE hospitalization_prescription (
 	prescription_id	 BIGINT,
 	hospitalization_id BIGINT NOT NULL,
@@ -169,6 +179,29 @@ CREATE TABLE appointment_prescription (
 	PRIMARY KEY(prescription_id)
 );
 
+-- bumped by the triggers of object_definition.sql whenever the appointments,
+-- prescriptions or bills of a patient change (ETag of the patient lists)
+CREATE TABLE patient_version (
+	patient_cc	 BIGINT,
+	version		 BIGINT NOT NULL DEFAULT 1,
+	PRIMARY KEY(patient_cc)
+);
+
+-- asynchronous report jobs (/dbproj/jobs) and their stored results, reused until
+-- the triggers of object_definition.sql mark them stale
+CREATE TABLE report_job (
+	id		 BIGSERIAL,
+	kind		 VARCHAR(32) NOT NULL,
+	params		 JSONB NOT NULL,
+	status		 VARCHAR(16) NOT NULL DEFAULT 'queued',
+	stale		 BOOLEAN NOT NULL DEFAULT FALSE,
+	result		 JSON,
+	error		 TEXT,
+	submitted_at	 TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	finished_at	 TIMESTAMP,
+	PRIMARY KEY(id)
+);
+
 ALTER TABLE doctor ADD UNIQUE (license_id);
 ALTER TABLE doctor ADD CONSTRAINT doctor_fk1 FOREIGN KEY (email) REFERENCES employee(email);
 ALTER TABLE employee ADD UNIQUE (emp_num);
@@ -208,8 +241,52 @@ ALTER TABLE doctor_specialty ADD CONSTRAINT doctor_specialty_fk1 FOREIGN KEY (do
 ALTER TABLE doctor_specialty ADD CONSTRAINT doctor_specialty_fk2 FOREIGN KEY (specialty_name) REFERENCES specialty(name);
 ALTER TABLE nurse_hierarchy ADD CONSTRAINT nurse_nurse_fk1 FOREIGN KEY (nurse_email) REFERENCES nurse(email);
 ALTER TABLE nurse_hierarchy ADD CONSTRAINT nurse_nurse_fk2 FOREIGN KEY (superior_email) REFERENCES nurse(email);
+ALTER TABLE nurse_closure ADD UNIQUE (descendant_email, depth);
+ALTER TABLE nurse_closure ADD CONSTRAINT nurse_closure_fk1 FOREIGN KEY (ancestor_email) REFERENCES nurse(email);
+ALTER TABLE nurse_closure ADD CONSTRAINT nurse_closure_fk2 FOREIGN KEY (descendant_email) REFERENCES nurse(email);
 ALTER TABLE hospitalization_prescription ADD CONSTRAINT hospitalization_prescription_fk1 FOREIGN KEY (prescription_id) REFERENCES prescription(id);
 ALTER TABLE hospitalization_prescription ADD CONSTRAINT hospitalization_prescription_fk2 FOREIGN KEY (hospitalization_id) REFERENCES hospitalization(id);
 ALTER TABLE appointment_prescription ADD CONSTRAINT appointment_prescription_fk1 FOREIGN KEY (appointment_id) REFERENCES appointment(id);
 ALTER TABLE appointment_prescription ADD CONSTRAINT appointment_prescription_fk2 FOREIGN KEY (prescription_id) REFERENCES prescription(id);
 
+-- block range indexes: cheap to maintain on insert, let time filters skip old history
+CREATE INDEX appointment_start_time_brin ON appointment USING BRIN (start_time);
+CREATE INDEX surgery_start_time_brin ON surgery USING BRIN (start_time);
+CREATE INDEX hospitalization_entry_time_brin ON hospitalization USING BRIN (entry_time);
+
+-- foreign key access paths of the endpoints and conflict checks (see Índices.txt)
+CREATE INDEX appointment_patient ON appointment (patient_cc);
+CREATE INDEX appointment_doctor_start ON appointment (doctor_email, start_time);
+CREATE INDEX hospitalization_patient ON hospitalization (patient_cc);
+CREATE INDEX surgery_hospitalization ON surgery (hospitalization_id);
+CREATE INDEX surgery_doctor_start ON surgery (doctor_email, start_time);
+CREATE INDEX surgery_end_time ON surgery (end_time);
+CREATE INDEX payment_bill ON payment (bill_id);
+CREATE INDEX appointment_role_nurse ON appointment_role (nurse_email);
+CREATE INDEX surgery_role_nurse ON surgery_role (nurse_email);
+CREATE INDEX appointment_prescription_appointment ON appointment_prescription (appointment_id);
+CREATE INDEX hospitalization_prescription_hospitalization ON hospitalization_prescription (hospitalization_id);
+CREATE INDEX medicine_dosage_prescription ON medicine_dosage (prescription_id);
+
+-- who is hospitalised at an instant (census): range containment on the stay
+CREATE INDEX hospitalization_stay ON hospitalization USING GIST (tsrange(entry_time, exit_time));
+
+-- at most one current job per request, identical submissions share it
+CREATE UNIQUE INDEX report_job_current ON report_job (kind, params) WHERE NOT stale AND status <> 'failed';
+
+-- closed history moved out of the hot tables by archive_history (object_definition.sql)
+CREATE SCHEMA archive;
+
+CREATE TABLE archive.bill (LIKE bill);
+CREATE TABLE archive.payment (LIKE payment);
+CREATE TABLE archive.appointment (LIKE appointment);
+CREATE TABLE archive.appointment_role (LIKE appointment_role);
+CREATE TABLE archive.hospitalization (LIKE hospitalization);
+CREATE TABLE archive.surgery (LIKE surgery);
+CREATE TABLE archive.surgery_role (LIKE surgery_role);
+CREATE TABLE archive.prescription (LIKE prescription);
+CREATE TABLE archive.medicine_dosage (LIKE medicine_dosage);
+CREATE TABLE archive.appointment_prescription (LIKE appointment_prescription);
+CREATE TABLE archive.hospitalization_prescription (LIKE hospitalization_prescription);
+
+CREATE INDEX archive_appointment_patient ON archive.appointment (patient_cc);